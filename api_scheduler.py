@@ -0,0 +1,206 @@
+'''
+Library that schedules requests to NASA's rate-limited APIs.
+
+Every request takes a token from a token bucket whose size and refill rate
+follow the X-RateLimit-Limit and X-RateLimit-Remaining headers NASA sends
+back, so bulk jobs run as fast as the API key allows without tripping 429
+responses. Waiting requests are served in priority order, so interactive
+lookups go ahead of background backfills. 429 and 5xx responses are retried
+with jittered exponential backoff.
+'''
+import heapq
+import itertools
+import random
+import threading
+import time
+import http_lib
+import metrics
+
+
+DEMO_KEY_HOURLY_LIMIT = 30    # Requests per hour allowed for DEMO_KEY
+API_KEY_HOURLY_LIMIT = 1000   # Requests per hour allowed for a personal API key
+
+PRIORITY_INTERACTIVE = 0      # Priority of requests a user is waiting for
+PRIORITY_BACKGROUND = 10      # Priority of backfill and prefetch requests
+
+MAX_RETRIES = 4               # Max retries of a request after 429, 5xx or connection errors
+BACKOFF_BASE = 1.0            # Seconds waited before the first retry
+BACKOFF_MAX = 60.0            # Max seconds waited before a retry
+
+# Global variables
+capacity = DEMO_KEY_HOURLY_LIMIT         # Max tokens in the bucket
+tokens = float(DEMO_KEY_HOURLY_LIMIT)    # Tokens currently in the bucket
+refill_rate = DEMO_KEY_HOURLY_LIMIT / 3600  # Tokens added per second
+last_refill = time.monotonic()           # When tokens were last added
+blocked_until = 0.0                      # No request is sent before this time (after a 429)
+waiters = []                             # Heap of (priority, ticket) of waiting requests
+tickets = itertools.count()              # Keeps waiters of equal priority in FIFO order
+condition = threading.Condition()        # Guards all of the above
+
+def main():
+    configure_rate_limit(API_KEY_HOURLY_LIMIT)
+    resp_msg = request('https://api.nasa.gov/planetary/apod', params={'api_key': 'DEMO_KEY'})
+    print(resp_msg.status_code, get_rate_limit_status())
+    return
+
+def configure_rate_limit(hourly_limit):
+    """Sets the request rate the token bucket allows, e.g. for the API key in use.
+
+    The bucket starts full, and is re-tuned by the rate limit headers of each response.
+
+    Args:
+        hourly_limit (int): Requests allowed per hour
+    """
+    global capacity
+    global tokens
+    global refill_rate
+    global last_refill
+
+    with condition:
+        capacity = hourly_limit
+        tokens = float(hourly_limit)
+        refill_rate = hourly_limit / 3600
+        last_refill = time.monotonic()
+        condition.notify_all()
+
+def request(url, params=None, priority=PRIORITY_INTERACTIVE, max_retries=MAX_RETRIES):
+    """Sends a GET request to a rate-limited NASA API once the rate limit allows it.
+
+    Args:
+        url (str): URL to request
+        params (dict, optional): Query parameters. Defaults to None.
+        priority (int, optional): Lower values are sent first. Defaults to PRIORITY_INTERACTIVE.
+        max_retries (int, optional): Max retries after 429, 5xx or connection errors. Defaults to MAX_RETRIES.
+
+    Raises:
+        requests.RequestException: If the last retry still fails to connect
+
+    Returns:
+        requests.Response: Response message (possibly a 429 or 5xx after the last retry)
+    """
+    import requests  # Deferred until the first API call, like the session itself (see http_lib)
+
+    for attempt in range(max_retries + 1):
+        with metrics.span('rate_limit_wait'):
+            acquire_token(priority)
+        try:
+            with metrics.span('api_call'):
+                resp_msg = http_lib.get(url, params=params)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            metrics.increment('api_retries')
+            back_off(attempt)
+            continue
+
+        update_from_headers(resp_msg)
+        if resp_msg.status_code != 429 and resp_msg.status_code < 500:
+            return resp_msg
+        if attempt == max_retries:
+            return resp_msg
+
+        print(f'NASA API responded {resp_msg.status_code}, retrying...')
+        metrics.increment('api_retries')
+        back_off(attempt, resp_msg.headers.get('Retry-After'), rate_limited=resp_msg.status_code == 429)
+
+def acquire_token(priority):
+    """Waits until the request is first in line and a token is available, then takes the token.
+
+    Args:
+        priority (int): Lower values are served first
+    """
+    global tokens
+
+    with condition:
+        waiter = (priority, next(tickets))
+        heapq.heappush(waiters, waiter)
+        try:
+            while True:
+                refill_tokens()
+                now = time.monotonic()
+                if waiters[0] == waiter and tokens >= 1 and now >= blocked_until:
+                    tokens -= 1
+                    return
+
+                # Only the first waiter knows how long to sleep; the rest wait to be notified
+                timeout = None
+                if waiters[0] == waiter:
+                    timeout = max(blocked_until - now, (1 - tokens) / refill_rate, 0.01)
+                condition.wait(timeout)
+        finally:
+            waiters.remove(waiter)
+            heapq.heapify(waiters)
+            condition.notify_all()
+
+def refill_tokens():
+    """Adds the tokens earned since the last refill. The caller must hold condition."""
+    global tokens
+    global last_refill
+
+    now = time.monotonic()
+    tokens = min(capacity, tokens + (now - last_refill) * refill_rate)
+    last_refill = now
+
+def update_from_headers(resp_msg):
+    """Re-tunes the token bucket from the rate limit headers of a NASA API response.
+
+    Args:
+        resp_msg (requests.Response): Response message
+    """
+    global capacity
+    global tokens
+    global refill_rate
+
+    limit = resp_msg.headers.get('X-RateLimit-Limit')
+    remaining = resp_msg.headers.get('X-RateLimit-Remaining')
+
+    with condition:
+        refill_tokens()
+        if limit is not None and limit.isdigit() and int(limit) > 0:
+            capacity = int(limit)
+            refill_rate = capacity / 3600
+        if remaining is not None and remaining.isdigit():
+            # The server's count is authoritative, but never exceeds the bucket size
+            tokens = min(float(remaining), capacity)
+        condition.notify_all()
+
+def back_off(attempt, retry_after=None, rate_limited=False):
+    """Sleeps before retrying a failed request, using jittered exponential backoff.
+
+    After a 429 response, every other request is held back for the same time.
+
+    Args:
+        attempt (int): Number of the attempt that failed, starting at 0
+        retry_after (str, optional): Retry-After header of the response, in seconds. Defaults to None.
+        rate_limited (bool, optional): Whether the response was a 429. Defaults to False.
+    """
+    global blocked_until
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+
+    if rate_limited:
+        with condition:
+            blocked_until = max(blocked_until, time.monotonic() + delay)
+            condition.notify_all()
+    time.sleep(delay)
+
+def get_rate_limit_status():
+    """Gets the current state of the token bucket.
+
+    Returns:
+        dict: 'tokens' currently available, bucket 'capacity', 'waiting' requests
+        and seconds until requests are no longer held back after a 429 ('blocked_for')
+    """
+    with condition:
+        refill_tokens()
+        return {
+            'tokens': tokens,
+            'capacity': capacity,
+            'waiting': len(waiters),
+            'blocked_for': max(blocked_until - time.monotonic(), 0.0)
+        }
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,22 @@ Library for interacting with NASA's Astronomy Picture of the Day API.
 
 
 import os
-import requests
+from datetime import date, timedelta
+import api_scheduler
+import metadata_cache
+import metrics
+import single_flight
 
 
 API_KEY = os.getenv('NASA_API_KEY', 'DEMO_KEY')  # Use DEMO_KEY as fallback
 APOD_URL = 'https://api.nasa.gov/planetary/apod'
+RANGE_CHUNK_DAYS = 100  # Max number of dates requested in a single range call
+
+# Pace API calls to the rate limit of the API key in use
+if API_KEY == 'DEMO_KEY':
+    api_scheduler.configure_rate_limit(api_scheduler.DEMO_KEY_HOURLY_LIMIT)
+else:
+    api_scheduler.configure_rate_limit(api_scheduler.API_KEY_HOURLY_LIMIT)
 
 def main():
     
@@ -20,16 +31,45 @@ def main():
     
     return None
 
-def get_apod_info(apod_date):
+def get_apod_info(apod_date, priority=api_scheduler.PRIORITY_INTERACTIVE):
     """Gets information from the NASA API for the Astronomy 
     Picture of the Day (APOD) from a specified date.
     Args:
         apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+        priority (int, optional): Scheduling priority of the API call. Defaults to PRIORITY_INTERACTIVE.
     Returns:
         dict: Dictionary of APOD info, if successful. None if unsuccessful
     """
     
    
+    # Historical APOD info never changes, so use the cached copy if there is one
+    cache_hit, apod_info = metadata_cache.lookup_apod_info(apod_date)
+    if cache_hit:
+        metrics.increment('metadata_cache_hits')
+        print(f'Getting {apod_date} APOD information from cache...success')
+        return apod_info
+    metrics.increment('metadata_cache_misses')
+
+    # Concurrent lookups of the same date share one API call
+    return single_flight.call(('apod_info', str(apod_date)), fetch_apod_info, apod_date, priority)
+
+def fetch_apod_info(apod_date, priority=api_scheduler.PRIORITY_INTERACTIVE):
+    """Gets the APOD information for a specified date from the NASA API and
+    stores it in the APOD information cache. Called by get_apod_info on a cache miss.
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+        priority (int, optional): Scheduling priority of the API call. Defaults to PRIORITY_INTERACTIVE.
+    Returns:
+        dict: Dictionary of APOD info, if successful. None if unsuccessful
+    """
+    # Another caller may have fetched it since the cache was checked
+    cache_hit, apod_info = metadata_cache.lookup_apod_info(apod_date)
+    if cache_hit:
+        return apod_info
+
+    # Only imported once the API has to be called, so cache hits never load it
+    import requests
+
     # Parameters for the APOD API call
     image_params = {
      'api_key': API_KEY, 
@@ -37,20 +77,95 @@ def get_apod_info(apod_date):
     }
     
     # Makes a GET request to the APOD API using the specified parameters
-    req = requests.get(APOD_URL, params=image_params)
+    try:
+        req = api_scheduler.request(APOD_URL, params=image_params, priority=priority)
+    except requests.RequestException as e:
+        print(f'failure to get APOD Information - Error: {e}')
+        return None
     
     # If the API call is successful, returns the APOD info dictionary
     if req.status_code == 200:
         print(f'Getting {apod_date} APOD information from NASA...success')
-        return req.json()
+        apod_info = req.json()
+        metadata_cache.store_apod_info(apod_date, apod_info)
+        return apod_info
         
     # If the API call is unsuccessful, returns None
     if req.status_code > 200:
         print(f'failure to get APOD Information - Status: {req.status_code}')
         print(f'Error message: {req.text}')
+        metadata_cache.store_apod_info(apod_date, None)
         return None
     
-   
+def get_apod_info_range(start_date, end_date, chunk_days=RANGE_CHUNK_DAYS, priority=api_scheduler.PRIORITY_BACKGROUND):
+    """Gets information from the NASA API for every APOD between two dates
+    (inclusive) using the start_date/end_date parameters of the APOD API.
+
+    Long spans are split into chunks of at most chunk_days dates, so a year
+    of APODs costs a handful of API calls instead of one call per date.
+
+    Args:
+        start_date (date): First APOD date (Can also be a string formatted as YYYY-MM-DD)
+        end_date (date): Last APOD date (Can also be a string formatted as YYYY-MM-DD)
+        chunk_days (int, optional): Max dates per API call. Defaults to RANGE_CHUNK_DAYS.
+        priority (int, optional): Scheduling priority of the API calls. Defaults to PRIORITY_BACKGROUND.
+
+    Yields:
+        dict: Dictionary of APOD info for each date in the range, oldest first
+    """
+    if isinstance(start_date, str):
+        start_date = date.fromisoformat(start_date)
+    if isinstance(end_date, str):
+        end_date = date.fromisoformat(end_date)
+
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+
+        # Skips the API call if every date in the chunk is already cached
+        cached_infos = []
+        chunk_date = chunk_start
+        while chunk_date <= chunk_end:
+            cache_hit, apod_info = metadata_cache.lookup_apod_info(chunk_date)
+            if not cache_hit or apod_info is None:
+                break
+            cached_infos.append(apod_info)
+            chunk_date += timedelta(days=1)
+        else:
+            metrics.increment('metadata_cache_hits', len(cached_infos))
+            print(f'Getting {chunk_start} to {chunk_end} APOD information from cache...success')
+            yield from cached_infos
+            chunk_start = chunk_end + timedelta(days=1)
+            continue
+
+        metrics.increment('metadata_cache_misses', (chunk_end - chunk_start).days + 1)
+        import requests
+
+        # Parameters for the APOD API range call
+        range_params = {
+         'api_key': API_KEY,
+         'start_date': chunk_start.isoformat(),
+         'end_date': chunk_end.isoformat()
+        }
+
+        try:
+            req = api_scheduler.request(APOD_URL, params=range_params, priority=priority)
+        except requests.RequestException as e:
+            print(f'failure to get APOD Information for {chunk_start} to {chunk_end} - Error: {e}')
+            return
+
+        # Stops at the first failed chunk, since later chunks would most likely fail too
+        if req.status_code != 200:
+            print(f'failure to get APOD Information for {chunk_start} to {chunk_end} - Status: {req.status_code}')
+            print(f'Error message: {req.text}')
+            return
+
+        print(f'Getting {chunk_start} to {chunk_end} APOD information from NASA...success')
+        for apod_info in sorted(req.json(), key=lambda info: info['date']):
+            metadata_cache.store_apod_info(apod_info['date'], apod_info)
+            yield apod_info
+
+        chunk_start = chunk_end + timedelta(days=1)
 
 def get_apod_image_url(apod_info_dict):
     """Gets the URL of the APOD image from the dictionary of APOD information.
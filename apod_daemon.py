@@ -0,0 +1,329 @@
+"""
+Long-running service that keeps the desktop background on the latest APOD.
+
+Unlike running apod_desktop.py from cron, the service opens the image cache
+DB and the pooled HTTP session once and keeps them warm. Shortly after NASA
+publishes the day's APOD (midnight US Eastern time), it fetches the new
+image and renders its screen-size variant. Only once both are on disk is
+the wallpaper switched, so the desktop never sees a partial file. Until
+the new APOD appears, it is polled for every few minutes.
+
+A local control socket accepts one JSON request per line, so the viewer (or
+the command line) can trigger actions without starting a new process:
+  {"command": "status"}
+  {"command": "refresh"}                          check for a new APOD now, even if the last check just failed
+  {"command": "set_wallpaper", "date": "YYYY-MM-DD"} (or "apod_id": N)
+  {"command": "cache", "dates": ["YYYY-MM-DD", ...]}
+  {"command": "stop"}
+Each response is one JSON line with "ok" and either the result or an "error".
+
+Usage:
+  python apod_daemon.py                      Run the service
+  python apod_daemon.py status|refresh|stop  Send a command to the running service
+  python apod_daemon.py set_wallpaper YYYY-MM-DD
+"""
+from datetime import date, datetime, timedelta, timezone
+from datetime import time as dt_time
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import apod_api
+import apod_desktop
+import cache_db
+import http_lib
+import image_lib
+import metadata_cache
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    PUBLISH_TIMEZONE = ZoneInfo('America/New_York')
+except (ImportError, ZoneInfoNotFoundError):
+    PUBLISH_TIMEZONE = timezone(timedelta(hours=-5))  # No tz database, so daylight saving time is ignored
+
+
+PUBLISH_DELAY = timedelta(minutes=5)  # Wait after midnight US Eastern time before the first check
+POLL_INTERVAL = 10 * 60               # Seconds between checks while the new APOD is not out yet
+CONTROL_PORT = 8593                   # TCP port of the control socket where there are no Unix sockets
+CONTROL_TIMEOUT = 300                 # Seconds a control client waits for a response
+
+# Global variables
+status = {
+    'started': None,           # When the service started (ISO timestamp)
+    'last_check': None,        # When the NASA API was last checked for a new APOD
+    'next_check': None,        # When it will be checked next
+    'wallpaper_date': None,    # APOD date of the current wallpaper
+    'wallpaper_id': None       # Record ID of the current wallpaper in the image cache DB
+}
+action_lock = threading.RLock()  # Runs one action (check, set wallpaper, cache) at a time
+wake_event = threading.Event()   # Set to check for a new APOD right away
+stopping = False                 # Set when the service is shutting down
+
+def main():
+    if len(sys.argv) > 1:
+        params = {'date': sys.argv[2]} if len(sys.argv) > 2 else {}
+        response = send_command(sys.argv[1], **params)
+        if response is None:
+            print('Error: The APOD service is not running.')
+            sys.exit(1)
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response['ok'] else 1)
+
+    run_daemon()
+
+def run_daemon():
+    """Runs the service until it is stopped by a stop command, SIGTERM or Ctrl+C."""
+    global stopping
+
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+    server = start_control_server()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_daemon())
+    status['started'] = datetime.now().isoformat(timespec='seconds')
+    print('APOD service started')
+
+    try:
+        while not stopping:
+            found = check_for_new_apod()
+            next_check = get_next_check_time(found)
+            status['next_check'] = next_check.isoformat(timespec='seconds')
+            wake_event.wait(max((next_check - datetime.now(PUBLISH_TIMEZONE)).total_seconds(), 0))
+            wake_event.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopping = True
+        stop_control_server(server)
+        cache_db.close_db()
+        http_lib.close_session()
+        print('APOD service stopped')
+
+def stop_daemon():
+    """Makes the service stop after the action it is running."""
+    global stopping
+    stopping = True
+    wake_event.set()
+
+def get_publish_date():
+    """Gets the date of the latest APOD NASA may have published, i.e. today in US Eastern time.
+
+    Returns:
+        date: Date of the latest APOD
+    """
+    return datetime.now(PUBLISH_TIMEZONE).date()
+
+def get_next_check_time(found):
+    """Determines when to check for a new APOD next.
+
+    Args:
+        found (bool): Whether the APOD of the current publish date is already the wallpaper
+
+    Returns:
+        datetime: Time of the next check
+    """
+    now = datetime.now(PUBLISH_TIMEZONE)
+    if not found:
+        return now + timedelta(seconds=POLL_INTERVAL)
+    next_midnight = datetime.combine(now.date() + timedelta(days=1), dt_time(0), tzinfo=PUBLISH_TIMEZONE)
+    return next_midnight + PUBLISH_DELAY
+
+def check_for_new_apod():
+    """Checks for the APOD of the current publish date and, if it is out and
+    is an image, caches it and sets it as the desktop background image.
+
+    Returns:
+        bool: True, if the wallpaper is the APOD of the current publish date
+        (or that APOD is a video). False, if it is not out yet.
+    """
+    with action_lock:
+        publish_date = get_publish_date()
+        status['last_check'] = datetime.now().isoformat(timespec='seconds')
+        if status['wallpaper_date'] == publish_date.isoformat():
+            return True
+
+        apod_info = apod_api.get_apod_info(publish_date)
+        if apod_info is None:
+            print(f'APOD for {publish_date} is not out yet')
+            return False
+        if apod_info.get('media_type') != 'image':
+            print(f'APOD for {publish_date} is a video, keeping the current wallpaper')
+            return True
+
+        # Hands the fetched info to add_apod_to_cache, as get_apod_date does
+        apod_desktop.cached_apod_info = apod_info
+        apod_id = apod_desktop.add_apod_to_cache(publish_date)
+        return apod_id != 0 and set_wallpaper(apod_id)
+
+def set_wallpaper(apod_id):
+    """Sets a cached APOD image as the desktop background image.
+
+    Its screen-size variant is rendered first, so the desktop switches
+    straight to a finished file.
+
+    Args:
+        apod_id (int): Record ID of the APOD in the image cache DB
+
+    Returns:
+        bool: True, if successful. False, if unsuccessful
+    """
+    with action_lock:
+        apod_info = apod_desktop.get_apod_info(apod_id)
+        if apod_info is None:
+            return False
+        apod_desktop.make_wallpaper_variants([apod_id])
+        if not image_lib.set_desktop_background_image(apod_info['file_path']):
+            return False
+
+        query_result = cache_db.query_one("SELECT apod_date FROM image_apod WHERE id = ?", (apod_id,))
+        status['wallpaper_id'] = apod_id
+        status['wallpaper_date'] = query_result[0] if query_result is not None else None
+        return True
+
+def parse_date(date_text):
+    """Converts a date in a control request to an APOD date.
+
+    Args:
+        date_text (str): Date formatted as YYYY-MM-DD
+
+    Raises:
+        ValueError: If the date is invalid, before the first APOD, or not published yet
+
+    Returns:
+        date: APOD date
+    """
+    apod_date = date.fromisoformat(date_text)
+    if not apod_desktop.MIN_APOD_DATE <= apod_date <= get_publish_date():
+        raise ValueError(f'No APOD for {date_text}')
+    return apod_date
+
+def run_command(request):
+    """Runs one request received on the control socket.
+
+    Args:
+        request (dict): Request with its 'command' and parameters
+
+    Raises:
+        ValueError: If the command or one of its parameters is invalid
+        KeyError: If a parameter is missing
+
+    Returns:
+        dict: Response
+    """
+    command = request['command']
+    if command == 'status':
+        return {'ok': True, 'status': dict(status)}
+    if command == 'refresh':
+        # A failed lookup of a few minutes ago would otherwise be answered from the cache
+        metadata_cache.forget_apod_info(get_publish_date())
+        wake_event.set()
+        return {'ok': True}
+    if command == 'stop':
+        stop_daemon()
+        return {'ok': True}
+    if command == 'set_wallpaper':
+        with action_lock:
+            apod_id = request.get('apod_id')
+            if apod_id is None:
+                apod_id = apod_desktop.add_apod_to_cache(parse_date(request['date']))
+            return {'ok': apod_id != 0 and set_wallpaper(int(apod_id)), 'apod_id': apod_id}
+    if command == 'cache':
+        apod_dates = [parse_date(date_text) for date_text in request['dates']]
+        with action_lock:
+            return {'ok': True, 'apod_ids': apod_desktop.add_apod_dates_to_cache(apod_dates)}
+    raise ValueError(f'Unknown command: {command}')
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """Answers the JSON-lines requests of one control socket client."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = run_command(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+def get_socket_path():
+    """Determines the path of the control socket.
+
+    Returns:
+        str: Path of the Unix socket, or None where there are no Unix sockets (Windows)
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    return os.path.join(tempfile.gettempdir(), f'apod_daemon-{os.getuid()}.sock')
+
+def start_control_server():
+    """Starts the control socket on a background thread.
+
+    A Unix socket is used where available, and a localhost TCP port otherwise.
+    Exits script if the service is already running.
+
+    Returns:
+        socketserver.BaseServer: Running control server
+    """
+    socket_path = get_socket_path()
+    if send_command('status') is not None:
+        print('Error: The APOD service is already running.')
+        sys.exit(1)
+
+    if socket_path is not None:
+        # Left behind by a service that did not shut down cleanly
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, ControlRequestHandler)
+        print(f'Control socket: {socket_path}')
+    else:
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', CONTROL_PORT), ControlRequestHandler)
+        print(f'Control socket: 127.0.0.1:{CONTROL_PORT}')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def stop_control_server(server):
+    """Stops the control socket and removes its file.
+
+    Args:
+        server (socketserver.BaseServer): Server returned by start_control_server
+    """
+    server.shutdown()
+    server.server_close()
+    socket_path = get_socket_path()
+    if socket_path is not None and os.path.exists(socket_path):
+        os.remove(socket_path)
+
+def send_command(command, timeout=CONTROL_TIMEOUT, **params):
+    """Sends a command to the running service through its control socket.
+
+    Args:
+        command (str): Command (see the module docstring)
+        timeout (float, optional): Seconds to wait for the response. Defaults to CONTROL_TIMEOUT.
+        **params: Parameters of the command, e.g. date='2024-01-01'
+
+    Returns:
+        dict: Response of the service, or None if the service is not running
+    """
+    socket_path = get_socket_path()
+    if socket_path is not None:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = socket_path
+    else:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = ('127.0.0.1', CONTROL_PORT)
+    client.settimeout(timeout)
+    try:
+        client.connect(address)
+    except OSError:
+        client.close()
+        return None
+
+    with client, client.makefile('rwb') as stream:
+        stream.write((json.dumps({'command': command, **params}) + '\n').encode())
+        stream.flush()
+        return json.loads(stream.readline())
+
+if __name__ == '__main__':
+    main()
@@ -4,29 +4,113 @@ COMP 593 - Final Project
 Description: 
   Downloads NASA's Astronomy Picture of the Day (APOD) from a specified date
   and sets it as the desktop background image.
+  Given several dates or a date range, downloads all of them into the image
+  cache at once (e.g. to warm the cache nightly) and sets the newest one as
+  the desktop background image.
 
 Usage:
-  python apod_desktop.py [apod_date]
+  python apod_desktop.py [apod_date ...] [--workers N] [--no-wallpaper]
+                         [--profile] [--metrics FILE] [--metrics-log FILE]
+                         [--cache-budget SIZE] [--eviction lru|lfu] [--screen-size WxH]
 
 Parameters:
-  apod_date = APOD date (format: YYYY-MM-DD)
+  apod_date = APOD date (format: YYYY-MM-DD), a comma-separated list of dates,
+              or a date range (format: YYYY-MM-DD..YYYY-MM-DD)
+  --workers = Max number of APOD images downloaded at once (default: 4)
+  --no-wallpaper = Only add the APOD images to the image cache
+  --profile = Write cProfile and tracemalloc reports (apod_profile*) to the current directory
+  --metrics = Write stage timings and counters to FILE in the Prometheus text format
+  --metrics-log = Append a JSON line per timed stage to FILE
+  --cache-budget = Max disk space used by cached images, e.g. 500M or 2G (default: 2G)
+  --eviction = Which images are deleted first when over budget: least recently (lru)
+               or least frequently (lfu) used (default: lru)
+  --screen-size = Size the wallpaper is scaled to, e.g. 2560x1440 (default: detected)
 """
 from datetime import date, timedelta
 import os
 import image_lib
+import http_lib
+import metadata_cache
+import cache_db
+import api_scheduler
+import metrics
+import single_flight
+import image_hash
+import image_features
+import image_analysis
 import inspect
 import sys
-import hashlib
 import sqlite3
 from apod_api import get_apod_image_url
 import apod_api
 import re
+import time
+import glob
+import contextlib
+import io
+import threading
 
 
 # Global variables
 image_cache_dir = None  # Full path of image cache directory
 image_cache_db = None   # Full path of image cache database
+image_blob_dir = None   # Full path of directory holding image files by SHA-256
 cached_apod_info = None  # Cached APOD info to avoid duplicate API calls
+cache_budget = 2 * 1024 ** 3  # Max bytes of original images kept in the image cache
+eviction_policy = 'lru'  # Order in which images are evicted (see EVICTION_ORDER)
+
+MIN_APOD_DATE = date(1995, 6, 16)  # Date of the first APOD
+RECENT_DAYS = 7  # Number of days checked for a new APOD when no date is given
+
+MAX_WORKERS = 4  # Default number of APOD images downloaded at once
+DB_BATCH_SIZE = 100  # Number of APOD records written to the image cache DB per transaction
+EVICTION_BATCH_SIZE = 32  # Number of eviction candidates read from the image cache DB at a time
+THUMBNAIL_SIZES = (64, 128, 256)  # Max width and height in pixels of each level of the thumbnail pyramid
+SEARCH_LIMIT = 50  # Default max number of APODs returned by a search
+SEARCH_TITLE_WEIGHT = 10.0  # How much more a match in the title counts than one in the explanation
+
+# ORDER BY clause of each eviction policy, matching the image_apod_lru/lfu indexes
+EVICTION_ORDER = {
+    'lru': 'last_access',
+    'lfu': 'hit_count, last_access'
+}
+
+# Columns of the image_apod table written when adding an APOD record
+APOD_DB_COLUMNS = ('title', 'explanation', 'file_path', 'sha256', 'apod_date',
+                   'url', 'etag', 'last_modified', 'content_length', 'phash', 'dhash',
+                   'width', 'height', 'aspect', 'luminance', 'histogram', 'duplicate_of')
+
+# SQL statement adding an APOD record, skipping images already in the DB
+# and updating the record of a file that has been replaced. Only the same
+# APOD (same date or URL) may replace a file's record, so the record of
+# another APOD with the same title is never overwritten.
+# The last parameter is the time of the last access, i.e. now, and adding
+# an image counts as its first use.
+ADD_APOD_QUERY = f"""
+    INSERT INTO image_apod ({', '.join(APOD_DB_COLUMNS)}, last_access, hit_count)
+    VALUES ({', '.join('?' * (len(APOD_DB_COLUMNS) + 1))}, 1)
+    ON CONFLICT (sha256) DO NOTHING
+    ON CONFLICT (file_path) DO UPDATE SET
+     last_access = excluded.last_access,
+     cached = 1,
+     title = excluded.title,
+     explanation = excluded.explanation,
+     sha256 = excluded.sha256,
+     apod_date = excluded.apod_date,
+     url = excluded.url,
+     etag = excluded.etag,
+     last_modified = excluded.last_modified,
+     content_length = excluded.content_length,
+     phash = excluded.phash,
+     dhash = excluded.dhash,
+     width = excluded.width,
+     height = excluded.height,
+     aspect = excluded.aspect,
+     luminance = excluded.luminance,
+     histogram = excluded.histogram,
+     duplicate_of = excluded.duplicate_of
+    WHERE image_apod.apod_date = excluded.apod_date OR image_apod.url = excluded.url
+"""
 
 def main():
     ## DO NOT CHANGE THIS FUNCTION ##
@@ -53,87 +137,68 @@ def main():
     else:
         print("Error: Could not retrieve APOD information from database")
 
-def get_cached_apod_info():
-    """Gets APOD information from the cache when API is unavailable.
+def get_most_recent_apod_date():
+    """Finds the most recent date that has an APOD image available.
+
+    The newest image in the image cache DB is used if it is today's. Otherwise
+    the APOD information for the last RECENT_DAYS days is fetched with a single
+    range call to the NASA API. If that finds no newer image (e.g. when offline
+    or rate limited), the newest cached image is used. The image cache must be
+    initialized first (see init_apod_cache).
     
     Returns:
-        dict: APOD info from cache, or None if no cache available
+        tuple: (date, apod_info) - Most recent date with an APOD image and its info (None
+        if the image is already cached), or (None, None) if none found
     """
-    # Use a hardcoded path to one of the cached images we know exists
-    cache_dir = "/Users/Abdullah/NASA-API/image_cache"
-    
-    # Check for known cached images
-    cached_images = [
-        {
-            'title': 'Astronomy Picture of the Day',
-            'explanation': 'Cached APOD image',
-            'file_path': f"{cache_dir}/Astronomy_Picture_of_the_Day.jpg"
-        },
-        {
-            'title': 'Comet A3 Through an Australian Sunrise',
-            'explanation': 'Cached APOD image',
-            'file_path': f"{cache_dir}/Comet_A3_Through_an_Australian_Sunrise.jpg"
-        },
-        {
-            'title': 'Comet Lemmon Brightens',
-            'explanation': 'Cached APOD image',
-            'file_path': f"{cache_dir}/Comet_Lemmon_Brightens.jpg"
-        }
-    ]
-    
-    # Return the first cached image that exists
-    for cached_image in cached_images:
-        if os.path.exists(cached_image['file_path']):
-            print(f"Using cached APOD: {cached_image['title']}")
-            return cached_image
-    
-    return None
+    today = date.today()
+    newest_cached_date = get_newest_cached_apod_date()
+    if newest_cached_date is not None and newest_cached_date >= today:
+        print(f"Found cached APOD image for {newest_cached_date}")
+        return newest_cached_date, None
+
+    # Only ask for the days after the newest cached image
+    start_date = max(today - timedelta(days=RECENT_DAYS - 1), MIN_APOD_DATE)
+    if newest_cached_date is not None:
+        start_date = max(start_date, newest_cached_date + timedelta(days=1))
+
+    print(f"Checking {start_date} to {today}...")
+    newest_info = None
+    for apod_info in apod_api.get_apod_info_range(start_date, today, chunk_days=RECENT_DAYS,
+                                                  priority=api_scheduler.PRIORITY_INTERACTIVE):
+        if apod_info.get('media_type') == 'image':
+            newest_info = apod_info
+        else:
+            print(f"APOD for {apod_info['date']} is a video, skipping...")
+
+    if newest_info is not None:
+        print(f"Found APOD image for {newest_info['date']}")
+        return date.fromisoformat(newest_info['date']), newest_info
+
+    if newest_cached_date is not None:
+        print(f"Using newest cached APOD image from {newest_cached_date}")
+        return newest_cached_date, None
+
+    return None, None
+
+def get_newest_cached_apod_date():
+    """Gets the date of the newest APOD image in the image cache whose file still exists.
+
+    Uses the apod_date index, so only the newest few records are read.
+    Records of evicted images are skipped.
 
-def get_most_recent_apod_date():
-    """Finds the most recent date that has APOD data available.
-    
     Returns:
-        tuple: (date, apod_info) - Most recent date with APOD data and its info, or (None, None) if none found
+        date: Date of the newest cached APOD image, or None if there is none
     """
-    # Known good dates with images (fallback for rate limiting)
-    known_good_dates = [
-        date(2024, 9, 25),  # Comet A3 Through an Australian Sunrise
-        date(2024, 9, 20),  # Another known good date
-        date(2024, 9, 15),  # Another known good date
-    ]
-    
-    # Try today and recent dates first (limited attempts to avoid rate limiting)
-    recent_dates_to_try = 3  # Only try 3 recent dates to avoid rate limit
-    
-    for days_back in range(0, recent_dates_to_try):
-        test_date = date.today() - timedelta(days=days_back)
-        
-        # Don't go before APOD started
-        if test_date < date(1995, 6, 16):
-            break
-            
-        # Test if this date has APOD data
-        print(f"Checking {test_date}...")
-        apod_info = apod_api.get_apod_info(test_date)
-        
-        if apod_info is not None and apod_info.get('media_type') == 'image':
-            print(f"Found APOD image for {test_date}")
-            return test_date, apod_info
-        elif apod_info is not None and apod_info.get('media_type') == 'video':
-            print(f"APOD for {test_date} is a video, continuing search...")
-            continue
-    
-    # If recent dates don't work, fall back to known good dates
-    print("Recent dates failed, trying known good dates...")
-    for test_date in known_good_dates:
-        print(f"Trying known good date: {test_date}...")
-        apod_info = apod_api.get_apod_info(test_date)
-        
-        if apod_info is not None and apod_info.get('media_type') == 'image':
-            print(f"Using fallback APOD image for {test_date}")
-            return test_date, apod_info
-    
-    return None, None
+    query_result = cache_db.query_all("""
+      SELECT apod_date, file_path FROM image_apod
+      WHERE apod_date IS NOT NULL AND cached
+      ORDER BY apod_date DESC
+      LIMIT 10
+    """)
+    for apod_date, file_path in query_result:
+        if os.path.exists(file_path):
+            return date.fromisoformat(apod_date)
+    return None
 
 def get_apod_date():
     """Gets the APOD date
@@ -141,43 +206,50 @@ def get_apod_date():
     The APOD date is taken from the first command line parameter.
     Validates that the command line parameter specifies a valid APOD date.
     Prints an error message and exits script if the date is invalid.
-    Uses today's date if no date is provided on the command line.
+    Uses the most recent available APOD image if no date is provided on the command line.
 
     Returns:
         date: APOD date
     """
     
     
-    min_date = date(1995,6,16)
     # checks if there are more than one command-line arguments
     if len(sys.argv) > 1:
-         # tries to covert the agrs into a date 
-        try:
-            apod_date = date.fromisoformat(sys.argv[1])
-        # exception ERROR if  the format is incorrect 
-        except ValueError:
-            print(f"Error: Invalid date format: {sys.argv[1]}. PLEASE use this format (YYYY-MM-DD).")
-            sys.exit(1)
+        return parse_apod_date(sys.argv[1])
     # if no date provided just uses the most recent available APOD date 
     else:
         global cached_apod_info  # Move global declaration to the top
         print("No date specified. Finding most recent APOD image...")
+        # The newest image is looked up in the image cache DB, which main() only opens afterwards
+        init_apod_cache(get_script_dir())
         apod_date, cached_info = get_most_recent_apod_date()
         if apod_date is None:
-            print("API rate limited. Using cached APOD instead...")
-            # Use cached data when API is unavailable
-            cached_info = get_cached_apod_info()
-            if cached_info is not None:
-                # Store the cached info globally and return a dummy date
-                cached_apod_info = cached_info
-                # Return today's date as a placeholder - the cached info will be used
-                return date.today()
-            else:
-                print("Error: No cached APOD available and API is rate limited.")
-                sys.exit(1)
+            print("Error: No cached APOD available and the NASA API is unavailable.")
+            sys.exit(1)
         # Store the cached info globally to avoid duplicate API calls
         cached_apod_info = cached_info
         return apod_date
+
+def parse_apod_date(date_text):
+    """Converts a date given on the command line to an APOD date.
+
+    Prints an error message and exits script if the date is invalid, i.e. not
+    formatted as YYYY-MM-DD, before the first APOD, or in the future.
+
+    Args:
+        date_text (str): Date formatted as YYYY-MM-DD
+
+    Returns:
+        date: APOD date
+    """
+    min_date = MIN_APOD_DATE
+     # tries to covert the agrs into a date 
+    try:
+        apod_date = date.fromisoformat(date_text)
+    # exception ERROR if  the format is incorrect 
+    except ValueError:
+        print(f"Error: Invalid date format: {date_text}. PLEASE use this format (YYYY-MM-DD).")
+        sys.exit(1)
     
     # if the date past 1995
     if apod_date < min_date:
@@ -191,6 +263,32 @@ def get_apod_date():
         
     return apod_date
 
+def get_apod_dates():
+    """Gets every APOD date given on the command line.
+
+    Each command line parameter is a date (YYYY-MM-DD), a comma-separated list
+    of dates, or an inclusive date range (YYYY-MM-DD..YYYY-MM-DD). Every date is
+    validated as in get_apod_date. Prints an error message and exits script if
+    a date or range is invalid.
+
+    Returns:
+        list[date]: APOD dates, oldest first, without duplicates
+    """
+    apod_dates = set()
+    for arg in sys.argv[1:]:
+        for item in arg.split(','):
+            if '..' in item:
+                start_text, end_text = item.split('..', 1)
+                start_date = parse_apod_date(start_text)
+                end_date = parse_apod_date(end_text)
+                if start_date > end_date:
+                    print(f"Error: Invalid date range: {item}. The first date must not be after the last.")
+                    sys.exit(1)
+                apod_dates.update(start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1))
+            elif item:
+                apod_dates.add(parse_apod_date(item))
+    return sorted(apod_dates)
+
 def get_script_dir():
     """Determines the path of the directory in which this script resides
 
@@ -210,12 +308,18 @@ def init_apod_cache(parent_dir):
     The image cache directory is a subdirectory of the specified parent directory.
     The image cache database is a sqlite database located in the image cache directory.
 
+    Does nothing if the image cache in the parent directory is already initialized.
+
     Args:
         parent_dir (str): Full path of parent directory    
     """
     #  will store the paths to the image cache directory and database
     global image_cache_dir
     global image_cache_db
+    global image_blob_dir
+    # get_apod_date opens the image cache before main() initializes it
+    if cache_db.connection is not None and cache_db.db_path == os.path.join(parent_dir, 'image_cache', 'image_cache.db'):
+        return
    # creates the path for the image cache directory joining the parent dircetory with the subdirectory  
     image_cache_dir = os.path.join(parent_dir, 'image_cache')
    #   checks if the image_cache_dir does not exist. If it doesn't, 
@@ -231,36 +335,25 @@ def init_apod_cache(parent_dir):
         print('Image cache directory Already exists.')
      # creates the path for the image cache database  by 
      # joining the image_cache_dir with the database file 
+    # Image files are stored once, by content, under the blob directory
+    image_blob_dir = os.path.join(image_cache_dir, 'blobs')
+    os.makedirs(os.path.join(image_blob_dir, 'incoming'), exist_ok=True)
+
     image_cache_db = os.path.join(image_cache_dir, 'image_cache.db')
     # checks if the file does not already exist
-    if not os.path.exists(image_cache_db) :
-        # If the database file does not exist, creates a SQLite database by creating 
-        # a new file named 'apod_cache.db' in the image Dir .
-        con = sqlite3.connect(image_cache_db)
-        # creats the new file named 'named 'apod_cache.db 
-        cur = con.cursor()
-       # create a new table named 'apod' in the database. 
-        query = """
-            CREATE TABLE IF NOT EXISTS image_apod
-            (
-               id    INTEGER PRIMARY KEY,
-               title TEXT NOT NULL,
-               explanation TEXT NOT NULL,
-               file_path TEXT NOT NULL,
-               sha256 TEXT NOT NULL 
-            );
-        """ 
-        #  executes an SQL command for the database above
-        cur.execute(query)
-        # saving the changes made to the database
-        con.commit()
-        # closes the connection to the SQLite database
-        con.close()
+    db_exists = os.path.exists(image_cache_db)
+
+    # Opens the shared connection to the image cache DB, creating its tables
+    # or migrating an older DB to the current schema in place
+    cache_db.open_db(image_cache_db)
+    if not db_exists:
         print(f'Image cache DB Dir: {image_cache_db}')
         print('Image cache DB created.')
     else:
-        
         print('Image cache DB Already exists')
+
+    # Keep the APOD information cache in the image cache DB too
+    metadata_cache.init_metadata_cache()
         
 def add_apod_to_cache(apod_date):
     """Adds the APOD image from a specified date to the image cache.
@@ -280,27 +373,38 @@ def add_apod_to_cache(apod_date):
     
     # prints APOD date
     print("APOD date:", apod_date.isoformat())
-    
-    # Use cached APOD info if available, otherwise get from API
+
+    # Use cached APOD info if available
     global cached_apod_info
-    if cached_apod_info is not None:
+    apod_info = cached_apod_info
+    cached_apod_info = None  # Clear the cache after use
+
+    # Concurrent requests for the same date share one fetch and one DB write
+    return single_flight.call(('apod', apod_date.isoformat()), fetch_apod_into_cache, apod_date, apod_info)
+
+def fetch_apod_into_cache(apod_date, apod_info=None):
+    """Adds the APOD image from a specified date to the image cache, unless it
+    is already there. Called by add_apod_to_cache.
+
+    Args:
+        apod_date (date): Date of the APOD image
+        apod_info (dict, optional): APOD info already fetched from the NASA API. Defaults to None.
+
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if successful or if the APOD
+        already exists in the cache. Zero, if unsuccessful.
+    """
+    # If the image for this date is already cached, no API call is needed
+    apod_id = get_apod_id_from_db_by_date(apod_date)
+    if apod_id != 0 and os.path.exists(get_apod_info(apod_id)['file_path']):
+        print('APOD image is already in cache')
+        metrics.increment('image_cache_hits')
+        record_apod_access([apod_id])
+        make_wallpaper_variants([apod_id])
+        return apod_id
+    
+    if apod_info is not None:
         print("Using cached APOD information...")
-        apod_info = cached_apod_info
-        cached_apod_info = None  # Clear the cache after use
-        
-        # If this is cached info from database, return existing ID
-        if 'file_path' in apod_info:
-            # This is already cached, just find its ID
-            con = sqlite3.connect(image_cache_db)
-            cur = con.cursor()
-            query = "SELECT id FROM image_apod WHERE file_path = ?"
-            cur.execute(query, (apod_info['file_path'],))
-            result = cur.fetchone()
-            con.close()
-            if result:
-                print("APOD already in cache")
-                return result[0]
-        
     else:
         # gets the APOD date from APOD api
         apod_info = apod_api.get_apod_info(apod_date)
@@ -310,6 +414,261 @@ def add_apod_to_cache(apod_date):
         print("Error: Failed to get APOD information from NASA API")
         return 0
     
+    apod_id = add_apod_info_to_cache(apod_info)
+    if apod_id != 0:
+        make_wallpaper_variants([apod_id])
+    return apod_id
+
+def add_apod_range_to_cache(start_date, end_date, max_workers=MAX_WORKERS, progress=None):
+    """Adds the APOD images for every date between two dates (inclusive) to the image cache.
+
+    The APOD information for the whole range is fetched with bulk range calls
+    to the NASA API, so one metadata request covers many dates. The images are
+    downloaded concurrently while the metadata for later dates is still coming in.
+    Dates whose image is already cached are skipped, as in fetch_apod_into_cache,
+    so re-running a cached range sends no requests.
+
+    Args:
+        start_date (date): Date of the first APOD image
+        end_date (date): Date of the last APOD image
+        max_workers (int, optional): Max number of concurrent downloads. Defaults to MAX_WORKERS.
+        progress (function, optional): Called each time a date has been processed. Defaults to None.
+
+    Returns:
+        list[int]: Record IDs of the APODs in the image cache DB that were added
+        successfully or already existed in the cache
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f"APOD date range: {start_date.isoformat()} to {end_date.isoformat()}")
+
+    cached_ids = get_cached_apod_ids_by_date(start_date, end_date)
+    apod_ids = record_cached_apod_hits(cached_ids, progress)
+
+    # Only the span between the first and last date not yet cached is asked for
+    missing_dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)
+                     if (start_date + timedelta(days=i)).isoformat() not in cached_ids]
+    if missing_dates:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_apod_image, apod_info)
+                       for apod_info in apod_api.get_apod_info_range(missing_dates[0], missing_dates[-1])
+                       if apod_info['date'] not in cached_ids]
+            apod_ids.extend(save_apods_to_cache(futures, progress))
+        # Dates the API returned nothing for (APOD has gaps) are done too
+        if progress is not None:
+            for _ in range(len(missing_dates) - len(futures)):
+                progress()
+    make_wallpaper_variants(apod_ids)
+
+    print(f"Cached {len(apod_ids)} APOD images")
+    conn_stats = http_lib.get_connection_stats()
+    print(f"HTTP connections: {conn_stats['new_connections']} opened, {conn_stats['reused_connections']} reused")
+    return apod_ids
+
+def get_cached_apod_ids_by_date(start_date, end_date):
+    """Gets the APODs between two dates (inclusive) whose image is in the image cache.
+
+    Args:
+        start_date (date): First APOD date
+        end_date (date): Last APOD date
+
+    Returns:
+        dict: APOD date formatted as YYYY-MM-DD -> record ID of its APOD in the image cache DB
+    """
+    query_result = cache_db.query_all("""
+      SELECT apod_date, id, file_path FROM image_apod
+      WHERE apod_date BETWEEN ? AND ? AND cached
+    """, (start_date.isoformat(), end_date.isoformat()))
+    return {apod_date: apod_id for apod_date, apod_id, file_path in query_result if os.path.exists(file_path)}
+
+def get_cached_apod_ids_for_dates(apod_dates):
+    """Gets the APODs from a list of dates whose image is in the image cache.
+
+    Args:
+        apod_dates (list[date]): APOD dates
+
+    Returns:
+        dict: APOD date formatted as YYYY-MM-DD -> record ID of its APOD in the image cache DB
+    """
+    date_texts = [apod_date.isoformat() for apod_date in apod_dates]
+    cached_ids = {}
+    for i in range(0, len(date_texts), DB_BATCH_SIZE):
+        batch_dates = date_texts[i:i + DB_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch_dates))
+        query_result = cache_db.query_all(f"""
+          SELECT apod_date, id, file_path FROM image_apod
+          WHERE apod_date IN ({placeholders}) AND cached
+        """, batch_dates)
+        cached_ids.update((apod_date, apod_id) for apod_date, apod_id, file_path in query_result
+                          if os.path.exists(file_path))
+    return cached_ids
+
+def record_cached_apod_hits(cached_ids, progress=None):
+    """Counts the APODs already in the image cache as cache hits, so their dates
+    need no requests at all.
+
+    Args:
+        cached_ids (dict): APOD date -> record ID of each cached APOD (see get_cached_apod_ids_by_date)
+        progress (function, optional): Called once for each date. Defaults to None.
+
+    Returns:
+        list[int]: Record IDs of the cached APODs
+    """
+    if cached_ids:
+        print(f"{len(cached_ids)} APOD images already in cache")
+        metrics.increment('image_cache_hits', len(cached_ids))
+        record_apod_access(cached_ids.values())
+        if progress is not None:
+            for _ in cached_ids:
+                progress()
+    return list(cached_ids.values())
+
+def add_apod_dates_to_cache(apod_dates, max_workers=MAX_WORKERS, progress=None):
+    """Adds the APOD images from a list of dates to the image cache.
+
+    The APOD information requests, image downloads and hashing for different
+    dates run concurrently in a pool of at most max_workers threads. The image
+    cache DB is only written from the calling thread. Dates whose image is
+    already cached are skipped, as in add_apod_range_to_cache.
+
+    Args:
+        apod_dates (list[date]): Dates of the APOD images
+        max_workers (int, optional): Max number of dates processed at once. Defaults to MAX_WORKERS.
+        progress (function, optional): Called each time a date has been processed. Defaults to None.
+
+    Returns:
+        list[int]: Record IDs of the APODs in the image cache DB that were added
+        successfully or already existed in the cache
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cached_ids = get_cached_apod_ids_for_dates(apod_dates)
+    apod_ids = record_cached_apod_hits(cached_ids, progress)
+
+    missing_dates = [apod_date for apod_date in apod_dates if apod_date.isoformat() not in cached_ids]
+    if missing_dates:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch_apod_image, apod_date) for apod_date in missing_dates]
+            apod_ids.extend(save_apods_to_cache(futures, progress))
+    make_wallpaper_variants(apod_ids)
+
+    print(f"Cached {len(apod_ids)} of {len(apod_dates)} APOD images")
+    return apod_ids
+
+def fetch_apod_image(apod_date):
+    """Gets the APOD information for a specified date from the NASA API and
+    downloads its image. Safe to call from a worker thread.
+
+    Args:
+        apod_date (date): Date of the APOD image
+
+    Returns:
+        dict: Downloaded APOD image (see download_apod_image), None if unsuccessful
+    """
+    apod_info = apod_api.get_apod_info(apod_date, priority=api_scheduler.PRIORITY_BACKGROUND)
+    if apod_info is None:
+        print(f"Error: Failed to get {apod_date} APOD information from NASA API")
+        return None
+    return download_apod_image(apod_info)
+
+def save_apods_to_cache(futures, progress=None):
+    """Saves downloaded APOD images to the image cache as their downloads complete.
+
+    This is the single writer of the image cache DB for concurrent downloads.
+    New records are written in batches of DB_BATCH_SIZE per transaction.
+
+    Args:
+        futures (list[Future]): Futures of download_apod_image results
+        progress (function, optional): Called each time a future completes. Defaults to None.
+
+    Returns:
+        list[int]: Record IDs of the APODs in the image cache DB that were saved
+        successfully or already existed in the cache
+    """
+    from concurrent.futures import as_completed
+
+    apod_ids = []
+    hit_ids = []
+    new_apods = []
+    for future in as_completed(futures):
+        apod_image = future.result()
+        if progress is not None:
+            progress()
+        if apod_image is None:
+            continue
+
+        # Image was not downloaded because the cached copy is still current
+        if 'apod_id' in apod_image:
+            hit_ids.append(apod_image['apod_id'])
+            continue
+
+        # Image is already in the DB (e.g. under another date), so it is only
+        # linked again if it had been evicted
+        apod_id = get_apod_id_from_db(apod_image['sha256'])
+        if apod_id != 0:
+            if restore_apod_image(apod_id, apod_image['blob_path']):
+                hit_ids.append(apod_id)
+            continue
+
+        # A re-encoded or resized copy of a cached image is not stored again,
+        # but its APOD still gets its own record sharing the cached image file.
+        # Copies within one batch are only found by a scan (see image_hash).
+        apod_id = get_near_duplicate_id_from_db(apod_image)
+        if apod_id != 0:
+            linked = link_duplicate_apod_image(apod_id, apod_image)
+        else:
+            linked = link_apod_image(apod_image)
+        if not linked:
+            continue
+        new_apods.append(apod_image)
+        if len(new_apods) >= DB_BATCH_SIZE:
+            apod_ids.extend(add_linked_apods_to_db(new_apods))
+            new_apods = []
+
+    apod_ids.extend(add_linked_apods_to_db(new_apods))
+    record_apod_access(hit_ids)
+    apod_ids.extend(hit_ids)
+    return [apod_id for apod_id in apod_ids if apod_id != 0]
+
+def add_apod_info_to_cache(apod_info):
+    """Adds the APOD image described by a dictionary of APOD info to the image cache.
+
+    The image file is downloaded and, if the APOD is not already in the DB, saved
+    to the image cache and the APOD information is added to the image cache DB.
+
+    Args:
+        apod_info (dict): Dictionary of APOD info from API
+
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if successful or if the APOD
+        already exists in the cache. Zero, if unsuccessful.
+    """
+    apod_image = download_apod_image(apod_info)
+    if apod_image is None:
+        return 0
+    return save_apod_to_cache(apod_image)
+
+def download_apod_image(apod_info):
+    """Downloads and hashes the APOD image described by a dictionary of APOD info.
+
+    The image is streamed into the blob directory and stored under its SHA-256
+    hash (see store_image_blob). If the image URL is already in the cache, a
+    conditional GET is sent instead and nothing is downloaded unless the image
+    changed on the server.
+    DOES NOT WRITE TO THE IMAGE CACHE DB, so it is safe to call from a worker thread.
+
+    Args:
+        apod_info (dict): Dictionary of APOD info from API
+
+    Returns:
+        dict: Downloaded APOD image with its 'title', 'explanation', 'apod_date', 'url',
+        'blob_path', 'file_path' (None if the image has no title path yet), 'sha256',
+        'etag', 'last_modified', 'content_length', perceptual 'phash' and 'dhash'
+        and the 'width', 'height', 'aspect', 'luminance' and 'histogram' features
+        (as stored in the image cache DB, None if not extracted), if successful.
+        Only the 'apod_id' of the cached APOD, if the image is already cached and
+        unchanged. None, if unsuccessful.
+    """
     # Extract the image explanation and title from the APOD information
     image_explantion = apod_info['explanation']
     image_title = apod_info['title']
@@ -320,89 +679,243 @@ def add_apod_to_cache(apod_date):
     # Check if this is a video - if so, we can't use it as desktop wallpaper
     if media_type == 'video':
         print("APOD for this date is a video, not an image. Cannot set as desktop wallpaper.")
-        return 0
+        return None
    
     # gets the APOD image url
     apod_image_url = get_apod_image_url(apod_info)
     print(f'Image url:{apod_image_url}')
     
-    # download the APOD image 
-    image_data = image_lib.download_image(apod_image_url)
-    
-     # Calculate the hash of the downloaded image
-    apod_hash = hashlib.sha256(image_data).hexdigest()
-    print(f'APOD SHA-256:{apod_hash}')
-    
-     # Determine the file path for the APOD image
-    APOD_path = determine_apod_file_path(image_title, apod_image_url)
-    
-    # Add the APOD information to the image cache database and get the APOD ID
-    apod_id = add_apod_to_db(image_title, image_explantion, APOD_path, apod_hash)
-   
+    # If this image URL is already cached, only ask the server whether it changed
+    cache_entry = get_apod_cache_entry_from_db(apod_image_url)
+    if cache_entry is not None and os.path.exists(cache_entry['file_path']):
+        if cache_entry['etag'] is None and cache_entry['last_modified'] is None:
+            print('APOD image URL is already in cache')
+            metrics.increment('image_cache_hits')
+            return {'apod_id': cache_entry['id']}
+        download, blob_path = download_image_blob(apod_image_url,
+                                                  etag=cache_entry['etag'],
+                                                  last_modified=cache_entry['last_modified'])
+        if download is None:
+            return None
+        if download['not_modified']:
+            metrics.increment('image_cache_hits')
+            return {'apod_id': cache_entry['id']}
+        # The image changed on the server, so its title path will point to the new image
+        APOD_path = cache_entry['file_path']
+    else:
+        metrics.increment('image_cache_misses')
+        # The title path is chosen by the DB writer, once the image is known to be new
+        APOD_path = None
+
+        # Stream the APOD image into the cache, hashing it on the way
+        download, blob_path = download_image_blob(apod_image_url)
+        if download is None:
+            return None
+    print(f"APOD SHA-256:{download['sha256']}")
+
+    # Perceptual hashes, for spotting re-encoded or resized copies of cached images, and
+    # features for choosing a wallpaper without decoding the image again, from one decode
+    analysis = image_analysis.analyze_image(blob_path)
+
+    return {
+        'title': image_title,
+        'explanation': image_explantion,
+        'apod_date': apod_info.get('date'),
+        'url': apod_image_url,
+        'blob_path': blob_path,
+        'file_path': APOD_path,
+        'sha256': download['sha256'],
+        'etag': download['etag'],
+        'last_modified': download['last_modified'],
+        'content_length': download['content_length'],
+        **analysis
+    }
+
+def save_apod_to_cache(apod_image):
+    """Adds the information of a downloaded APOD image to the image cache DB,
+    and links the image under its human-readable title path.
+
+    Args:
+        apod_image (dict): Downloaded APOD image (see download_apod_image)
+
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if successful or if the APOD
+        already exists in the cache. Zero, if unsuccessful.
+    """
+    # Image was not downloaded because the cached copy is still current
+    if 'apod_id' in apod_image:
+        print('APOD image is already in cache')
+        record_apod_access([apod_image['apod_id']])
+        return apod_image['apod_id']
+
+    apod_hash = apod_image['sha256']
+
     # Get the APOD ID from the cache using its  hash
     image = get_apod_id_from_db(apod_hash)
-    
-    # Save the APOD image file to the cache if it is not already present
-    save_image =image_lib.save_image_file(image_data, APOD_path)
-    
-    # If the APOD image is not already in the cache, add it and save the image to the cache
-    if image == 0:
-        print('APOD image is not already in cache.')
-        print('Adding image to cache')
-        print(f'APOD file path:{APOD_path}')
-        
-        return apod_id
-    
+
     # If the APOD image is already in the cache, return its ID
+    # (linking it again if it had been evicted)
     if not image == 0:
         print('APOD image is already in cache')
+        if not restore_apod_image(image, apod_image['blob_path']):
+            return 0
+        record_apod_access([image])
         return image
-    
-    # Return 0 if the APOD image could not be added to the cache
+
+    # If a re-encoded or resized copy of the image is already in the cache, the
+    # APOD shares that image file, but is still added with its own record
+    image = get_near_duplicate_id_from_db(apod_image)
+    if image != 0:
+        print('A near-duplicate of the APOD image is already in cache')
+        if not link_duplicate_apod_image(image, apod_image):
+            return 0
     else:
-        return 0
+        # If the APOD image is not already in the cache, link it and add it to the image cache database
+        print('APOD image is not already in cache.')
+        print('Adding image to cache')
+        if not link_apod_image(apod_image):
+            return 0
+    APOD_path = apod_image['file_path']
+    print(f'APOD file path:{APOD_path}')
+    apod_id = add_apod_to_db(apod_image['title'], apod_image['explanation'], APOD_path, apod_hash,
+                          apod_date=apod_image['apod_date'],
+                          url=apod_image['url'], etag=apod_image['etag'],
+                          last_modified=apod_image['last_modified'],
+                          content_length=apod_image['content_length'],
+                          phash=apod_image['phash'], dhash=apod_image['dhash'],
+                          duplicate_of=apod_image.get('duplicate_of'),
+                          **{column: apod_image[column] for column in image_features.FEATURE_COLUMNS})
+    if apod_id == 0:
+        discard_apod_image(apod_image)
+    return apod_id
     
-def add_apod_to_db(title, explanation, file_path, sha256):
+def add_apod_to_db(title, explanation, file_path, sha256, apod_date=None, url=None, etag=None, last_modified=None,
+                   content_length=None, phash=None, dhash=None, width=None, height=None, aspect=None,
+                   luminance=None, histogram=None, duplicate_of=None):
     """Adds specified APOD information to the image cache DB.
+
+    If the image is already in the DB, the existing record is kept. If a record
+    for the same file path already exists, it is updated instead, since the
+    file on disk has been replaced by the new image.
      
     Args:
         title (str): Title of the APOD image
         explanation (str): Explanation of the APOD image
         file_path (str): Full path of the APOD image file
         sha256 (str): SHA-256 hash value of APOD image
+        apod_date (str, optional): APOD date formatted as YYYY-MM-DD
+        url (str, optional): URL the APOD image was downloaded from
+        etag (str, optional): ETag header of the APOD image response
+        last_modified (str, optional): Last-Modified header of the APOD image response
+        content_length (int, optional): Size of the APOD image in bytes
+        phash (int, optional): Perceptual pHash of the APOD image, as stored in the DB (see image_hash.to_db_hash)
+        dhash (int, optional): Perceptual dHash of the APOD image, as stored in the DB
+        width (int, optional): Width of the APOD image in pixels
+        height (int, optional): Height of the APOD image in pixels
+        aspect (float, optional): Aspect ratio (width / height) of the APOD image
+        luminance (float, optional): Mean brightness of the APOD image, from 0 to 1
+        histogram (bytes, optional): Coarse color histogram of the APOD image (see image_features)
+        duplicate_of (int, optional): Record ID of the APOD whose image file this APOD shares
+        (see link_duplicate_apod_image)
 
     Returns:
-        int: The ID of the newly inserted APOD record, if successful.  Zero, if unsuccessful       
-    """
-    # Connect to the image cache DB
-    con = sqlite3.connect(image_cache_db)
-    cur = con.cursor()
-    #defines the SQL statement to insert the APOD image information into the database.
-    add_apod_query = """
-        INSERT INTO image_apod
-        (
-         title, 
-         explanation, 
-         file_path, 
-         sha256
-        )
-        VALUES (?, ?, ?, ?);
+        int: The ID of the newly inserted (or already existing) APOD record, if successful.  Zero, if unsuccessful       
     """
     #creates a tuple containing
     #the APOD image information that will be inserted into the database.
-    img = (title, explanation, file_path, sha256)
-    
-    # checks if the APOD image is already in the database by calling the get_apod_id_from_db function, 
-    id = get_apod_id_from_db(sha256)
-    if not id == 0 :
-        return id
-    
-    # executes the SQL statement to insert the APOD image information into the database 
-    cur.execute(add_apod_query,img)
-    
-    con.commit() 
-    con.close()
+    img = (title, explanation, file_path, sha256, apod_date, url, etag, last_modified, content_length,
+           phash, dhash, width, height, aspect, luminance, histogram, duplicate_of, time.time())
     
+    # Inserts the record and reads back its ID in one transaction, so there is
+    # no gap between checking for the image and adding it
+    try:
+        with cache_db.transaction() as cur:
+            cur.execute(ADD_APOD_QUERY + " RETURNING id", img)
+            query_result = cur.fetchone()
+            if query_result is None:
+                # The image is already in the DB under another record
+                query_result = cur.execute("SELECT id FROM image_apod WHERE sha256 = ?", (sha256,)).fetchone()
+    except sqlite3.IntegrityError as e:
+        print(f'Error: Could not add APOD to image cache DB: {e}')
+        return 0
+    if query_result is None:
+        # The file path belongs to the record of another APOD
+        print(f'Error: Could not add APOD to image cache DB: {file_path} is used by another APOD')
+        return 0
+
+    image_hash.add_to_index(query_result[0], image_hash.from_db_hash(phash), image_hash.from_db_hash(dhash))
+    # The image file of a near-duplicate is its original's, so that is kept too
+    evict_apod_images(protected_ids=[query_result[0], duplicate_of])
+    return query_result[0]
+
+def add_linked_apods_to_db(apod_images):
+    """Adds downloaded APOD images, already linked under their title paths, to the
+    image cache DB in one batch, and deletes the files of those that could not be added.
+
+    Args:
+        apod_images (list[dict]): Downloaded APOD images (see download_apod_image)
+
+    Returns:
+        list[int]: Record ID of each APOD, in the same order as apod_images.
+        Zero for an APOD that could not be added.
+    """
+    apod_ids = add_apods_to_db(apod_images)
+    for apod_image, apod_id in zip(apod_images, apod_ids):
+        if apod_id == 0:
+            discard_apod_image(apod_image)
+    return apod_ids
+
+def add_apods_to_db(apod_records):
+    """Adds many APOD records to the image cache DB in a single transaction.
+
+    Records whose image is already in the DB are skipped, and records for a
+    file path that already exists update that record, as in add_apod_to_db.
+    If a record breaks another unique index (e.g. a second record for its date),
+    the transaction is rolled back and the records are added one at a time with
+    add_apod_to_db, so only the records that break it are left out.
+
+    Args:
+        apod_records (iterable[dict]): APOD records, each with the 'title', 'explanation',
+        'file_path' and 'sha256' of the image and optionally its 'apod_date', 'url',
+        'etag', 'last_modified', 'content_length', 'phash', 'dhash', the image features
+        (see image_features.FEATURE_COLUMNS) and 'duplicate_of'
+
+    Returns:
+        list[int]: Record ID of each APOD, in the same order as apod_records.
+        Zero for a record that could not be added.
+    """
+    now = time.time()
+    rows = [tuple(record.get(column) for column in APOD_DB_COLUMNS) + (now,) for record in apod_records]
+    if not rows:
+        return []
+
+    hashes = [row[APOD_DB_COLUMNS.index('sha256')] for row in rows]
+    ids_by_hash = {}
+    try:
+        with cache_db.transaction() as cur:
+            cur.executemany(ADD_APOD_QUERY, rows)
+
+            # executemany() discards RETURNING rows, so the IDs are read back
+            # through the sha256 index inside the same transaction
+            for i in range(0, len(hashes), DB_BATCH_SIZE):
+                batch_hashes = hashes[i:i + DB_BATCH_SIZE]
+                placeholders = ', '.join('?' * len(batch_hashes))
+                cur.execute(f"SELECT sha256, id FROM image_apod WHERE sha256 IN ({placeholders})", batch_hashes)
+                ids_by_hash.update(cur.fetchall())
+    except sqlite3.IntegrityError as e:
+        print(f'Could not add {len(rows)} APODs to image cache DB at once ({e}), adding them one at a time')
+        return [add_apod_to_db(**dict(zip(APOD_DB_COLUMNS, row))) for row in rows]
+
+    phash_column = APOD_DB_COLUMNS.index('phash')
+    dhash_column = APOD_DB_COLUMNS.index('dhash')
+    for row, sha256 in zip(rows, hashes):
+        if sha256 in ids_by_hash:
+            image_hash.add_to_index(ids_by_hash[sha256], image_hash.from_db_hash(row[phash_column]),
+                                    image_hash.from_db_hash(row[dhash_column]))
+
+    # A batch larger than the budget evicts its own first images
+    evict_apod_images()
+    return [ids_by_hash.get(sha256, 0) for sha256 in hashes]
     
 def get_apod_id_from_db(image_sha256):
     """Gets the record ID of the APOD in the cache having a specified SHA-256 hash value
@@ -415,31 +928,654 @@ def get_apod_id_from_db(image_sha256):
     Returns:
         int: Record ID of the APOD in the image cache DB, if it exists. Zero, if it does not.
     """
-    # Connect to the image cache DB
-    con = sqlite3.connect(image_cache_db)
-    cur = con.cursor()
-    
-    # Query for the APOD record with the specified  hash value
-    img_query = f""" 
-     SELECT id FROM image_apod 
-     WHERE sha256 = ? 
-    """
-    # Execute the query and fetch the results
-    cur.execute(img_query, (image_sha256,))
-    img_query_resltus =  cur.fetchone()
+    # Query for the APOD record with the specified  hash value (uses the sha256 index)
+    img_query_resltus = cache_db.query_one("SELECT id FROM image_apod WHERE sha256 = ?", (image_sha256,))
     
     # Check if the query returned no results
     if  img_query_resltus == None :
         return 0
     
     # otherwise it will return the ID of the APOD record
-    if not  img_query_resltus == None: 
-      return img_query_resltus[0]
-    
-    # Commit the changes to the database and close the connection
-    con.commit()
-    con.close()
-    
+    return img_query_resltus[0]
+
+def get_apod_id_from_db_by_date(apod_date):
+    """Gets the record ID of the APOD in the cache for a specified date.
+
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if it exists. Zero, if it does not.
+    """
+    query_result = cache_db.query_one("SELECT id FROM image_apod WHERE apod_date = ?", (str(apod_date),))
+    if query_result is None:
+        return 0
+    return query_result[0]
+
+def get_near_duplicate_id_from_db(apod_image):
+    """Gets the record ID of a cached APOD whose image is a near-duplicate of a
+    downloaded image, e.g. a re-encoded or resized copy of it.
+
+    Only an image at least as large (in bytes) as the downloaded one counts,
+    so a better copy of an image is still cached. A download that replaces the
+    image of an existing record is never a duplicate, and APODs that share the
+    image file of another (see link_duplicate_apod_image) are never matched.
+
+    Args:
+        apod_image (dict): Downloaded APOD image (see download_apod_image)
+
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if there is one. Zero, if there is not.
+    """
+    if apod_image['phash'] is None or apod_image['file_path'] is not None:
+        return 0
+
+    phash = image_hash.from_db_hash(apod_image['phash'])
+    dhash = image_hash.from_db_hash(apod_image['dhash'])
+    for apod_id, distance in image_hash.find_near_duplicates(phash, dhash):
+        # The index can still hold the hashes of an image that was replaced since
+        query_result = cache_db.query_one("""
+          SELECT phash, dhash FROM image_apod
+          WHERE id = ? AND cached AND duplicate_of IS NULL AND content_length >= ?
+        """, (apod_id, apod_image['content_length'] or 0))
+        if query_result is None or query_result[0] is None:
+            continue
+        cached_hashes = (image_hash.from_db_hash(query_result[0]), image_hash.from_db_hash(query_result[1]))
+        if image_hash.is_near_duplicate((phash, dhash), cached_hashes):
+            print(f'APOD image is a near-duplicate of cached APOD {apod_id} ({distance} bits apart)')
+            return apod_id
+    return 0
+
+def link_duplicate_apod_image(apod_id, apod_image):
+    """Links the image file of a cached APOD under the title path of a downloaded
+    APOD image that is a near-duplicate of it, so both APODs share one image file.
+
+    The downloaded copy is deleted. The APOD is still added with its own record,
+    title and explanation, whose 'duplicate_of' is the cached APOD's record ID.
+
+    Args:
+        apod_id (int): Record ID of the cached APOD whose image is kept
+        apod_image (dict): Downloaded APOD image (see download_apod_image), whose
+        'blob_path', 'file_path' and 'duplicate_of' are set to the shared image
+
+    Returns:
+        bool: True, if successful. False, if unsuccessful
+    """
+    file_path = cache_db.query_one("SELECT file_path FROM image_apod WHERE id = ?", (apod_id,))[0]
+    discard_image_blob(apod_image['blob_path'])
+    apod_image['blob_path'] = file_path
+    apod_image['duplicate_of'] = apod_id
+    return link_apod_image(apod_image)
+
+def discard_apod_image(apod_image):
+    """Deletes the title path link and the blob of a downloaded APOD image that
+    could not be added to the image cache DB, unless a record refers to them.
+
+    Args:
+        apod_image (dict): Downloaded APOD image (see download_apod_image), linked
+        under its title path (see link_apod_image)
+    """
+    query_result = cache_db.query_one("SELECT id FROM image_apod WHERE file_path = ?", (apod_image['file_path'],))
+    if query_result is None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(apod_image['file_path'])
+    # The blob path of a near-duplicate is the image file it shares
+    if apod_image.get('duplicate_of') is None and get_apod_id_from_db(apod_image['sha256']) == 0:
+        discard_image_blob(apod_image['blob_path'])
+
+def discard_image_blob(blob_path):
+    """Deletes a downloaded image from the blob directory that no record refers to.
+
+    Args:
+        blob_path (str): Path of the image in the blob directory
+    """
+    # Another caller sharing the download may have deleted it already
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(blob_path)
+
+def download_image_blob(image_url, etag=None, last_modified=None):
+    """Downloads an image into the blob directory and stores it under its SHA-256 hash.
+
+    Args:
+        image_url (str): URL of image
+        etag (str, optional): ETag of the cached copy, for a conditional GET. Defaults to None.
+        last_modified (str, optional): Last-Modified of the cached copy, for a conditional GET. Defaults to None.
+
+    Returns:
+        tuple: (download, blob_path) - Download info from image_lib.download_image_to_file
+        (None if unsuccessful) and the path of the stored image (None unless it was downloaded)
+    """
+    # Concurrent downloads of the same URL share one request. Conditional and
+    # unconditional GETs get different answers, so they are not shared.
+    return single_flight.call(('image', image_url, etag, last_modified),
+                              fetch_image_blob, image_url, etag, last_modified)
+
+def fetch_image_blob(image_url, etag=None, last_modified=None):
+    """Downloads an image into the blob directory. Called by download_image_blob.
+
+    Args:
+        image_url (str): URL of image
+        etag (str, optional): ETag of the cached copy, for a conditional GET. Defaults to None.
+        last_modified (str, optional): Last-Modified of the cached copy, for a conditional GET. Defaults to None.
+
+    Returns:
+        tuple: (download, blob_path) - as download_image_blob
+    """
+    import hashlib
+
+    # The download path only depends on the URL, so an interrupted download
+    # leaves its partial file where the next attempt will resume it
+    file_extension = image_url.split('.')[-1]
+    url_hash = hashlib.sha256(image_url.encode()).hexdigest()
+    incoming_path = os.path.join(image_blob_dir, 'incoming', f'{url_hash}.{file_extension}')
+
+    download = image_lib.download_image_to_file(image_url, incoming_path, etag=etag, last_modified=last_modified)
+    if download is None or download['not_modified']:
+        return download, None
+
+    return download, store_image_blob(incoming_path, download['sha256'], file_extension)
+
+def store_image_blob(file_path, sha256, file_extension):
+    """Moves a downloaded image file to its content-addressed path in the blob
+    directory, 'blobs/<first 2 hash digits>/<hash>.<extension>'.
+
+    Each distinct image is written only once. If an image with the same hash
+    is already stored, the downloaded file is discarded.
+
+    Args:
+        file_path (str): Path of the downloaded image file
+        sha256 (str): SHA-256 hash value of the image
+        file_extension (str): File extension of the image
+
+    Returns:
+        str: Full path of the stored image
+    """
+    blob_path = get_blob_path(sha256, file_extension)
+    if os.path.exists(blob_path):
+        os.remove(file_path)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(file_path, blob_path)
+    return blob_path
+
+def get_blob_path(sha256, file_extension):
+    """Determines the path of an image in the blob directory.
+
+    Args:
+        sha256 (str): SHA-256 hash value of the image
+        file_extension (str): File extension of the image
+
+    Returns:
+        str: Full path of the image in the blob directory
+    """
+    return os.path.join(image_blob_dir, sha256[:2], f'{sha256}.{file_extension}')
+
+def link_apod_image(apod_image):
+    """Links a downloaded APOD image under its human-readable title path.
+
+    If the image has no title path yet, one is chosen with determine_apod_file_path.
+    When that path is already taken by a different image or by the record of
+    another APOD (i.e. another APOD has the same title, even if its image has
+    been evicted), the start of the image's hash is added to the file name.
+
+    Args:
+        apod_image (dict): Downloaded APOD image (see download_apod_image), whose
+        'file_path' is set to the chosen path
+
+    Returns:
+        bool: True, if successful. False, if unsuccessful
+    """
+    if apod_image['file_path'] is None:
+        APOD_path = determine_apod_file_path(apod_image['title'], apod_image['url'])
+        if is_file_path_taken(APOD_path, apod_image) or \
+                (os.path.exists(APOD_path) and not os.path.samefile(APOD_path, apod_image['blob_path'])):
+            path_root, file_extension = os.path.splitext(APOD_path)
+            APOD_path = f"{path_root}_{apod_image['sha256'][:8]}{file_extension}"
+        apod_image['file_path'] = APOD_path
+
+    return image_lib.link_image_file(apod_image['blob_path'], apod_image['file_path'])
+
+def is_file_path_taken(file_path, apod_image):
+    """Checks whether a file path is recorded in the image cache DB for another
+    APOD than a downloaded image's, whether or not its image is still cached.
+
+    Args:
+        file_path (str): Full path of an image file in the image cache
+        apod_image (dict): Downloaded APOD image (see download_apod_image)
+
+    Returns:
+        bool: True, if the path belongs to the record of an APOD with another date and URL
+    """
+    query_result = cache_db.query_one("SELECT apod_date, url FROM image_apod WHERE file_path = ?", (file_path,))
+    if query_result is None:
+        return False
+    apod_date, url = query_result
+    is_same_apod = (apod_date is not None and apod_date == apod_image['apod_date']) or \
+                   (url is not None and url == apod_image['url'])
+    return not is_same_apod
+
+def search_apods(query, limit=SEARCH_LIMIT, cached_only=False):
+    """Searches the titles and explanations of the APODs in the image cache DB.
+
+    Every word of the query must match, as a word or the start of one, e.g.
+    'neb' matches 'nebula'. Matches are ranked by relevance (BM25), with
+    matches in the title counting more. The full-text search index is used,
+    so only the matching records are read.
+
+    Args:
+        query (str): Words to search for
+        limit (int, optional): Max number of APODs returned. Defaults to SEARCH_LIMIT.
+        cached_only (bool, optional): Only return APODs whose image is in the image cache. Defaults to False.
+
+    Returns:
+        list[dict]: The 'id', 'title', 'apod_date', 'file_path', 'sha256' and 'cached'
+        status of each matching APOD, with a 'snippet' of its explanation in which
+        the matching words are marked with [ and ], best match first
+    """
+    # Single letters (e.g. the s of "comet's") would match almost everything
+    words = [word for word in re.findall(r'\w+', query) if len(word) > 1]
+    if not words:
+        return []
+    columns = ('id', 'title', 'apod_date', 'file_path', 'sha256', 'cached', 'snippet')
+
+    if not cache_db.has_search_index():
+        # No FTS5 in this sqlite, so every record is scanned
+        conditions = ' AND '.join(["(title LIKE ? OR explanation LIKE ?)"] * len(words))
+        params = [f'%{word}%' for word in words for _ in range(2)]
+        query_result = cache_db.query_all(f"""
+          SELECT id, title, apod_date, file_path, sha256, cached, substr(explanation, 1, 120) FROM image_apod
+          WHERE {conditions} {'AND cached' if cached_only else ''}
+          ORDER BY apod_date DESC
+          LIMIT ?
+        """, params + [limit])
+        return [dict(zip(columns, row)) for row in query_result]
+
+    # Each word is quoted, so characters of the FTS5 query syntax are taken literally
+    match_query = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+    with metrics.span('search'):
+        query_result = cache_db.query_all(f"""
+          SELECT a.id, a.title, a.apod_date, a.file_path, a.sha256, a.cached,
+                 snippet(image_apod_fts, 1, '[', ']', '...', 16)
+          FROM image_apod_fts
+          JOIN image_apod a ON a.id = image_apod_fts.rowid
+          WHERE image_apod_fts MATCH ? {'AND a.cached' if cached_only else ''}
+          ORDER BY bm25(image_apod_fts, ?, 1.0)
+          LIMIT ?
+        """, (match_query, SEARCH_TITLE_WEIGHT, limit))
+    return [dict(zip(columns, row)) for row in query_result]
+
+def get_wallpaper_variant_path(sha256, size):
+    """Determines the path of the screen-size variant of an image, which is
+    kept next to the image in the blob directory, 'blobs/<first 2 hash digits>/<hash>_<width>x<height>.jpg'.
+
+    Args:
+        sha256 (str): SHA-256 hash value of the image
+        size (tuple[int, int]): Screen size in pixels (width, height)
+
+    Returns:
+        str: Full path of the variant
+    """
+    return os.path.join(image_blob_dir, sha256[:2], f'{sha256}_{size[0]}x{size[1]}.jpg')
+
+def get_image_variant_paths(sha256):
+    """Gets the paths of all screen-size variants and thumbnails of an image that exist.
+
+    Args:
+        sha256 (str): SHA-256 hash value of the image
+
+    Returns:
+        list[str]: Full paths of the variants and thumbnails
+    """
+    return glob.glob(os.path.join(image_blob_dir, sha256[:2], f'{glob.escape(sha256)}_*.jpg'))
+
+def get_thumbnail_path(sha256, size):
+    """Determines the path of a thumbnail of an image, which is kept next to
+    the image in the blob directory, 'blobs/<first 2 hash digits>/<hash>_thumb<size>.jpg'.
+
+    Args:
+        sha256 (str): SHA-256 hash value of the image
+        size (int): Level of the thumbnail pyramid (see THUMBNAIL_SIZES)
+
+    Returns:
+        str: Full path of the thumbnail
+    """
+    return os.path.join(image_blob_dir, sha256[:2], f'{sha256}_thumb{size}.jpg')
+
+def get_thumbnail(file_path, sha256, size):
+    """Gets a thumbnail of an APOD image, rendering every level of the
+    thumbnail pyramid the first time one is asked for.
+
+    DOES NOT USE THE IMAGE CACHE DB, so it is safe to call from a worker thread.
+
+    Args:
+        file_path (str): Full path of the APOD image file
+        sha256 (str): SHA-256 hash value of the APOD image
+        size (int): Level of the thumbnail pyramid (see THUMBNAIL_SIZES)
+
+    Returns:
+        str: Full path of the thumbnail, or None if it could not be rendered
+    """
+    thumbnail_path = get_thumbnail_path(sha256, size)
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+
+    thumbnail_paths = {level: get_thumbnail_path(sha256, level) for level in THUMBNAIL_SIZES}
+    with metrics.span('render_thumbnails'):
+        if not image_lib.render_thumbnail_pyramid(file_path, thumbnail_paths):
+            return None
+    return thumbnail_path
+
+def get_gallery_size():
+    """Gets the number of APOD images in the image cache.
+
+    Returns:
+        int: Number of cached APOD images
+    """
+    return cache_db.query_one("SELECT COUNT(*) FROM image_apod WHERE cached")[0]
+
+def get_gallery_page(offset, limit):
+    """Gets a page of the APOD images in the image cache, newest first.
+
+    Args:
+        offset (int): Number of images skipped
+        limit (int): Max number of images returned
+
+    Returns:
+        list[dict]: The 'id', 'title', 'apod_date', 'file_path' and 'sha256' of each APOD
+    """
+    query_result = cache_db.query_all("""
+      SELECT id, title, apod_date, file_path, sha256 FROM image_apod
+      WHERE cached
+      ORDER BY apod_date DESC, id DESC
+      LIMIT ? OFFSET ?
+    """, (limit, offset))
+    return [dict(zip(('id', 'title', 'apod_date', 'file_path', 'sha256'), row)) for row in query_result]
+
+def make_wallpaper_variants(apod_ids, size=None, max_workers=None):
+    """Renders a copy of APOD images scaled to the screen size, so setting one
+    as the desktop background does not make the desktop scale the original.
+
+    Variants that already exist are reused. Several images are rendered at
+    once in a pool of worker processes. Each variant is registered with
+    image_lib, so set_desktop_background_image uses it in place of the original.
+
+    Args:
+        apod_ids (iterable[int]): Record IDs of the APODs in the image cache DB
+        size (tuple[int, int], optional): Screen size in pixels (width, height). Defaults to
+        the screen size from get_screen_size.
+        max_workers (int, optional): Max number of rendering processes. Defaults to one per core.
+
+    Returns:
+        dict: Record ID -> full path of the variant, for each APOD that has one
+    """
+    apod_ids = list(apod_ids)
+    if not apod_ids:
+        return {}
+    if size is not None:
+        variants, pending = find_wallpaper_variants(apod_ids, size)
+    else:
+        size = get_screen_size()
+        if size is None:
+            return {}
+        variants, pending = find_wallpaper_variants(apod_ids, size)
+        # The saved size may be out of date (e.g. after changing screens), so the
+        # screen is only detected again when something has to be rendered anyway
+        if pending and image_lib.screen_size is None:
+            detected_size = get_screen_size(detect=True)
+            if detected_size is not None and detected_size != size:
+                size = detected_size
+                variants, pending = find_wallpaper_variants(apod_ids, size)
+
+    # Pillow is only loaded when there is something to render
+    if pending and image_lib.load_pillow() is None:
+        pending = []
+
+    if pending:
+        print(f'Rendering {len(pending)} wallpaper variants at {size[0]}x{size[1]}...', end='')
+        file_paths = [file_path for _, file_path, _ in pending]
+        variant_paths = [variant_path for _, _, variant_path in pending]
+        with metrics.span('render_variants'):
+            if len(pending) == 1:
+                # A single image is not worth starting a process for
+                results = [image_lib.render_image_variant(file_paths[0], variant_paths[0], size)]
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    results = list(executor.map(image_lib.render_image_variant, file_paths, variant_paths,
+                                                [size] * len(pending)))
+        for (apod_id, file_path, variant_path), rendered in zip(pending, results):
+            if rendered:
+                variants[apod_id] = (file_path, variant_path)
+        print('success')
+
+    for file_path, variant_path in variants.values():
+        image_lib.add_wallpaper_variant(file_path, variant_path)
+    return {apod_id: variant_path for apod_id, (_, variant_path) in variants.items()}
+
+def find_wallpaper_variants(apod_ids, size):
+    """Finds which APOD images already have a wallpaper variant for a screen
+    size, and which still need one rendered.
+
+    Args:
+        apod_ids (list[int]): Record IDs of the APODs in the image cache DB
+        size (tuple[int, int]): Screen size in pixels (width, height)
+
+    Returns:
+        tuple: (variants, pending) - Record ID -> (image path, variant path) of each
+        image whose variant exists, and (record ID, image path, variant path) of each
+        image whose variant must be rendered
+    """
+    variants = {}
+    pending = []
+    for i in range(0, len(apod_ids), DB_BATCH_SIZE):
+        batch_ids = apod_ids[i:i + DB_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch_ids))
+        # An image whose stored size already fits the screen is used as it is,
+        # so it is not opened to find that out every time
+        query_result = cache_db.query_all(f"""
+          SELECT id, file_path, sha256 FROM image_apod
+          WHERE cached AND id IN ({placeholders}) AND (width IS NULL OR width > ? OR height > ?)
+        """, batch_ids + [size[0], size[1]])
+        for apod_id, file_path, sha256 in query_result:
+            variant_path = get_wallpaper_variant_path(sha256, size)
+            if os.path.exists(variant_path):
+                variants[apod_id] = (file_path, variant_path)
+            elif os.path.exists(file_path):
+                pending.append((apod_id, file_path, variant_path))
+    return variants, pending
+
+def get_screen_size(detect=False):
+    """Gets the screen size wallpaper variants are rendered for.
+
+    Detecting the screen is slow (system_profiler on macOS, a Tk window
+    elsewhere), so the size detected last is saved in the image cache DB and
+    used by later runs until detect is True. A size set with
+    image_lib.configure_screen_size, or already detected by this process, is
+    always used.
+
+    Args:
+        detect (bool, optional): Whether to detect the screen instead of using the saved size. Defaults to False.
+
+    Returns:
+        tuple[int, int]: Screen size in pixels (width, height), or None if it cannot be detected
+    """
+    if image_lib.screen_size is not None:
+        return image_lib.screen_size
+    if not detect:
+        saved_size = cache_db.get_setting('screen_size')
+        if saved_size is not None:
+            width, height = saved_size.split('x')
+            return int(width), int(height)
+
+    size = image_lib.get_screen_size()
+    if size is not None:
+        cache_db.set_setting('screen_size', f'{size[0]}x{size[1]}')
+    return size
+
+def restore_apod_image(apod_id, blob_path):
+    """Links a downloaded image back under the file path of its APOD record, if
+    the image had been evicted from the image cache.
+
+    An APOD that shared the image file of a near-duplicate (see
+    link_duplicate_apod_image) keeps the downloaded image as its own.
+
+    Args:
+        apod_id (int): Record ID of the APOD in the image cache DB
+        blob_path (str): Path of the downloaded image in the blob directory
+
+    Returns:
+        bool: True, if the image is in the image cache. False, if unsuccessful
+    """
+    file_path, cached = cache_db.query_one("SELECT file_path, cached FROM image_apod WHERE id = ?", (apod_id,))
+    if cached and os.path.exists(file_path):
+        return True
+
+    print('Restoring evicted APOD image')
+    if not image_lib.link_image_file(blob_path, file_path):
+        return False
+    cache_db.execute("UPDATE image_apod SET cached = 1, duplicate_of = NULL, content_length = ? WHERE id = ?",
+                     (os.path.getsize(blob_path), apod_id))
+    evict_apod_images(protected_ids=[apod_id])
+    return True
+
+def record_apod_access(apod_ids):
+    """Records a cache hit for APOD images, for the eviction policy.
+
+    A hit on an APOD that shares the image file of another (see
+    link_duplicate_apod_image) counts for that one too, since it is the one evicted.
+
+    Args:
+        apod_ids (iterable[int]): Record IDs of the APODs in the image cache DB
+    """
+    apod_ids = list(apod_ids)
+    if not apod_ids:
+        return
+    now = time.time()
+    with cache_db.transaction() as cur:
+        cur.executemany("""
+          UPDATE image_apod SET last_access = ?, hit_count = hit_count + 1
+          WHERE id = ? OR id = (SELECT duplicate_of FROM image_apod WHERE id = ?)
+        """, [(now, apod_id, apod_id) for apod_id in apod_ids])
+
+def configure_cache_budget(budget=None, policy=None):
+    """Sets the disk space cached images may use, and the order they are evicted in.
+
+    The budget covers the original images only, not their wallpaper variants
+    and thumbnails (see get_cache_size).
+
+    Args:
+        budget (int, optional): Max bytes of cached images. Defaults to None (unchanged).
+        policy (str, optional): 'lru' or 'lfu' (see EVICTION_ORDER). Defaults to None (unchanged).
+    """
+    global cache_budget
+    global eviction_policy
+
+    if budget is not None:
+        cache_budget = budget
+    if policy is not None:
+        if policy not in EVICTION_ORDER:
+            raise ValueError(f'Unknown eviction policy: {policy}')
+        eviction_policy = policy
+
+def get_cache_size():
+    """Gets the disk space used by the images in the image cache, from the running
+    total the image cache DB keeps as images are added, evicted and restored.
+
+    An image file shared by near-duplicate APODs (see link_duplicate_apod_image)
+    is counted once. Wallpaper variants and thumbnails are not counted; they are
+    small next to the original images and are deleted along with them.
+
+    Returns:
+        int: Total size in bytes of the cached images
+    """
+    return cache_db.query_one("SELECT bytes FROM cache_size")[0]
+
+def evict_apod_images(protected_ids=()):
+    """Deletes cached images, in the order of the eviction policy, until the
+    image cache is within its budget.
+
+    The records of evicted images are kept, so an image can be downloaded
+    again when it is next asked for. Only as many candidates as needed are
+    read from the image cache DB; the image cache directory is never scanned.
+    APODs sharing the image file of an evicted image (see
+    link_duplicate_apod_image) are evicted with it.
+
+    Args:
+        protected_ids (iterable[int], optional): Record IDs of APODs never evicted, e.g.
+        images that have just been added. Defaults to ().
+
+    Returns:
+        int: Number of images evicted
+    """
+    cache_size = get_cache_size()
+    if cache_size <= cache_budget:
+        return 0
+
+    protected_ids = set(protected_ids)
+    evicted_count = 0
+    while cache_size > cache_budget:
+        query_result = cache_db.query_all(f"""
+          SELECT id, file_path, sha256, url, content_length FROM image_apod
+          WHERE cached AND duplicate_of IS NULL
+          ORDER BY {EVICTION_ORDER[eviction_policy]}
+          LIMIT ?
+        """, (EVICTION_BATCH_SIZE + len(protected_ids),))
+        candidates = [row for row in query_result if row[0] not in protected_ids]
+        if not candidates:
+            break
+
+        evicted_ids = []
+        for apod_id, file_path, sha256, url, content_length in candidates:
+            print(f'Evicting APOD image {file_path}')
+            paths = [file_path] + get_image_variant_paths(sha256)
+            if url is not None:
+                paths.append(get_blob_path(sha256, url.split('.')[-1]))
+            # Otherwise the links of its near-duplicates would keep the image on disk
+            for duplicate_id, duplicate_path, duplicate_sha256 in cache_db.query_all(
+                    "SELECT id, file_path, sha256 FROM image_apod WHERE duplicate_of = ? AND cached", (apod_id,)):
+                paths += [duplicate_path] + get_image_variant_paths(duplicate_sha256)
+                evicted_ids.append(duplicate_id)
+            for path in paths:
+                if os.path.lexists(path):
+                    os.remove(path)
+            evicted_ids.append(apod_id)
+            cache_size -= content_length or 0
+            if cache_size <= cache_budget:
+                break
+
+        with cache_db.transaction() as cur:
+            cur.executemany("UPDATE image_apod SET cached = 0 WHERE id = ?", [(apod_id,) for apod_id in evicted_ids])
+        evicted_count += len(evicted_ids)
+
+    metrics.increment('images_evicted', evicted_count)
+    return evicted_count
+
+def get_apod_cache_entry_from_db(image_url):
+    """Gets the cache entry of the APOD image downloaded from a specified URL.
+
+    Args:
+        image_url (str): URL of APOD image
+
+    Returns:
+        dict: The 'id', 'file_path', 'sha256', 'etag' and 'last_modified' of the
+        cached APOD, if it exists. None, if it does not.
+    """
+    query_result = cache_db.query_one("""
+      SELECT id, file_path, sha256, etag, last_modified FROM image_apod
+      WHERE url = ?
+      ORDER BY id DESC
+    """, (image_url,))
+
+    if query_result is None:
+        return None
+    return {
+        'id': query_result[0],
+        'file_path': query_result[1],
+        'sha256': query_result[2],
+        'etag': query_result[3],
+        'last_modified': query_result[4]
+    }
+
 def determine_apod_file_path(image_title, image_url):
     """Determines the path at which a newly downloaded APOD image must be 
     saved in the image cache. 
@@ -489,23 +1625,14 @@ def get_apod_info(image_id):
     Returns:
         dict: Dictionary of APOD information
     """
-    con = sqlite3.connect(image_cache_db)
-    cur = con.cursor()
-    
     # Construct a SELECT query to retrieve the APOD information for the given image ID
     select_apod_query = """ 
       SELECT title, explanation, file_path FROM image_apod 
       WHERE id = ?
     """
     
-  # Execute the query with the given image ID as the parameter and retrieve the result
-    cur.execute(select_apod_query, (image_id,))
-    # retrieves a single row from the result set of a query that has been executed
-    query_result = cur.fetchone()
-    
-    # Commit the changes to the database and close the connection
-    con.commit()
-    con.close()
+    # Execute the query with the given image ID as the parameter and retrieve the result
+    query_result = cache_db.query_one(select_apod_query, (image_id,))
     
     # If the query returned a result, return the APOD information dictionary
     if query_result is not None:
@@ -523,5 +1650,235 @@ def get_apod_info(image_id):
     
 
 
+def get_cli_options():
+    """Removes the optional flags from the command line parameters, so that
+    get_apod_date() only sees the APOD date.
+
+    Flags:
+        --workers N          Max number of APOD images downloaded at once
+        --no-wallpaper       Only add the APOD images to the image cache
+        --profile            Write cProfile and tracemalloc reports of the run
+        --metrics FILE       Write stage timings and counters in the Prometheus text format
+        --metrics-log FILE   Append a JSON line for every timed stage as it ends
+        --cache-budget SIZE  Max disk space of cached images, in bytes or with a K/M/G suffix
+        --eviction POLICY    Evict the least recently (lru) or least frequently (lfu) used images first
+        --screen-size WxH    Scale the wallpaper to this size instead of the detected screen size
+
+    Prints an error message and exits script if a worker count, cache budget,
+    eviction policy or screen size is invalid.
+
+    Returns:
+        dict: 'workers' (int), 'no_wallpaper' and 'profile' (bool), 'metrics' and
+        'metrics_log' (file paths or None), 'cache_budget' (bytes or None),
+        'eviction' (policy or None) and 'screen_size' ((width, height) or None)
+    """
+    options = {'workers': MAX_WORKERS, 'no_wallpaper': False, 'profile': False, 'metrics': None, 'metrics_log': None,
+               'cache_budget': None, 'eviction': None, 'screen_size': None}
+    args = sys.argv[1:]
+    remaining_args = []
+    while args:
+        arg = args.pop(0)
+        if arg in ('--profile', '--no-wallpaper'):
+            options[arg[2:].replace('-', '_')] = True
+        elif arg in ('--workers', '--metrics', '--metrics-log', '--cache-budget', '--eviction', '--screen-size') and args:
+            options[arg[2:].replace('-', '_')] = args.pop(0)
+        else:
+            remaining_args.append(arg)
+    sys.argv[1:] = remaining_args
+
+    if not str(options['workers']).isdigit() or int(options['workers']) == 0:
+        print(f"Error: Invalid number of workers: {options['workers']}. PLEASE use a whole number above 0.")
+        sys.exit(1)
+    options['workers'] = int(options['workers'])
+    if options['cache_budget'] is not None:
+        options['cache_budget'] = parse_size(options['cache_budget'])
+        if options['cache_budget'] is None:
+            print("Error: Invalid cache budget. PLEASE use a size such as 500M or 2G.")
+            sys.exit(1)
+    if options['eviction'] is not None and options['eviction'] not in EVICTION_ORDER:
+        print(f"Error: Invalid eviction policy: {options['eviction']}. PLEASE use one of: {', '.join(EVICTION_ORDER)}.")
+        sys.exit(1)
+    if options['screen_size'] is not None:
+        match = re.fullmatch(r'(\d+)x(\d+)', options['screen_size'])
+        if match is None or int(match[1]) == 0 or int(match[2]) == 0:
+            print(f"Error: Invalid screen size: {options['screen_size']}. PLEASE use this format (WIDTHxHEIGHT).")
+            sys.exit(1)
+        options['screen_size'] = (int(match[1]), int(match[2]))
+    return options
+
+def parse_size(size):
+    """Converts a size given on the command line, e.g. '2G' or '500M', to bytes.
+
+    Args:
+        size (str): Size in bytes, optionally followed by K, M or G (powers of 1024)
+
+    Returns:
+        int: Size in bytes, or None if the size is invalid
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper().removesuffix('B')
+    multiplier = units.get(size[-1:], 1)
+    if size[-1:] in units:
+        size = size[:-1]
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        return None
+
+def is_batch_mode(options):
+    """Checks whether the command line asks for more than main() does, i.e. for
+    several dates, a date range or no wallpaper.
+
+    Args:
+        options (dict): Options from get_cli_options
+
+    Returns:
+        bool: True, if cache_apod_dates must be run instead of main()
+    """
+    args = sys.argv[1:]
+    return options['no_wallpaper'] or len(args) > 1 or any('..' in arg or ',' in arg for arg in args)
+
+def cache_apod_dates(apod_dates, max_workers=MAX_WORKERS, set_wallpaper=True):
+    """Adds the APOD images for many dates to the image cache, and sets the newest
+    one as the desktop background image.
+
+    Consecutive dates are fetched with bulk range calls to the NASA API, and
+    the images are downloaded in a pool of max_workers threads. When run in a
+    terminal, a progress bar replaces the per-image messages, and the error
+    messages among them are printed once the bar is done.
+
+    Args:
+        apod_dates (list[date]): APOD dates, oldest first
+        max_workers (int, optional): Max number of concurrent downloads. Defaults to MAX_WORKERS.
+        set_wallpaper (bool, optional): Whether to set the newest APOD image as the desktop
+        background image. Defaults to True.
+
+    Returns:
+        list[int]: Record IDs of the APODs in the image cache DB that were added
+        successfully or already existed in the cache
+    """
+    init_apod_cache(get_script_dir())
+
+    # Splits the dates into runs of consecutive dates
+    date_runs = []
+    for apod_date in apod_dates:
+        if date_runs and apod_date - date_runs[-1][-1] == timedelta(days=1):
+            date_runs[-1].append(apod_date)
+        else:
+            date_runs.append([apod_date])
+    single_dates = [date_run[0] for date_run in date_runs if len(date_run) == 1]
+
+    progress_bar = ProgressBar(len(apod_dates)) if sys.stderr.isatty() else None
+    progress = progress_bar.update if progress_bar is not None else None
+    start_time = time.perf_counter()
+    apod_ids = []
+    error_log = ErrorLog()
+    with contextlib.redirect_stdout(error_log) if progress_bar is not None else contextlib.nullcontext():
+        for date_run in date_runs:
+            if len(date_run) > 1:
+                apod_ids.extend(add_apod_range_to_cache(date_run[0], date_run[-1], max_workers, progress))
+        if single_dates:
+            apod_ids.extend(add_apod_dates_to_cache(single_dates, max_workers, progress))
+    if progress_bar is not None:
+        progress_bar.finish()
+        for line in error_log.lines:
+            print(line)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Cached {len(apod_ids)} of {len(apod_dates)} APOD images in {elapsed:.1f} s "
+          f"({len(apod_dates) / max(elapsed, 1e-9):.1f} items/sec)")
+
+    if set_wallpaper and apod_ids:
+        newest_apod = ('', 0)  # (apod_date, id) of the newest APOD
+        for i in range(0, len(apod_ids), DB_BATCH_SIZE):
+            batch_ids = apod_ids[i:i + DB_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch_ids))
+            query_result = cache_db.query_one(f"""
+              SELECT apod_date, id FROM image_apod
+              WHERE id IN ({placeholders}) AND apod_date IS NOT NULL
+              ORDER BY apod_date DESC
+            """, batch_ids)
+            if query_result is not None:
+                newest_apod = max(newest_apod, query_result)
+        if newest_apod[1] != 0:
+            image_lib.set_desktop_background_image(get_apod_info(newest_apod[1])['file_path'])
+    return apod_ids
+
+class ErrorLog(io.TextIOBase):
+    """Text stream that discards what is written to it, except the lines with an
+    error message, which are kept so they can be printed later."""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []         # Error lines written so far
+        self.partial_line = ''  # Text written since the last line break
+        self.lock = threading.Lock()  # Worker threads print too
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        """Keeps the complete lines of text that contain an error message."""
+        with self.lock:
+            lines = (self.partial_line + text).split('\n')
+            self.partial_line = lines.pop()
+            self.lines.extend(line for line in lines if 'Error' in line)
+        return len(text)
+
+class ProgressBar:
+    """Progress bar with the processing rate, drawn on one line of stderr."""
+
+    WIDTH = 30  # Characters in the bar
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.draw()
+
+    def update(self):
+        """Counts one more processed item and redraws the bar."""
+        self.done += 1
+        self.draw()
+
+    def draw(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        filled = self.WIDTH * min(self.done, self.total) // max(self.total, 1)
+        sys.stderr.write(f"\r[{'#' * filled}{'.' * (self.WIDTH - filled)}] "
+                         f"{self.done}/{self.total} {rate:.1f} items/sec")
+        sys.stderr.flush()
+
+    def finish(self):
+        """Ends the line of the bar."""
+        sys.stderr.write('\n')
+        sys.stderr.flush()
+
+def run_cli():
+    """Runs main(), or cache_apod_dates() for several dates, with the options
+    given on the command line."""
+    options = get_cli_options()
+    metrics.configure_metrics(options['metrics_log'])
+    configure_cache_budget(options['cache_budget'], options['eviction'])
+    if options['screen_size'] is not None:
+        image_lib.configure_screen_size(options['screen_size'])
+
+    run = main
+    if is_batch_mode(options):
+        apod_dates = get_apod_dates()
+        if not apod_dates:
+            # No date given, so the most recent APOD is cached
+            apod_dates = [get_apod_date()]
+        run = lambda: cache_apod_dates(apod_dates, options['workers'], set_wallpaper=not options['no_wallpaper'])
+    try:
+        if options['profile']:
+            metrics.run_profiled(run, os.path.join(os.getcwd(), 'apod_profile'))
+        else:
+            run()
+    finally:
+        if options['metrics'] is not None:
+            metrics.write_prometheus(options['metrics'])
+            print(f"Metrics written to {options['metrics']}")
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    run_cli()
\ No newline at end of file
@@ -1,17 +1,367 @@
+'''
+Gallery of the APOD images in the image cache.
+
+The list of images is virtualized: only the rows on screen (plus a few
+above and below) exist as canvas items, and only their records are read
+from the image cache DB, so the gallery opens and scrolls just as fast with
+thousands of cached images as with ten. Thumbnails come from a pyramid
+rendered once per image (see apod_desktop.get_thumbnail), are decoded on a
+background thread, and the most recently shown ones are kept as PhotoImages
+in an LRU. The search box above the list searches APOD titles and
+explanations as you type (see apod_desktop.search_apods).
+'''
 from tkinter import *
+from collections import OrderedDict
 import inspect
 import os
+import queue
+import sys
+import threading
+import apod_daemon
 import apod_desktop
+import image_lib
+
+try:
+    from PIL import Image, ImageTk
+except ImportError:
+    Image = None
+
+
+ROW_HEIGHT = 72               # Height in pixels of each row of the gallery
+ROW_THUMBNAIL_SIZE = 64       # Thumbnail pyramid level shown in the rows
+PREVIEW_THUMBNAIL_SIZE = 256  # Thumbnail pyramid level shown for the selected image
+OVERSCAN_ROWS = 4             # Rows materialized above and below the visible ones
+PHOTO_CACHE_SIZE = 256        # Max number of decoded thumbnails kept as PhotoImages
+POLL_INTERVAL_MS = 30         # How often decoded thumbnails are picked up by the Tk thread
+SEARCH_DELAY_MS = 250         # Pause in typing after which the search box is searched
+SEARCH_RESULTS_LIMIT = 500    # Max number of APODs listed for a search
+SERVICE_TIMEOUT = 15          # Seconds to wait for the APOD service to set the desktop background
+
+def main():
+    # Determine the path and parent directory of this script
+    script_path = os.path.abspath(inspect.getframeinfo(inspect.currentframe()).filename)
+    script_dir = os.path.dirname(script_path)
+
+    # Initialize the image cache
+    apod_desktop.init_apod_cache(script_dir)
+
+    root = Tk()
+    root.title('Astronomy Picture of the Day')
+    root.geometry('900x600')
+    Gallery(root).pack(fill=BOTH, expand=True)
+    root.mainloop()
+
+class ThumbnailLoader:
+    """Decodes thumbnails on a background thread and keeps an LRU of PhotoImages.
+
+    PhotoImages can only be made on the Tk thread, so the background thread
+    hands decoded images back through a queue that the Tk thread polls.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.requests = queue.LifoQueue()  # Most recently requested thumbnails are decoded first
+        self.results = queue.Queue()
+        self.photos = OrderedDict()        # (sha256, size) -> PhotoImage, least recently used first
+        self.callbacks = {}                # (sha256, size) -> function called with the PhotoImage
+        self.pending = set()               # Thumbnails requested but not yet decoded
+
+        threading.Thread(target=self.decode_thumbnails, daemon=True).start()
+        self.root.after(POLL_INTERVAL_MS, self.poll_results)
+
+    def get(self, apod, size, callback):
+        """Gets a thumbnail of an APOD image, or requests it if it is not decoded yet.
+
+        Args:
+            apod (dict): APOD with its 'file_path' and 'sha256'
+            size (int): Level of the thumbnail pyramid
+            callback (function): Called with the PhotoImage once a requested thumbnail is decoded
+
+        Returns:
+            PhotoImage: The thumbnail, or None if it has been requested
+        """
+        key = (apod['sha256'], size)
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            return photo
+
+        self.callbacks[key] = callback
+        if key not in self.pending:
+            self.pending.add(key)
+            self.requests.put((key, apod['file_path']))
+        return None
+
+    def forget(self, apod, size):
+        """Cancels a thumbnail request, e.g. for a row scrolled out of view.
+
+        Args:
+            apod (dict): APOD with its 'sha256'
+            size (int): Level of the thumbnail pyramid
+        """
+        self.callbacks.pop((apod['sha256'], size), None)
+
+    def decode_thumbnails(self):
+        """Decodes requested thumbnails, rendering them first if needed. Runs on the background thread."""
+        while True:
+            key, file_path = self.requests.get()
+            # Rows scrolled away before their turn are skipped
+            if key not in self.callbacks:
+                self.results.put((key, file_path, None, True))
+                continue
+
+            image = None
+            sha256, size = key
+            thumbnail_path = apod_desktop.get_thumbnail(file_path, sha256, size)
+            if thumbnail_path is not None:
+                try:
+                    with Image.open(thumbnail_path) as thumbnail:
+                        thumbnail.load()
+                        image = thumbnail.copy()
+                except OSError:
+                    pass
+            self.results.put((key, file_path, image, False))
+
+    def poll_results(self):
+        """Turns decoded thumbnails into PhotoImages. Runs on the Tk thread."""
+        try:
+            while True:
+                key, file_path, image, skipped = self.results.get_nowait()
+                self.pending.discard(key)
+                if skipped:
+                    # The row may have scrolled back into view since
+                    if key in self.callbacks:
+                        self.pending.add(key)
+                        self.requests.put((key, file_path))
+                    continue
+
+                callback = self.callbacks.pop(key, None)
+                if image is None:
+                    continue
+
+                photo = ImageTk.PhotoImage(image)
+                self.photos[key] = photo
+                while len(self.photos) > PHOTO_CACHE_SIZE:
+                    self.photos.popitem(last=False)
+                if callback is not None:
+                    callback(photo)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_INTERVAL_MS, self.poll_results)
+
+class Gallery(Frame):
+    """Scrollable list of the cached APOD images, with a preview of the selected one."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.loader = ThumbnailLoader(root) if Image is not None else None
+        self.row_count = apod_desktop.get_gallery_size()
+        self.rows = {}           # Row index -> (apod, canvas item IDs) of the materialized rows
+        self.selected = None     # APOD shown in the preview
+        self.search_results = None  # APODs matching the search box, None when not searching
+        self.search_job = None   # Pending search, while typing
+        self.set_desktop_results = queue.Queue()  # Responses of set_desktop, from its worker thread
+
+        # Gallery list
+        list_frame = Frame(self)
+        list_frame.pack(side=LEFT, fill=BOTH, expand=True)
+        self.search_text = StringVar()
+        self.search_text.trace_add('write', lambda *args: self.schedule_search())
+        Entry(list_frame, textvariable=self.search_text).pack(side=TOP, fill=X, padx=4, pady=4)
+        self.canvas = Canvas(list_frame, highlightthickness=0)
+        scrollbar = Scrollbar(list_frame, orient=VERTICAL, command=self.scroll)
+        self.canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement=1,
+                              scrollregion=(0, 0, 0, self.row_count * ROW_HEIGHT))
+        scrollbar.pack(side=RIGHT, fill=Y)
+        self.canvas.pack(side=LEFT, fill=BOTH, expand=True)
+        self.selection = self.canvas.create_rectangle(0, 0, 0, 0, fill='#cce4ff', outline='')
+
+        # Preview of the selected image
+        preview_frame = Frame(self, width=320)
+        preview_frame.pack(side=RIGHT, fill=Y)
+        preview_frame.pack_propagate(False)
+        self.preview_image = Label(preview_frame)
+        self.preview_image.pack(pady=8)
+        self.preview_title = Label(preview_frame, wraplength=300, font=('TkDefaultFont', 12, 'bold'))
+        self.preview_title.pack(padx=8)
+        self.set_desktop_button = Button(preview_frame, text='Set as Desktop', state=DISABLED,
+                                         command=self.set_desktop)
+        self.set_desktop_button.pack(pady=(8, 0))
+        self.set_desktop_status = Label(preview_frame, wraplength=300, fg='gray40')
+        self.set_desktop_status.pack(padx=8, pady=(0, 8))
+        self.preview_explanation = Text(preview_frame, wrap=WORD, height=10, relief=FLAT)
+        self.preview_explanation.pack(fill=BOTH, expand=True, padx=8, pady=(0, 8))
+
+        self.canvas.bind('<Configure>', lambda event: self.refresh())
+        self.canvas.bind('<Button-1>', self.select)
+        self.canvas.bind('<MouseWheel>', lambda event: self.scroll('scroll', -1 if event.delta > 0 else 1, 'units'))
+        self.canvas.bind('<Button-4>', lambda event: self.scroll('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda event: self.scroll('scroll', 1, 'units'))
+
+    def scroll(self, *args):
+        """Scrolls the gallery list (the scrollbar's command) and materializes the rows now in view.
+
+        A scroll unit is one row.
+        """
+        if args[0] == 'scroll' and args[2] == 'units':
+            # The canvas scrolls by pixels (yscrollincrement=1)
+            args = ('scroll', int(args[1]) * ROW_HEIGHT, 'units')
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def refresh(self):
+        """Makes canvas items for the rows in view and deletes those of rows out of view."""
+        top = int(self.canvas.canvasy(0))
+        first_row = max(top // ROW_HEIGHT - OVERSCAN_ROWS, 0)
+        last_row = min((top + self.canvas.winfo_height()) // ROW_HEIGHT + OVERSCAN_ROWS + 1, self.row_count)
+
+        for index in [index for index in self.rows if not first_row <= index < last_row]:
+            apod, items = self.rows.pop(index)
+            self.canvas.delete(*items)
+            if self.loader is not None:
+                self.loader.forget(apod, ROW_THUMBNAIL_SIZE)
+
+        missing_rows = [index for index in range(first_row, last_row) if index not in self.rows]
+        if not missing_rows:
+            return
+        if self.search_results is not None:
+            page = self.search_results[missing_rows[0]:missing_rows[-1] + 1]
+        else:
+            page = apod_desktop.get_gallery_page(missing_rows[0], missing_rows[-1] - missing_rows[0] + 1)
+        for index, apod in enumerate(page, start=missing_rows[0]):
+            if index not in self.rows:
+                self.rows[index] = (apod, self.make_row(index, apod))
+
+    def make_row(self, index, apod):
+        """Makes the canvas items of one row of the gallery list.
+
+        Args:
+            index (int): Row index
+            apod (dict): APOD shown in the row (see apod_desktop.get_gallery_page)
+
+        Returns:
+            list[int]: Canvas item IDs of the row
+        """
+        y = index * ROW_HEIGHT
+        image_item = self.canvas.create_image(4 + ROW_THUMBNAIL_SIZE // 2, y + ROW_HEIGHT // 2, anchor=CENTER)
+        items = [
+            image_item,
+            self.canvas.create_text(ROW_THUMBNAIL_SIZE + 12, y + 20, anchor=W, text=apod['title'],
+                                    font=('TkDefaultFont', 11, 'bold')),
+            self.canvas.create_text(ROW_THUMBNAIL_SIZE + 12, y + 44, anchor=W,
+                                    text=apod.get('snippet') or apod['apod_date'] or '', fill='gray40')
+        ]
+        if self.loader is not None:
+            photo = self.loader.get(apod, ROW_THUMBNAIL_SIZE,
+                                    lambda photo: self.canvas.itemconfigure(image_item, image=photo))
+            if photo is not None:
+                self.canvas.itemconfigure(image_item, image=photo)
+        return items
+
+    def schedule_search(self):
+        """Searches once typing in the search box pauses."""
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DELAY_MS, self.search)
+
+    def search(self):
+        """Lists the APODs matching the search box, or all APODs if it is empty."""
+        self.search_job = None
+        query = self.search_text.get().strip()
+        if query:
+            self.search_results = apod_desktop.search_apods(query, limit=SEARCH_RESULTS_LIMIT, cached_only=True)
+            self.row_count = len(self.search_results)
+        else:
+            self.search_results = None
+            self.row_count = apod_desktop.get_gallery_size()
+
+        for apod, items in self.rows.values():
+            self.canvas.delete(*items)
+            if self.loader is not None:
+                self.loader.forget(apod, ROW_THUMBNAIL_SIZE)
+        self.rows = {}
+        self.canvas.coords(self.selection, 0, 0, 0, 0)
+        self.canvas.configure(scrollregion=(0, 0, 0, self.row_count * ROW_HEIGHT))
+        self.canvas.yview_moveto(0)
+        self.refresh()
+
+    def select(self, event):
+        """Shows the image in the clicked row in the preview."""
+        index = int(self.canvas.canvasy(event.y)) // ROW_HEIGHT
+        if index not in self.rows:
+            return
+        apod = self.rows[index][0]
+        self.selected = apod
+        self.canvas.coords(self.selection, 0, index * ROW_HEIGHT, self.canvas.winfo_width(), (index + 1) * ROW_HEIGHT)
+
+        self.preview_title.configure(text=apod['title'])
+        apod_info = apod_desktop.get_apod_info(apod['id'])
+        self.preview_explanation.delete('1.0', END)
+        self.preview_explanation.insert('1.0', apod_info['explanation'] if apod_info is not None else '')
+        self.set_desktop_button.configure(state=NORMAL)
+        self.set_desktop_status.configure(text='')
+
+        self.preview_image.configure(image='')
+        if self.loader is not None:
+            photo = self.loader.get(apod, PREVIEW_THUMBNAIL_SIZE, lambda photo: self.show_preview_image(apod, photo))
+            if photo is not None:
+                self.show_preview_image(apod, photo)
+
+    def show_preview_image(self, apod, photo):
+        """Shows a decoded thumbnail in the preview, if its APOD is still the selected one."""
+        if apod is not self.selected:
+            return
+        self.preview_image.configure(image=photo)
+        self.preview_image.image = photo
+
+    def set_desktop(self):
+        """Sets the selected image as the desktop background image on a worker
+        thread, so the gallery stays responsive while the APOD service is busy."""
+        if self.selected is None:
+            return
+        self.set_desktop_button.configure(state=DISABLED)
+        self.set_desktop_status.configure(text='Setting desktop background...')
+        # Tk may only be used from this thread, so the worker must not detect the screen
+        # size itself. macOS detects the native (Retina) size without Tk.
+        screen_size = None if sys.platform == 'darwin' else (self.winfo_screenwidth(), self.winfo_screenheight())
+        threading.Thread(target=self.set_desktop_in_background, args=(self.selected, screen_size),
+                         daemon=True).start()
+        self.after(POLL_INTERVAL_MS, self.poll_set_desktop)
+
+    def set_desktop_in_background(self, apod, screen_size=None):
+        """Sets an image as the desktop background image, through the APOD service
+        if it is running. Runs on a worker thread.
 
-# Determine the path and parent directory of this script
-script_path = os.path.abspath(inspect.getframeinfo(inspect.currentframe()).filename)
-script_dir = os.path.dirname(script_path)
+        Args:
+            apod (dict): APOD with its 'id' and 'file_path'
+            screen_size (tuple[int, int], optional): Screen size in pixels (width, height), read
+            on the Tk thread. Defaults to None (detected without Tk, on macOS).
+        """
+        try:
+            response = apod_daemon.send_command('set_wallpaper', timeout=SERVICE_TIMEOUT, apod_id=apod['id'])
+        except (OSError, ValueError) as e:
+            response = {'ok': False, 'error': f'The APOD service did not answer ({e})'}
+        if response is None:
+            # The service is not running, so the image is set from here
+            apod_desktop.make_wallpaper_variants([apod['id']], size=screen_size)
+            response = {'ok': image_lib.set_desktop_background_image(apod['file_path'])}
+        self.set_desktop_results.put((apod, response))
 
-# Initialize the image cache
-apod_desktop.init_apod_cache(script_dir)
+    def poll_set_desktop(self):
+        """Shows the result of set_desktop once its worker thread is done. Runs on the Tk thread."""
+        try:
+            apod, response = self.set_desktop_results.get_nowait()
+        except queue.Empty:
+            self.after(POLL_INTERVAL_MS, self.poll_set_desktop)
+            return
 
-# TODO: Create the GUI
-root = Tk()
-root.geometry('600x400')
+        if self.selected is not None:
+            self.set_desktop_button.configure(state=NORMAL)
+        if response.get('ok'):
+            text = f"Desktop background set to {apod['title']}"
+        else:
+            text = f"Error: {response.get('error') or 'The desktop background could not be set'}"
+        self.set_desktop_status.configure(text=text)
 
-root.mainloop()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark of adding APOD records to the image cache DB one row per
+transaction (add_apod_to_db) versus in batches (add_apods_to_db).
+
+Usage:
+  python bench_db_insert.py [record_count ...]
+
+Parameters:
+  record_count = Number of records inserted per run (default: 1000 10000)
+"""
+import sys
+import tempfile
+import time
+import apod_desktop
+import cache_db
+
+
+def main():
+    record_counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+
+    for record_count in record_counts:
+        records = make_records(record_count)
+        per_row_rate = run_benchmark(insert_per_row, records)
+        batch_rate = run_benchmark(insert_batch, records)
+        print(f'{record_count} records: '
+              f'per-row {per_row_rate:,.0f} rows/sec, '
+              f'batch {batch_rate:,.0f} rows/sec '
+              f'({batch_rate / per_row_rate:.1f}x)')
+
+def make_records(record_count):
+    """Makes a list of distinct synthetic APOD records.
+
+    Args:
+        record_count (int): Number of records
+
+    Returns:
+        list[dict]: APOD records as accepted by add_apods_to_db
+    """
+    return [
+        {
+            'title': f'Synthetic APOD {i}',
+            'explanation': 'Synthetic APOD used for benchmarking. ' * 20,
+            'file_path': f'/tmp/apod_bench/Synthetic_APOD_{i}.jpg',
+            'sha256': f'{i:064x}',
+            'apod_date': f'bench-{i}',
+            'url': f'https://apod.nasa.gov/apod/image/bench/{i}.jpg',
+            'content_length': 5_000_000
+        }
+        for i in range(record_count)
+    ]
+
+def run_benchmark(insert_function, records):
+    """Times inserting records into a fresh image cache DB.
+
+    Args:
+        insert_function (function): Function that inserts a list of records
+        records (list[dict]): APOD records
+
+    Returns:
+        float: Records inserted per second
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        apod_desktop.init_apod_cache(temp_dir)
+        # A budget that fits every record, so only inserting is timed and nothing is evicted
+        apod_desktop.configure_cache_budget(sum(record['content_length'] for record in records))
+        start_time = time.perf_counter()
+        insert_function(records)
+        elapsed = time.perf_counter() - start_time
+
+        row_count = cache_db.query_one("SELECT COUNT(*) FROM image_apod")[0]
+        assert row_count == len(records), f'expected {len(records)} rows, found {row_count}'
+        cache_db.close_db()
+
+    return len(records) / elapsed
+
+def insert_per_row(records):
+    """Inserts records with one add_apod_to_db call (and transaction) each."""
+    for record in records:
+        apod_desktop.add_apod_to_db(**record)
+
+def insert_batch(records):
+    """Inserts all records with a single add_apods_to_db call (and transaction)."""
+    apod_desktop.add_apods_to_db(records)
+
+if __name__ == '__main__':
+    main()
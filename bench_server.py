@@ -0,0 +1,216 @@
+"""
+Local stand-in for NASA's APOD API and image server, used by the benchmarks.
+
+Serves:
+  /planetary/apod?date=YYYY-MM-DD                      APOD info for one date
+  /planetary/apod?start_date=...&end_date=...          APOD info for a date range
+  /apod/image/YYYY-MM-DD.jpg                           Synthetic JPEG for a date
+
+API responses carry X-RateLimit-Limit/X-RateLimit-Remaining headers, and
+every response can be delayed to imitate network latency. Images are real
+JPEGs (when Pillow is installed) padded to a configurable size, with an ETag
+so conditional requests can be answered with 304.
+
+Usage:
+  python bench_server.py [port]
+"""
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import hashlib
+import io
+import json
+import sys
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+IMAGE_SIZE = 2 * 1024 * 1024    # Default size in bytes of each synthetic image
+IMAGE_DIMENSIONS = (1920, 1080) # Pixel size of each synthetic image
+GRID_SIZE = 4                   # Synthetic images are a GRID_SIZE x GRID_SIZE grid of coloured blocks
+RATE_LIMIT = 1000               # Default hourly limit reported in the rate limit headers
+VIDEO_EVERY = 0                 # Make every Nth date a video (0 for none)
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server, base_url = start_server(port=port)
+    print(f'Stand-in APOD API: {base_url}/planetary/apod')
+    try:
+        server.serve_thread.join()
+    except KeyboardInterrupt:
+        stop_server(server)
+
+def start_server(port=0, latency=0.0, image_size=IMAGE_SIZE, rate_limit=RATE_LIMIT, video_every=VIDEO_EVERY):
+    """Starts the stand-in APOD server on a background thread.
+
+    Args:
+        port (int, optional): Port to listen on, 0 for any free port. Defaults to 0.
+        latency (float, optional): Seconds each response is delayed. Defaults to 0.0.
+        image_size (int, optional): Size in bytes of each image. Defaults to IMAGE_SIZE.
+        rate_limit (int, optional): Hourly limit reported in the rate limit headers. Defaults to RATE_LIMIT.
+        video_every (int, optional): Make every Nth date a video (0 for none). Defaults to VIDEO_EVERY.
+
+    Returns:
+        tuple: (server, base_url) - Running server and the URL it is reachable at
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), APODRequestHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.image_size = image_size
+    server.rate_limit = rate_limit
+    server.video_every = video_every
+    server.requests_served = 0
+    server.lock = threading.Lock()
+    server.images = {}
+
+    server.serve_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.serve_thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def stop_server(server):
+    """Stops a running stand-in APOD server.
+
+    Args:
+        server (ThreadingHTTPServer): Server returned by start_server
+    """
+    server.shutdown()
+    server.server_close()
+
+def make_image(apod_date, image_size):
+    """Makes a synthetic JPEG for a date, padded with comment segments to a given size.
+
+    Args:
+        apod_date (str): APOD date formatted as YYYY-MM-DD
+        image_size (int): Size in bytes of the image
+
+    Returns:
+        bytes: JPEG image data
+    """
+    seed = hashlib.sha256(apod_date.encode()).digest()
+    if Image is not None:
+        width, height = IMAGE_DIMENSIONS
+        # A grid of blocks coloured by the seed, so every date looks different
+        # (also to perceptual hashes, see image_hash)
+        image = Image.new('RGB', (width, height))
+        for i in range(GRID_SIZE * GRID_SIZE):
+            column, row = i % GRID_SIZE, i // GRID_SIZE
+            box = (column * width // GRID_SIZE, row * height // GRID_SIZE,
+                   (column + 1) * width // GRID_SIZE, (row + 1) * height // GRID_SIZE)
+            image.paste(tuple(seed[(i + offset) % len(seed)] for offset in (0, 7, 13)), box)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        jpeg = buffer.getvalue()
+    else:
+        jpeg = b'\xff\xd8\xff\xd9'
+
+    # Pad with COM segments (max 65533 bytes of payload each) right after SOI
+    padding = []
+    remaining = image_size - len(jpeg)
+    while remaining > 4:
+        payload_size = min(remaining - 4, 65533)
+        payload = (seed * (payload_size // len(seed) + 1))[:payload_size]
+        padding.append(b'\xff\xfe' + (payload_size + 2).to_bytes(2, 'big') + payload)
+        remaining -= payload_size + 4
+    return jpeg[:2] + b''.join(padding) + jpeg[2:]
+
+class APODRequestHandler(BaseHTTPRequestHandler):
+    """Answers APOD API and image requests for the stand-in server."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        with self.server.lock:
+            self.server.requests_served += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if url.path == '/planetary/apod':
+            self.send_apod_info(parse_qs(url.query))
+        elif url.path.startswith('/apod/image/') and url.path.endswith('.jpg'):
+            self.send_image(url.path.rsplit('/', 1)[-1][:-len('.jpg')])
+        else:
+            self.send_body(404, b'{"msg": "Not found"}')
+
+    def send_apod_info(self, query):
+        try:
+            if 'date' in query:
+                body = self.get_apod_info(date.fromisoformat(query['date'][0]))
+            else:
+                start_date = date.fromisoformat(query['start_date'][0])
+                end_date = date.fromisoformat(query['end_date'][0])
+                body = []
+                while start_date <= end_date:
+                    body.append(self.get_apod_info(start_date))
+                    start_date += timedelta(days=1)
+        except (KeyError, ValueError):
+            self.send_body(400, b'{"msg": "Bad request"}')
+            return
+
+        with self.server.lock:
+            remaining = max(self.server.rate_limit - self.server.requests_served, 0)
+        self.send_body(200, json.dumps(body).encode(), headers={
+            'X-RateLimit-Limit': str(self.server.rate_limit),
+            'X-RateLimit-Remaining': str(remaining)
+        })
+
+    def get_apod_info(self, apod_date):
+        image_url = f'http://{self.headers["Host"]}/apod/image/{apod_date.isoformat()}.jpg'
+        is_video = self.server.video_every and apod_date.toordinal() % self.server.video_every == 0
+        return {
+            'date': apod_date.isoformat(),
+            'title': f'Synthetic APOD {apod_date.isoformat()}',
+            'explanation': f'Synthetic APOD served by the benchmark server for {apod_date.isoformat()}.',
+            'media_type': 'video' if is_video else 'image',
+            'url': image_url,
+            'hdurl': image_url,
+            'thumbnail_url': image_url
+        }
+
+    def send_image(self, apod_date):
+        with self.server.lock:
+            image_data = self.server.images.get(apod_date)
+            if image_data is None:
+                image_data = make_image(apod_date, self.server.image_size)
+                self.server.images[apod_date] = image_data
+
+        etag = '"' + hashlib.md5(image_data).hexdigest() + '"'
+        last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        headers = {'ETag': etag, 'Last-Modified': last_modified, 'Accept-Ranges': 'bytes'}
+        if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == last_modified:
+            self.send_body(304, b'', headers=headers)
+            return
+
+        # Range requests are honoured only while the If-Range validator still matches
+        byte_range = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if byte_range.startswith('bytes=') and if_range in (None, etag, last_modified):
+            start = int(byte_range[len('bytes='):].split('-', 1)[0])
+            if start >= len(image_data):
+                self.send_body(416, b'', headers={'Content-Range': f'bytes */{len(image_data)}'})
+                return
+            headers['Content-Range'] = f'bytes {start}-{len(image_data) - 1}/{len(image_data)}'
+            self.send_body(206, image_data[start:], content_type='image/jpeg', headers=headers)
+            return
+        self.send_body(200, image_data, content_type='image/jpeg', headers=headers)
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Startup benchmark for the APOD desktop script.
+
+Each run is a fresh Python process, as when the script is started from cron:
+  import_ms     time to import apod_desktop (from python -X importtime)
+  cache_hit_ms  wall-clock time of a whole run whose APOD is already in the
+                image cache, from starting the interpreter to setting the wallpaper
+  python_ms     wall-clock time of starting an empty interpreter, for reference
+
+The cache-hit run must not load any of HEAVY_MODULES, since everything it
+needs is in the image cache DB. It runs with the screen size saved in the
+image cache DB by the run that seeded it, as a real run would, so it fails
+if the screen is detected again (which loads tkinter or runs system_profiler). The benchmark fails (exit status 1) if it
+does, if a timing is over its budget, or if a timing is more than
+REGRESSION_TOLERANCE (and REGRESSION_MIN_MS) slower than in an earlier results
+file. Each timing is the best of several runs, which is far less noisy for
+start-up times than the mean or median. The wallpaper is not actually changed.
+
+Usage:
+  python bench_startup.py [--runs N] [--output FILE] [--compare FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import bench_server
+import bench_suite
+
+
+HEAVY_MODULES = ('requests', 'urllib3', 'PIL', 'asyncio', 'concurrent.futures',
+                 'cProfile', 'pstats', 'tracemalloc', 'tkinter', 'numpy')
+IMPORT_BUDGET_MS = 80       # Max time to import apod_desktop
+CACHE_HIT_BUDGET_MS = 300   # Max wall-clock time of a cache-hit run
+REGRESSION_TOLERANCE = 0.2  # Max slowdown compared to an earlier results file...
+REGRESSION_MIN_MS = 5       # ...unless it is less than this many milliseconds
+BENCH_DATE = '2024-01-01'   # APOD date the cache-hit runs ask for
+SCREEN_SIZE = (1280, 720)   # Screen size 'detected' by the seeding run, smaller than the images so a wallpaper variant is rendered once and reused
+
+# Runs apod_desktop.main() on the benchmark's image cache, then prints which
+# heavy modules were loaded as the last line of its output
+CACHE_HIT_SCRIPT = """
+import json
+import sys
+sys.argv[1:] = [{apod_date!r}]
+import apod_desktop
+import image_lib
+apod_desktop.get_script_dir = lambda: {cache_parent_dir!r}
+image_lib.set_desktop_background_image = lambda image_path: True
+apod_desktop.main()
+print(json.dumps([name for name in {heavy_modules!r} if name in sys.modules]))
+"""
+
+def main():
+    args = get_args()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    with tempfile.TemporaryDirectory() as cache_parent_dir:
+        seed_image_cache(cache_parent_dir)
+        cache_hit_script = CACHE_HIT_SCRIPT.format(apod_date=BENCH_DATE, cache_parent_dir=cache_parent_dir,
+                                                   heavy_modules=HEAVY_MODULES)
+        python_times = [time_process(['-c', 'pass'], script_dir)[0] for _ in range(args.runs)]
+        import_times = [measure_import_time('apod_desktop', script_dir) for _ in range(args.runs)]
+        cache_hit_runs = [time_process(['-c', cache_hit_script], script_dir) for _ in range(args.runs)]
+
+    loaded_modules = json.loads(cache_hit_runs[-1][1].splitlines()[-1])
+    results = {
+        'version': bench_suite.get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': args.runs,
+        'python_ms': min(python_times) * 1000,
+        'import_ms': min(import_times) * 1000,
+        'cache_hit_ms': min(seconds for seconds, _ in cache_hit_runs) * 1000,
+        'heavy_modules': loaded_modules
+    }
+    print(f"python      {results['python_ms']:7.1f} ms")
+    print(f"import      {results['import_ms']:7.1f} ms  (budget {IMPORT_BUDGET_MS} ms)")
+    print(f"cache hit   {results['cache_hit_ms']:7.1f} ms  (budget {CACHE_HIT_BUDGET_MS} ms)")
+    print(f"heavy modules loaded on a cache hit: {', '.join(loaded_modules) or 'none'}")
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results saved to {args.output}')
+
+    failures = check_results(results)
+    if args.compare:
+        with open(args.compare) as file:
+            failures += compare_results(json.load(file), results)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+def get_args():
+    """Gets the benchmark settings from the command line.
+
+    Returns:
+        argparse.Namespace: Benchmark settings
+    """
+    parser = argparse.ArgumentParser(description='Startup benchmark for the APOD desktop script.')
+    parser.add_argument('--runs', type=int, default=10, help='number of processes started per measurement')
+    parser.add_argument('--output', default='bench_results_startup.json', help='file the results are saved to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    return parser.parse_args()
+
+def seed_image_cache(cache_parent_dir):
+    """Adds the APOD for BENCH_DATE to a new image cache, from the stand-in APOD server.
+
+    Args:
+        cache_parent_dir (str): Directory the image cache is created in
+    """
+    import apod_api
+    import apod_desktop
+    import cache_db
+    import image_lib
+
+    server, base_url = bench_server.start_server()
+    apod_api.APOD_URL = f'{base_url}/planetary/apod'
+    # Stands in for detecting the screen, so the size is saved in the image cache DB as in a real run
+    image_lib.detect_screen_size = lambda: SCREEN_SIZE
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            apod_desktop.init_apod_cache(cache_parent_dir)
+            apod_desktop.add_apod_to_cache(apod_desktop.parse_apod_date(BENCH_DATE))
+    finally:
+        cache_db.close_db()
+        bench_server.stop_server(server)
+
+def time_process(python_args, cwd):
+    """Runs a Python process to completion and times it.
+
+    Args:
+        python_args (list[str]): Arguments of the Python interpreter
+        cwd (str): Directory the process runs in
+
+    Returns:
+        tuple: (seconds, stdout) - Wall-clock time taken and output of the process
+    """
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable] + python_args, cwd=cwd, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start_time, result.stdout
+
+def measure_import_time(module, cwd):
+    """Measures the time to import a module in a fresh process, with python -X importtime.
+
+    Args:
+        module (str): Name of the module
+        cwd (str): Directory the process runs in
+
+    Returns:
+        float: Seconds taken to import the module and everything it imports
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=cwd, capture_output=True, text=True, check=True)
+    # Lines read "import time: <self us> | <cumulative us> | <name>", the top-level module unindented
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2] == f' {module}':
+            return int(fields[1]) / 1_000_000
+    raise ValueError(f'No import time reported for {module}')
+
+def check_results(results):
+    """Checks the results against the budgets.
+
+    Args:
+        results (dict): Current results
+
+    Returns:
+        list[str]: Description of each failed check
+    """
+    failures = []
+    if results['import_ms'] > IMPORT_BUDGET_MS:
+        failures.append(f"importing apod_desktop took {results['import_ms']:.1f} ms")
+    if results['cache_hit_ms'] > CACHE_HIT_BUDGET_MS:
+        failures.append(f"a cache-hit run took {results['cache_hit_ms']:.1f} ms")
+    if results['heavy_modules']:
+        failures.append(f"a cache-hit run loaded {', '.join(results['heavy_modules'])}")
+    return failures
+
+def compare_results(old_results, new_results):
+    """Prints the change of each timing between two result files.
+
+    Args:
+        old_results (dict): Earlier results
+        new_results (dict): Current results
+
+    Returns:
+        list[str]: Description of each timing that regressed
+    """
+    print(f"Compared to {old_results['version']}:")
+    failures = []
+    for metric in ('import_ms', 'cache_hit_ms'):
+        if not old_results.get(metric):
+            continue
+        change = (new_results[metric] - old_results[metric]) / old_results[metric]
+        print(f'{metric:14} {change:+.1%}')
+        if change > REGRESSION_TOLERANCE and new_results[metric] - old_results[metric] > REGRESSION_MIN_MS:
+            failures.append(f'{metric} regressed by {change:.1%}')
+    return failures
+
+if __name__ == '__main__':
+    main()
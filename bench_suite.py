@@ -0,0 +1,221 @@
+"""
+Offline benchmark suite for the APOD image cache.
+
+Runs the cache against a local stand-in for the APOD API and image server
+(see bench_server.py), so no NASA quota is used and results are repeatable.
+Each scenario runs in a fresh process with a fresh image cache, and reports
+its throughput, p50/p99 latency and peak RSS. Results are saved as JSON so
+runs of different versions can be compared.
+
+Scenarios:
+  single_date    add_apod_to_cache() for one date at a time
+  bulk_backfill  add_apod_range_to_cache() for the whole date range
+  repeat_hit     add_apod_to_cache() again for dates already in the cache
+
+Usage:
+  python bench_suite.py [--dates N] [--image-size BYTES] [--latency SECONDS]
+                        [--output FILE] [--compare FILE]
+"""
+from datetime import date, timedelta
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import bench_server
+
+
+SCENARIOS = ('single_date', 'bulk_backfill', 'repeat_hit')
+FIRST_DATE = date(2020, 1, 1)  # First APOD date requested by the scenarios
+
+def main():
+    args = get_args()
+
+    server, base_url = bench_server.start_server(latency=args.latency, image_size=args.image_size)
+
+    # Makes the images up front, so the first scenario doesn't pay for encoding them
+    for i in range(args.dates):
+        apod_date = (FIRST_DATE + timedelta(days=i)).isoformat()
+        server.images[apod_date] = bench_server.make_image(apod_date, args.image_size)
+
+    try:
+        results = {
+            'version': get_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {
+                'dates': args.dates,
+                'image_size': args.image_size,
+                'latency': args.latency
+            },
+            'scenarios': {}
+        }
+        for scenario in args.scenarios:
+            result = run_scenario(scenario, base_url, args.dates)
+            results['scenarios'][scenario] = result
+            print_result(scenario, result)
+    finally:
+        bench_server.stop_server(server)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare_results(json.load(file), results)
+
+def get_args():
+    """Gets the benchmark settings from the command line.
+
+    Returns:
+        argparse.Namespace: Benchmark settings
+    """
+    parser = argparse.ArgumentParser(description='Offline benchmark suite for the APOD image cache.')
+    parser.add_argument('--dates', type=int, default=30, help='number of APOD dates per scenario')
+    parser.add_argument('--image-size', type=int, default=bench_server.IMAGE_SIZE, help='size of each image in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency added to every response')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                        help='scenario to run (may be repeated, default: all)')
+    parser.add_argument('--output', default='bench_results.json', help='file the results are saved to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+def get_version():
+    """Gets the git commit of the code being benchmarked.
+
+    Returns:
+        str: Output of git describe, or 'unknown' outside a git checkout
+    """
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        return result.stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+def run_scenario(scenario, base_url, date_count):
+    """Runs a scenario in a fresh process, so its peak RSS is its own.
+
+    Args:
+        scenario (str): Name of the scenario
+        base_url (str): URL of the stand-in APOD server
+        date_count (int): Number of APOD dates
+
+    Returns:
+        dict: Scenario result (see scenario_worker)
+    """
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=scenario_worker, args=(scenario, base_url, date_count, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def scenario_worker(scenario, base_url, date_count, result_queue):
+    """Runs a scenario against a fresh image cache and reports its result.
+
+    Args:
+        scenario (str): Name of the scenario
+        base_url (str): URL of the stand-in APOD server
+        date_count (int): Number of APOD dates
+        result_queue (multiprocessing.Queue): Queue the result is put on
+    """
+    import apod_api
+    import apod_desktop
+    import http_lib
+
+    apod_api.APOD_URL = f'{base_url}/planetary/apod'
+    apod_dates = [FIRST_DATE + timedelta(days=i) for i in range(date_count)]
+    latencies = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            apod_desktop.init_apod_cache(temp_dir)
+
+            if scenario == 'repeat_hit':
+                apod_desktop.add_apod_range_to_cache(apod_dates[0], apod_dates[-1])
+
+            start_time = time.perf_counter()
+            if scenario == 'bulk_backfill':
+                apod_desktop.add_apod_range_to_cache(apod_dates[0], apod_dates[-1])
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                for apod_date in apod_dates:
+                    op_start_time = time.perf_counter()
+                    apod_desktop.add_apod_to_cache(apod_date)
+                    latencies.append(time.perf_counter() - op_start_time)
+            elapsed = time.perf_counter() - start_time
+
+    result_queue.put({
+        'items': date_count,
+        'seconds': elapsed,
+        'items_per_sec': date_count / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': get_peak_rss() / (1024 * 1024),
+        'http': http_lib.get_connection_stats()
+    })
+
+def percentile(values, percent):
+    """Calculates a percentile of a list of values (nearest-rank method).
+
+    Args:
+        values (list[float]): Values
+        percent (float): Percentile, from 0 to 100
+
+    Returns:
+        float: Value at the percentile, or 0.0 for an empty list
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def get_peak_rss():
+    """Gets the peak resident set size of the current process.
+
+    Returns:
+        int: Peak RSS in bytes
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def print_result(scenario, result):
+    """Prints the result of a scenario on one line."""
+    print(f"{scenario:14} {result['items_per_sec']:8.1f} items/sec  "
+          f"p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+          f"peak RSS {result['peak_rss_mb']:6.1f} MB")
+
+def compare_results(old_results, new_results):
+    """Prints the change of each metric between two result files.
+
+    Args:
+        old_results (dict): Earlier results
+        new_results (dict): Current results
+    """
+    print(f"Compared to {old_results['version']}:")
+    for scenario, new in new_results['scenarios'].items():
+        old = old_results['scenarios'].get(scenario)
+        if old is None:
+            continue
+        changes = []
+        for metric in ('items_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_mb'):
+            if old[metric]:
+                changes.append(f'{metric} {(new[metric] - old[metric]) / old[metric]:+.1%}')
+        print(f"{scenario:14} {'  '.join(changes)}")
+
+if __name__ == '__main__':
+    main()
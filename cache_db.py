@@ -0,0 +1,356 @@
+'''
+Library managing the connection to the image cache database.
+
+The whole process shares one long-lived sqlite connection in WAL mode, so
+callers no longer pay for opening the database on every query, readers are
+not blocked by the writer, and the connection is always closed properly.
+Opening the database also creates or migrates its schema in place.
+'''
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import metrics
+
+
+SCHEMA_VERSION = 8  # Stored in PRAGMA user_version; bump when adding a migration
+
+# Global variables
+db_path = None             # Full path of the open database
+connection = None          # Shared sqlite connection
+db_lock = threading.RLock()  # Serializes use of the connection across threads
+
+def main():
+    open_db(':memory:')
+    execute("INSERT INTO image_apod (title, explanation, file_path, sha256) VALUES ('t', 'e', 'p', 's')")
+    print(query_all("SELECT id, title, sha256 FROM image_apod"))
+    close_db()
+    return
+
+def open_db(path):
+    """Opens the image cache database, creating its tables and migrating an
+    existing database to the current schema if needed.
+
+    Any database that is already open is closed first.
+
+    Args:
+        path (str): Full path of the image cache database
+    """
+    global db_path
+    global connection
+
+    close_db()
+
+    with db_lock:
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        db_path = path
+        migrate_db()
+
+def migrate_db():
+    """Brings the open database up to SCHEMA_VERSION."""
+    with transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS image_apod
+            (
+               id    INTEGER PRIMARY KEY,
+               title TEXT NOT NULL,
+               explanation TEXT NOT NULL,
+               file_path TEXT NOT NULL,
+               sha256 TEXT NOT NULL,
+               url TEXT,
+               etag TEXT,
+               last_modified TEXT,
+               content_length INTEGER,
+               apod_date TEXT,
+               last_access REAL,
+               hit_count INTEGER NOT NULL DEFAULT 0,
+               cached INTEGER NOT NULL DEFAULT 1,
+               phash INTEGER,
+               dhash INTEGER,
+               width INTEGER,
+               height INTEGER,
+               aspect REAL,
+               luminance REAL,
+               histogram BLOB,
+               duplicate_of INTEGER
+            );
+        """)
+        # Values worth keeping between runs, e.g. the screen size detected last
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS setting
+            (
+               name  TEXT PRIMARY KEY,
+               value TEXT
+            );
+        """)
+
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        # Columns added since the original schema
+        new_columns = {
+            'url': 'TEXT',
+            'etag': 'TEXT',
+            'last_modified': 'TEXT',
+            'content_length': 'INTEGER',
+            'apod_date': 'TEXT',
+            'last_access': 'REAL',
+            'hit_count': 'INTEGER NOT NULL DEFAULT 0',
+            'cached': 'INTEGER NOT NULL DEFAULT 1',
+            'phash': 'INTEGER',
+            'dhash': 'INTEGER',
+            'width': 'INTEGER',
+            'height': 'INTEGER',
+            'aspect': 'REAL',
+            'luminance': 'REAL',
+            'histogram': 'BLOB',
+            'duplicate_of': 'INTEGER'
+        }
+        existing_columns = {row[1] for row in cur.execute("PRAGMA table_info(image_apod)")}
+        for column, column_type in new_columns.items():
+            if column not in existing_columns:
+                cur.execute(f"ALTER TABLE image_apod ADD COLUMN {column} {column_type}")
+                print(f'Image cache DB upgraded with column: {column}')
+
+        if version < 2:
+            # Eviction needs the size of every cached image, which older versions did not record
+            for apod_id, file_path in cur.execute(
+                    "SELECT id, file_path FROM image_apod WHERE content_length IS NULL").fetchall():
+                if os.path.exists(file_path):
+                    cur.execute("UPDATE image_apod SET content_length = ? WHERE id = ?",
+                                (os.path.getsize(file_path), apod_id))
+                else:
+                    cur.execute("UPDATE image_apod SET cached = 0 WHERE id = ?", (apod_id,))
+
+        # Older versions could store the same file or image twice. The last row
+        # written for a file describes what is on disk, so that one is kept.
+        cur.execute("""
+            DELETE FROM image_apod
+            WHERE id NOT IN (SELECT MAX(id) FROM image_apod GROUP BY file_path)
+        """)
+        cur.execute("""
+            DELETE FROM image_apod
+            WHERE id NOT IN (SELECT MIN(id) FROM image_apod GROUP BY sha256)
+        """)
+
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS image_apod_sha256 ON image_apod (sha256)")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS image_apod_file_path ON image_apod (file_path)")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS image_apod_apod_date ON image_apod (apod_date)")
+        cur.execute("CREATE INDEX IF NOT EXISTS image_apod_url ON image_apod (url)")
+        # Eviction candidates in least-recently-used and least-frequently-used order
+        cur.execute("CREATE INDEX IF NOT EXISTS image_apod_lru ON image_apod (last_access) WHERE cached")
+        cur.execute("CREATE INDEX IF NOT EXISTS image_apod_lfu ON image_apod (hit_count, last_access) WHERE cached")
+        # Wallpaper selection by shape and brightness (see image_features)
+        cur.execute("CREATE INDEX IF NOT EXISTS image_apod_aspect ON image_apod (aspect, luminance) WHERE cached")
+        cur.execute("CREATE INDEX IF NOT EXISTS image_apod_luminance ON image_apod (luminance) WHERE cached")
+        # APODs whose image file is shared with a near-duplicate (see apod_desktop.link_duplicate_apod_image)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS image_apod_duplicate_of ON image_apod (duplicate_of)
+            WHERE duplicate_of IS NOT NULL
+        """)
+        if version == 6:
+            # Version 6 kept only the date and URL of a near-duplicate, without its
+            # title and explanation, so those dates are downloaded again instead
+            cur.execute("DROP TABLE IF EXISTS image_apod_alias")
+
+        if version < 3:
+            create_search_index(cur)
+        if version < 8:
+            create_cache_size_total(cur)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def create_search_index(cur):
+    """Creates the full-text search index of APOD titles and explanations, and
+    the triggers keeping it in sync with image_apod, then fills it.
+
+    The index is an FTS5 table that reads its text from image_apod, so the
+    text is not stored twice. If this sqlite has no FTS5, there is no index
+    and searches fall back to a slower scan (see has_search_index).
+
+    Args:
+        cur (sqlite3.Cursor): Cursor in the migration transaction
+    """
+    try:
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS image_apod_fts USING fts5
+            (
+               title,
+               explanation,
+               content='image_apod',
+               content_rowid='id',
+               tokenize='porter unicode61'
+            );
+        """)
+    except sqlite3.OperationalError as e:
+        print(f'Full-text search index not created: {e}')
+        return
+
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_fts_insert AFTER INSERT ON image_apod BEGIN
+          INSERT INTO image_apod_fts (rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+        END;
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_fts_delete AFTER DELETE ON image_apod BEGIN
+          INSERT INTO image_apod_fts (image_apod_fts, rowid, title, explanation)
+          VALUES ('delete', old.id, old.title, old.explanation);
+        END;
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_fts_update AFTER UPDATE OF title, explanation ON image_apod BEGIN
+          INSERT INTO image_apod_fts (image_apod_fts, rowid, title, explanation)
+          VALUES ('delete', old.id, old.title, old.explanation);
+          INSERT INTO image_apod_fts (rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+        END;
+    """)
+    cur.execute("INSERT INTO image_apod_fts (image_apod_fts) VALUES ('rebuild')")
+
+def create_cache_size_total(cur):
+    """Creates the running total of the bytes used by cached images, and the
+    triggers keeping it in sync with image_apod, then fills it.
+
+    Eviction checks the total after every insert, so it is kept up to date by
+    every write instead of being summed over the whole table each time. An image
+    file shared by near-duplicate APODs (those with a duplicate_of) counts once.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor in the migration transaction
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cache_size
+        (
+           id    INTEGER PRIMARY KEY CHECK (id = 1),
+           bytes INTEGER NOT NULL
+        );
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_size_insert AFTER INSERT ON image_apod
+        WHEN new.cached AND new.duplicate_of IS NULL BEGIN
+          UPDATE cache_size SET bytes = bytes + COALESCE(new.content_length, 0);
+        END;
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_size_delete AFTER DELETE ON image_apod
+        WHEN old.cached AND old.duplicate_of IS NULL BEGIN
+          UPDATE cache_size SET bytes = bytes - COALESCE(old.content_length, 0);
+        END;
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS image_apod_size_update
+        AFTER UPDATE OF cached, content_length, duplicate_of ON image_apod BEGIN
+          UPDATE cache_size SET bytes = bytes
+            - CASE WHEN old.cached AND old.duplicate_of IS NULL THEN COALESCE(old.content_length, 0) ELSE 0 END
+            + CASE WHEN new.cached AND new.duplicate_of IS NULL THEN COALESCE(new.content_length, 0) ELSE 0 END;
+        END;
+    """)
+    cur.execute("""
+        INSERT OR REPLACE INTO cache_size (id, bytes)
+        SELECT 1, COALESCE(SUM(content_length), 0) FROM image_apod WHERE cached AND duplicate_of IS NULL
+    """)
+
+def has_search_index():
+    """Checks whether the open database has the full-text search index.
+
+    Returns:
+        bool: True, if image_apod_fts exists
+    """
+    return query_one("SELECT 1 FROM sqlite_master WHERE name = 'image_apod_fts'") is not None
+
+def get_setting(name):
+    """Gets a value saved with set_setting.
+
+    Args:
+        name (str): Name of the setting
+
+    Returns:
+        str: Value of the setting, or None if it has not been saved
+    """
+    query_result = query_one("SELECT value FROM setting WHERE name = ?", (name,))
+    return query_result[0] if query_result is not None else None
+
+def set_setting(name, value):
+    """Saves a value in the database, so later runs can read it with get_setting.
+
+    Args:
+        name (str): Name of the setting
+        value (str): Value of the setting
+    """
+    execute("INSERT INTO setting (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, value))
+
+@contextmanager
+def transaction():
+    """Runs a block of statements in a single transaction on the shared connection.
+
+    The transaction is committed if the block succeeds and rolled back if it raises.
+
+    Yields:
+        sqlite3.Cursor: Cursor on the shared connection
+    """
+    with db_lock, metrics.span('sqlite'):
+        cur = connection.cursor()
+        try:
+            yield cur
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cur.close()
+
+def execute(query, params=()):
+    """Executes a single statement that modifies the database and commits it.
+
+    Args:
+        query (str): SQL statement
+        params (tuple, optional): Statement parameters. Defaults to ().
+
+    Returns:
+        list[tuple]: Rows produced by the statement (e.g. by a RETURNING clause)
+    """
+    with transaction() as cur:
+        cur.execute(query, params)
+        return cur.fetchall()
+
+def query_one(query, params=()):
+    """Runs a query and gets its first row.
+
+    Args:
+        query (str): SQL query
+        params (tuple, optional): Query parameters. Defaults to ().
+
+    Returns:
+        tuple: First row of the result, or None if there are no rows
+    """
+    with db_lock, metrics.span('sqlite'):
+        return connection.execute(query, params).fetchone()
+
+def query_all(query, params=()):
+    """Runs a query and gets all of its rows.
+
+    Args:
+        query (str): SQL query
+        params (tuple, optional): Query parameters. Defaults to ().
+
+    Returns:
+        list[tuple]: Rows of the result
+    """
+    with db_lock, metrics.span('sqlite'):
+        return connection.execute(query, params).fetchall()
+
+def close_db():
+    """Closes the shared connection, if one is open."""
+    global db_path
+    global connection
+
+    with db_lock:
+        if connection is not None:
+            connection.close()
+            connection = None
+            db_path = None
+
+if __name__ == '__main__':
+    main()
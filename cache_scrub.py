@@ -0,0 +1,250 @@
+"""
+Checks that the files in the image cache still match the image cache DB.
+
+Every image file recorded in the DB is re-hashed across a pool of worker
+processes (one per core by default). Files are read through mmap, so large
+images are hashed straight from the page cache without being copied into
+the process. The scrub reports:
+  missing   records whose image file no longer exists (other than evicted images)
+  corrupt   records whose image file no longer matches its SHA-256 hash
+  orphaned  image files and blobs that no record refers to
+
+With --repair, missing and corrupt images are downloaded again from their
+URL and orphaned files are deleted.
+
+Usage:
+  python cache_scrub.py [--repair] [--workers N]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import time
+import apod_desktop
+import cache_db
+import image_analysis
+import image_lib
+import metrics
+
+
+def main():
+    args = get_args()
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+
+    report = scrub_cache(max_workers=args.workers)
+    print_report(report)
+    if args.repair:
+        repair_cache(report)
+
+def get_args():
+    """Gets the scrub settings from the command line.
+
+    Returns:
+        argparse.Namespace: Scrub settings
+    """
+    parser = argparse.ArgumentParser(description='Checks the image cache against the image cache DB.')
+    parser.add_argument('--repair', action='store_true',
+                        help='download missing and corrupt images again and delete orphaned files')
+    parser.add_argument('--workers', type=int, default=None, help='number of hashing processes (default: one per core)')
+    return parser.parse_args()
+
+def scrub_cache(max_workers=None):
+    """Checks every image file recorded in the image cache DB against its SHA-256 hash,
+    and looks for files in the image cache that no record refers to.
+
+    The image cache must be initialized first (see apod_desktop.init_apod_cache).
+
+    Args:
+        max_workers (int, optional): Number of hashing processes. Defaults to one per core.
+
+    Returns:
+        dict: 'checked' (number of records), 'bytes' (bytes hashed), 'seconds' taken, 'missing' and
+        'corrupt' (lists of records, each a dict with the 'id', 'file_path', 'sha256'
+        and 'url' of the APOD and the 'file_sha256' its file must have) and 'orphaned'
+        (list of file paths)
+    """
+    # Evicted images are expected to be missing. The file of a near-duplicate
+    # is the image of the APOD it duplicates (see apod_desktop.link_duplicate_apod_image).
+    rows = cache_db.query_all("""
+      SELECT a.id, a.file_path, a.sha256, a.url, COALESCE(original.sha256, a.sha256)
+      FROM image_apod a
+      LEFT JOIN image_apod original ON original.id = a.duplicate_of
+      WHERE a.cached
+    """)
+    records = [dict(zip(('id', 'file_path', 'sha256', 'url', 'file_sha256'), row)) for row in rows]
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = max(1, len(records) // (max_workers * 8))
+    report = {'checked': len(records), 'bytes': 0, 'seconds': 0.0, 'missing': [], 'corrupt': [], 'orphaned': []}
+    start_time = time.perf_counter()
+
+    print(f'Scrubbing {len(records)} cached images with {max_workers} processes...')
+    with metrics.span('scrub'), ProcessPoolExecutor(max_workers=max_workers) as executor:
+        file_paths = [record['file_path'] for record in records]
+        for record, (sha256, size) in zip(records, executor.map(hash_file_mmap, file_paths, chunksize=chunk_size)):
+            if sha256 is None:
+                report['missing'].append(record)
+                continue
+            report['bytes'] += size
+            if sha256 != record['file_sha256']:
+                report['corrupt'].append(record)
+
+    report['orphaned'] = find_orphaned_files(records)
+    report['seconds'] = time.perf_counter() - start_time
+    metrics.increment('scrub_bytes', report['bytes'])
+    return report
+
+def hash_file_mmap(file_path):
+    """Calculates the SHA-256 hash of a file, reading it through mmap.
+
+    Runs in the worker processes of scrub_cache.
+
+    Args:
+        file_path (str): Path of the file
+
+    Returns:
+        tuple: (sha256, size) - Hex SHA-256 hash and size of the file, or (None, 0)
+        if the file cannot be read
+    """
+    try:
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            # mmap cannot map an empty file
+            if size == 0:
+                return hashlib.sha256().hexdigest(), 0
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                return hashlib.sha256(mapped_file).hexdigest(), size
+    except OSError:
+        return None, 0
+
+def find_orphaned_files(records):
+    """Finds the image files and blobs in the image cache that no record refers to.
+
+    The image cache DB and partial downloads (blobs/incoming) are never orphans,
+    and a wallpaper variant or thumbnail is orphaned only if its image is.
+
+    Args:
+        records (list[dict]): Records of the image cache DB, each with a 'file_path' and 'sha256'
+
+    Returns:
+        list[str]: Full paths of the orphaned files
+    """
+    file_paths = {os.path.abspath(record['file_path']) for record in records}
+    hashes = {record['sha256'] for record in records}
+    db_files = {os.path.basename(apod_desktop.image_cache_db) + suffix for suffix in ('', '-wal', '-shm', '-journal')}
+
+    orphaned = []
+    with os.scandir(apod_desktop.image_cache_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) or entry.name in db_files:
+                continue
+            if os.path.abspath(entry.path) not in file_paths:
+                orphaned.append(entry.path)
+
+    incoming_dir = os.path.join(apod_desktop.image_blob_dir, 'incoming')
+    for dir_path, dir_names, file_names in os.walk(apod_desktop.image_blob_dir):
+        dir_names[:] = [name for name in dir_names if os.path.join(dir_path, name) != incoming_dir]
+        for file_name in file_names:
+            # Blobs are named by their hash, and wallpaper variants and thumbnails by hash and size
+            if os.path.splitext(file_name)[0].split('_', 1)[0] not in hashes:
+                orphaned.append(os.path.join(dir_path, file_name))
+    return sorted(orphaned)
+
+def print_report(report):
+    """Prints the result of a scrub.
+
+    Args:
+        report (dict): Result of scrub_cache
+    """
+    print(f"Checked {report['checked']} images ({report['bytes'] / (1024 * 1024):.1f} MiB) in {report['seconds']:.2f} s")
+    for record in report['missing']:
+        print(f"Missing: {record['file_path']}")
+    for record in report['corrupt']:
+        print(f"Corrupt: {record['file_path']}")
+    for file_path in report['orphaned']:
+        print(f"Orphaned: {file_path}")
+    print(f"{len(report['missing'])} missing, {len(report['corrupt'])} corrupt, {len(report['orphaned'])} orphaned")
+
+def repair_cache(report):
+    """Repairs the problems found by a scrub.
+
+    Missing and corrupt images are downloaded again from their URL, and orphaned
+    files are deleted.
+
+    Args:
+        report (dict): Result of scrub_cache
+
+    Returns:
+        int: Number of problems that could not be repaired
+    """
+    failures = 0
+    for record in report['missing'] + report['corrupt']:
+        if not repair_image(record):
+            failures += 1
+
+    for file_path in report['orphaned']:
+        print(f'Deleting orphaned file {file_path}...', end='')
+        try:
+            os.remove(file_path)
+            print('success')
+        except OSError as e:
+            print('failure')
+            print(f'Error: {e}')
+            failures += 1
+
+    print(f"Repair finished with {failures} problems left")
+    return failures
+
+def repair_image(record):
+    """Downloads a missing or corrupt image again and links it back under its file path.
+
+    If the image has changed on the server since it was cached, the record is
+    updated to the new image. A near-duplicate keeps the downloaded image as its own.
+
+    Args:
+        record (dict): Record of the image cache DB, with the 'id', 'file_path', 'sha256', 'url'
+        and 'file_sha256' of the APOD (see scrub_cache)
+
+    Returns:
+        bool: True, if successful. False, if unsuccessful
+    """
+    print(f"Repairing {record['file_path']}")
+    if record['url'] is None:
+        print('Error: The image URL is not in the image cache DB, so it cannot be downloaded again')
+        return False
+
+    # A corrupt file is the same file as its blob, which would otherwise be kept
+    file_extension = record['url'].split('.')[-1]
+    blob_path = apod_desktop.get_blob_path(record['sha256'], file_extension)
+    for file_path in (record['file_path'], blob_path):
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+
+    download, blob_path = apod_desktop.download_image_blob(record['url'])
+    if download is None:
+        return False
+    if not image_lib.link_image_file(blob_path, record['file_path']):
+        return False
+
+    if download['sha256'] != record['sha256']:
+        print('The image has changed on the server since it was cached')
+        analysis = image_analysis.analyze_image(blob_path)
+        try:
+            cache_db.execute(f"""
+              UPDATE image_apod
+              SET sha256 = ?, etag = ?, last_modified = ?, content_length = ?, duplicate_of = NULL,
+                  {', '.join(f'{column} = ?' for column in image_analysis.ANALYSIS_COLUMNS)}
+              WHERE id = ?
+            """, (download['sha256'], download['etag'], download['last_modified'], download['content_length'],
+                  *(analysis[column] for column in image_analysis.ANALYSIS_COLUMNS), record['id']))
+        except sqlite3.IntegrityError as e:
+            print(f'Error: Could not update image cache DB: {e}')
+            return False
+    elif record['file_sha256'] != record['sha256']:
+        cache_db.execute("UPDATE image_apod SET duplicate_of = NULL WHERE id = ?", (record['id'],))
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Library providing a shared, pooled HTTP session for talking to NASA's servers.
+
+All HTTP calls made by apod_api and image_lib go through the session in this
+module, so connections to api.nasa.gov and apod.nasa.gov are kept alive and
+reused across calls instead of paying a new TCP+TLS handshake every time.
+
+requests is only imported when the session is first created, so scripts that
+find everything they need in the image cache start up without it.
+'''
+
+
+POOL_CONNECTIONS = 4      # Number of per-host connection pools to keep
+POOL_MAXSIZE = 8          # Max number of keep-alive connections kept per host
+DEFAULT_TIMEOUT = (5, 60) # (connect, read) timeout in seconds
+
+# Global variables
+session = None                # Shared requests session, created on first use
+session_timeout = DEFAULT_TIMEOUT  # Timeout applied to calls that don't give one
+
+def main():
+    get('https://api.nasa.gov/planetary/apod', params={'api_key': 'DEMO_KEY'})
+    get('https://api.nasa.gov/planetary/apod', params={'api_key': 'DEMO_KEY'})
+    print(get_connection_stats())
+    return
+
+def configure_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT):
+    """Creates (or re-creates) the shared HTTP session with the specified pool settings.
+
+    Any existing session is closed, so its pooled connections are released.
+
+    Args:
+        pool_connections (int, optional): Number of per-host connection pools. Defaults to POOL_CONNECTIONS.
+        pool_maxsize (int, optional): Max keep-alive connections per host. Defaults to POOL_MAXSIZE.
+        timeout (float or tuple, optional): Default (connect, read) timeout in seconds. Defaults to DEFAULT_TIMEOUT.
+
+    Returns:
+        requests.Session: The shared HTTP session
+    """
+    global session
+    global session_timeout
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    close_session()
+
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session_timeout = timeout
+    return session
+
+def get_session():
+    """Gets the shared HTTP session, creating it with the default settings if needed.
+
+    Returns:
+        requests.Session: The shared HTTP session
+    """
+    if session is None:
+        configure_session()
+    return session
+
+def get(url, **kwargs):
+    """Sends a GET request through the shared HTTP session.
+
+    Uses the session's default timeout unless one is given.
+
+    Args:
+        url (str): URL to request
+        **kwargs: Extra arguments passed on to requests.Session.get
+
+    Returns:
+        requests.Response: Response message
+    """
+    kwargs.setdefault('timeout', session_timeout)
+    return get_session().get(url, **kwargs)
+
+def get_connection_stats():
+    """Gets the number of requests sent and connections opened by the shared session.
+
+    Counts are taken from the session's live connection pools, so pools that
+    were discarded (e.g. by configure_session) are not included.
+
+    Returns:
+        dict: Number of 'requests' sent, 'new_connections' opened and
+        'reused_connections' (requests that went over an already open connection)
+    """
+    num_requests = 0
+    num_connections = 0
+
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+    return {
+        'requests': num_requests,
+        'new_connections': num_connections,
+        'reused_connections': max(num_requests - num_connections, 0)
+    }
+
+def close_session():
+    """Closes the shared HTTP session and all of its pooled connections."""
+    global session
+
+    if session is not None:
+        session.close()
+        session = None
+
+if __name__ == '__main__':
+    main()
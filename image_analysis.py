@@ -0,0 +1,151 @@
+'''
+Library that analyzes APOD images for the image cache DB.
+
+Each image is decoded once, at a reduced scale, into the two small samples
+its stored data is computed from: a grayscale sample for the perceptual
+hashes (see image_hash) and a color sample for the wallpaper selection
+features (see image_features). Images cached by an older version are
+analyzed in bulk across a pool of worker processes.
+
+Usage:
+  python image_analysis.py [--workers N]
+'''
+import argparse
+import os
+import cache_db
+import image_features
+import image_hash
+import image_lib
+
+
+ANALYSIS_BATCH_SIZE = 4096  # Number of images sampled and analyzed at a time by backfill_analysis
+
+# Columns of the image_apod table written by the analysis
+ANALYSIS_COLUMNS = ('phash', 'dhash') + image_features.FEATURE_COLUMNS
+
+def main():
+    import apod_desktop  # Not at the top, since apod_desktop imports this module
+
+    args = get_args()
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+    analyzed = backfill_analysis(max_workers=args.workers)
+    print(f'Analyzed {analyzed} images')
+
+def get_args():
+    """Gets the backfill settings from the command line.
+
+    Returns:
+        argparse.Namespace: Backfill settings
+    """
+    parser = argparse.ArgumentParser(description='Analyzes cached images that have no hashes or features yet.')
+    parser.add_argument('--workers', type=int, default=None, help='number of image decoding processes (default: one per core)')
+    return parser.parse_args()
+
+def load_sample(image_path):
+    """Decodes an image once and scales it down to the samples it is analyzed from.
+
+    JPEGs are decoded at a reduced scale (Pillow's draft mode) that is just
+    large enough for the color sample, so this is far cheaper than a full
+    decode. Safe to run in a worker process.
+
+    Args:
+        image_path (str): Path of the image file
+
+    Returns:
+        tuple: (width, height, gray_pixels, color_pixels) - Size of the image, its
+        image_hash.SAMPLE_SIZE grayscale sample and its image_features.SAMPLE_SIZE RGB
+        sample, row by row, or None if Pillow is not installed or the image could not be read
+    """
+    Image = image_lib.load_pillow()
+    if Image is None:
+        return None
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            image.draft('RGB', (image_features.SAMPLE_SIZE, image_features.SAMPLE_SIZE))
+            decoded = image.convert('RGB')
+        color_sample = decoded.resize((image_features.SAMPLE_SIZE, image_features.SAMPLE_SIZE), Image.BILINEAR)
+        gray_sample = decoded.convert('L').resize((image_hash.SAMPLE_SIZE, image_hash.SAMPLE_SIZE), Image.BILINEAR)
+        return width, height, gray_sample.tobytes(), color_sample.tobytes()
+    except OSError:
+        return None
+
+def analyze_samples(samples):
+    """Calculates the hashes and features of a batch of samples, each in one vectorized pass.
+
+    Args:
+        samples (list[tuple]): Samples from load_sample
+
+    Returns:
+        list[dict]: Value of each of ANALYSIS_COLUMNS for each sample, as stored in the image cache DB
+    """
+    hashes = image_hash.compute_hashes([gray_pixels for _, _, gray_pixels, _ in samples])
+    features = image_features.compute_features([(width, height, color_pixels)
+                                                for width, height, _, color_pixels in samples])
+    return [{'phash': image_hash.to_db_hash(phash), 'dhash': image_hash.to_db_hash(dhash), **image_feature_values}
+            for (phash, dhash), image_feature_values in zip(hashes, features)]
+
+def analyze_image(image_path):
+    """Calculates the hashes and features of one image file.
+
+    Args:
+        image_path (str): Path of the image file
+
+    Returns:
+        dict: Value of each of ANALYSIS_COLUMNS, as stored in the image cache DB, all None
+        if the image could not be analyzed (e.g. NumPy or Pillow is not installed)
+    """
+    sample = load_sample(image_path)
+    if sample is not None:
+        try:
+            return analyze_samples([sample])[0]
+        except ImportError:
+            pass
+    return dict.fromkeys(ANALYSIS_COLUMNS)
+
+def backfill_analysis(max_workers=None):
+    """Analyzes every cached image that has no hashes or features yet, e.g.
+    images cached by an older version.
+
+    The images are decoded across a pool of worker processes, and each batch
+    of ANALYSIS_BATCH_SIZE samples is analyzed and written in one transaction.
+    The image cache must be initialized first.
+
+    Args:
+        max_workers (int, optional): Number of decoding processes. Defaults to one per core.
+
+    Returns:
+        int: Number of images analyzed
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    rows = cache_db.query_all("SELECT id, file_path FROM image_apod WHERE cached AND (phash IS NULL OR width IS NULL)")
+    if not rows:
+        return 0
+
+    max_workers = max_workers or os.cpu_count() or 1
+    print(f'Analyzing {len(rows)} images with {max_workers} processes...')
+    analyzed = 0
+    assignments = ', '.join(f'{column} = ?' for column in ANALYSIS_COLUMNS)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, len(rows), ANALYSIS_BATCH_SIZE):
+            batch_rows = rows[i:i + ANALYSIS_BATCH_SIZE]
+            file_paths = [file_path for _, file_path in batch_rows]
+            chunk_size = max(1, len(file_paths) // (max_workers * 8))
+            samples = list(executor.map(load_sample, file_paths, chunksize=chunk_size))
+
+            loaded = [(apod_id, sample) for (apod_id, _), sample in zip(batch_rows, samples) if sample is not None]
+            results = analyze_samples([sample for _, sample in loaded])
+            with cache_db.transaction() as cur:
+                cur.executemany(f"UPDATE image_apod SET {assignments} WHERE id = ?",
+                                [tuple(result[column] for column in ANALYSIS_COLUMNS) + (apod_id,)
+                                 for (apod_id, _), result in zip(loaded, results)])
+            for (apod_id, _), result in zip(loaded, results):
+                if result['phash'] is not None:
+                    image_hash.add_to_index(apod_id, image_hash.from_db_hash(result['phash']),
+                                            image_hash.from_db_hash(result['dhash']))
+            analyzed += len(loaded)
+    return analyzed
+
+if __name__ == '__main__':
+    main()
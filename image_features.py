@@ -0,0 +1,244 @@
+'''
+Library of precomputed image features, for choosing a wallpaper by its look.
+
+Rules such as "a landscape image close to 16:9 with mostly dark tones" would
+otherwise mean decoding every cached image. Instead, these features of each
+image are extracted once, when the image is cached, and stored in indexed
+columns of the image cache DB:
+  width, height  size of the image in pixels
+  aspect         width / height
+  luminance      mean brightness (Rec. 601 luma), from 0 (black) to 1 (white)
+  histogram      share of the pixels in each of the coarse COLOR_BINS, one byte each (0-255)
+
+Features are extracted with NumPy from a small sample of the image (see
+image_analysis), on whole batches of samples at once. Selecting images is a
+query on the aspect and luminance indexes, so no image is decoded.
+
+Usage:
+  python image_features.py [--workers N] [--landscape | --portrait] [--aspect W:H]
+                           [--min-width PIXELS] [--min-height PIXELS]
+                           [--min-luminance L] [--max-luminance L] [--color COLOR]
+                           [--limit N] [--wallpaper]
+'''
+import argparse
+import re
+import time
+import cache_db
+import image_lib
+import metrics
+
+
+SAMPLE_SIZE = 64               # Width and height in pixels of the color sample features are extracted from
+ACHROMATIC_CHROMA = 24         # Max difference between the color channels of a pixel counted as black, gray or white
+DARK_LEVEL = 64                # Max brightness of a pixel counted as black...
+LIGHT_LEVEL = 192              # ...and min brightness of one counted as white
+ASPECT_TOLERANCE = 0.05        # Max relative difference from a requested aspect ratio
+MIN_COLOR_SHARE = 0.25         # Min share of the pixels in a requested color
+SELECT_LIMIT = 50              # Default max number of APODs returned by select_apods
+
+# Bins of the color histogram: achromatic pixels by brightness, the others by hue
+COLOR_BINS = ('black', 'gray', 'white', 'red', 'yellow', 'green', 'cyan', 'blue', 'magenta')
+
+# Columns of the image_apod table holding the features
+FEATURE_COLUMNS = ('width', 'height', 'aspect', 'luminance', 'histogram')
+
+def main():
+    import apod_desktop  # Not at the top, since apod_desktop imports this module
+    import image_analysis  # Not at the top, since image_analysis imports this module
+
+    args = get_args()
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+
+    analyzed = image_analysis.backfill_analysis(max_workers=args.workers)
+    print(f'Analyzed {analyzed} images')
+
+    start_time = time.perf_counter()
+    apods = select_apods(orientation=args.orientation, aspect=args.aspect,
+                         min_width=args.min_width, min_height=args.min_height,
+                         min_luminance=args.min_luminance, max_luminance=args.max_luminance,
+                         color=args.color, limit=args.limit)
+    elapsed = time.perf_counter() - start_time
+    for apod in apods:
+        print(f"  {apod['apod_date']}  {apod['title']} ({apod['width']}x{apod['height']}, "
+              f"luminance {apod['luminance']:.2f})")
+    print(f'{len(apods)} matching images selected in {elapsed * 1000:.1f} ms')
+
+    if args.wallpaper and apods:
+        apod_desktop.make_wallpaper_variants([apods[0]['id']])
+        image_lib.set_desktop_background_image(apods[0]['file_path'])
+
+def get_args():
+    """Gets the selection rules from the command line.
+
+    Returns:
+        argparse.Namespace: Selection rules
+    """
+    parser = argparse.ArgumentParser(description='Selects cached APOD images by size, shape, brightness and color.')
+    orientation = parser.add_mutually_exclusive_group()
+    orientation.add_argument('--landscape', dest='orientation', action='store_const', const='landscape',
+                             help='only images wider than they are tall')
+    orientation.add_argument('--portrait', dest='orientation', action='store_const', const='portrait',
+                             help='only images taller than they are wide')
+    parser.add_argument('--aspect', type=parse_aspect, help='aspect ratio, e.g. 16:9 or 1.78')
+    parser.add_argument('--min-width', type=int, help='min width in pixels')
+    parser.add_argument('--min-height', type=int, help='min height in pixels')
+    parser.add_argument('--min-luminance', type=float, help='min mean brightness, from 0 to 1')
+    parser.add_argument('--max-luminance', type=float, help='max mean brightness, from 0 to 1')
+    parser.add_argument('--color', choices=COLOR_BINS, help='color at least a quarter of the image must have')
+    parser.add_argument('--limit', type=int, default=SELECT_LIMIT, help='max number of images listed')
+    parser.add_argument('--wallpaper', action='store_true', help='set the first image listed as the desktop background')
+    parser.add_argument('--workers', type=int, default=None, help='number of image decoding processes (default: one per core)')
+    return parser.parse_args()
+
+def parse_aspect(aspect):
+    """Converts an aspect ratio given on the command line, e.g. '16:9' or '1.78', to a number.
+
+    Args:
+        aspect (str): Aspect ratio as WIDTH:HEIGHT or as a decimal number
+
+    Raises:
+        ValueError: If the aspect ratio is invalid
+
+    Returns:
+        float: Width divided by height
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*[:x/]\s*(\d+(?:\.\d+)?)\s*', aspect)
+    ratio = float(match[1]) / float(match[2]) if match and float(match[2]) else float(aspect)
+    if ratio <= 0:
+        raise ValueError(f'Invalid aspect ratio: {aspect}')
+    return ratio
+
+def compute_features(samples):
+    """Calculates the features of a batch of samples in one vectorized pass.
+
+    Args:
+        samples (list[tuple]): (width, height, pixels) of each image - its size and the RGB values
+            of its SAMPLE_SIZE x SAMPLE_SIZE sample from image_analysis.load_sample, row by row
+
+    Returns:
+        list[dict]: 'width', 'height', 'aspect', 'luminance' and 'histogram' of each sample,
+        as stored in the image cache DB
+    """
+    import numpy as np
+
+    if not samples:
+        return []
+    pixels = np.frombuffer(b''.join(pixels for _, _, pixels in samples), dtype=np.uint8)
+    pixels = pixels.reshape(len(samples), SAMPLE_SIZE * SAMPLE_SIZE, 3).astype(np.float32)
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+
+    brightness = 0.299 * red + 0.587 * green + 0.114 * blue
+    luminances = brightness.mean(axis=1) / 255
+
+    # Hue sector of each pixel, 0 (red) to 5 (magenta), from the channel that is highest
+    highest = pixels.max(axis=2)
+    chroma = highest - pixels.min(axis=2)
+    safe_chroma = np.where(chroma > 0, chroma, 1)
+    hue = np.where(highest == red, ((green - blue) / safe_chroma) % 6,
+                   np.where(highest == green, (blue - red) / safe_chroma + 2, (red - green) / safe_chroma + 4))
+    sectors = np.floor(hue + 0.5).astype(np.int64) % 6
+
+    achromatic_bins = np.where(brightness < DARK_LEVEL, 0, np.where(brightness < LIGHT_LEVEL, 1, 2))
+    bins = np.where(chroma <= ACHROMATIC_CHROMA, achromatic_bins, sectors + 3)
+    # Counts the bins of all samples at once, with each sample's bins offset by its own range
+    offsets = np.arange(len(samples))[:, None] * len(COLOR_BINS)
+    counts = np.bincount((bins + offsets).ravel(), minlength=len(samples) * len(COLOR_BINS))
+    histograms = np.rint(counts.reshape(len(samples), -1) * 255 / bins.shape[1]).astype(np.uint8)
+
+    return [{
+        'width': width,
+        'height': height,
+        'aspect': width / height if height else None,
+        'luminance': float(luminance),
+        'histogram': histogram.tobytes()
+    } for (width, height, _), luminance, histogram in zip(samples, luminances, histograms)]
+
+def get_color_shares(histograms, color):
+    """Gets the share of the pixels in one color from many stored histograms.
+
+    Args:
+        histograms (list[bytes]): Histograms as stored in the image cache DB
+        color (str): One of COLOR_BINS
+
+    Returns:
+        numpy.ndarray: Share of the pixels in the color, from 0 to 1, of each histogram
+    """
+    import numpy as np
+
+    histograms = np.frombuffer(b''.join(histograms), dtype=np.uint8).reshape(len(histograms), len(COLOR_BINS))
+    return histograms[:, COLOR_BINS.index(color)] / 255
+
+def select_apods(orientation=None, aspect=None, aspect_tolerance=ASPECT_TOLERANCE, min_width=None, min_height=None,
+                 min_luminance=None, max_luminance=None, color=None, min_color_share=MIN_COLOR_SHARE,
+                 limit=SELECT_LIMIT):
+    """Selects cached APOD images by their stored features, without decoding any image.
+
+    The aspect ratio and luminance rules are answered by the image_apod_aspect
+    and image_apod_luminance indexes. Images whose features have not been
+    extracted yet (see image_analysis.backfill_analysis) are never selected.
+
+    Args:
+        orientation (str, optional): 'landscape' or 'portrait'
+        aspect (float, optional): Aspect ratio (width / height) the image must be close to
+        aspect_tolerance (float, optional): Max relative difference from aspect. Defaults to ASPECT_TOLERANCE.
+        min_width (int, optional): Min width in pixels
+        min_height (int, optional): Min height in pixels
+        min_luminance (float, optional): Min mean brightness, from 0 to 1
+        max_luminance (float, optional): Max mean brightness, from 0 to 1
+        color (str, optional): One of COLOR_BINS the image must have at least min_color_share of
+        min_color_share (float, optional): Min share of the pixels in color. Defaults to MIN_COLOR_SHARE.
+        limit (int, optional): Max number of APODs returned. Defaults to SELECT_LIMIT.
+
+    Raises:
+        ValueError: If the orientation or color is unknown
+
+    Returns:
+        list[dict]: The 'id', 'title', 'apod_date', 'file_path', 'width', 'height', 'aspect'
+        and 'luminance' of each matching APOD, newest first, or with the largest share of
+        color first if a color is given
+    """
+    conditions = ['cached', 'aspect IS NOT NULL']
+    params = []
+    if orientation == 'landscape':
+        conditions.append('aspect > 1')
+    elif orientation == 'portrait':
+        conditions.append('aspect < 1')
+    elif orientation is not None:
+        raise ValueError(f'Unknown orientation: {orientation}')
+    if aspect is not None:
+        conditions.append('aspect BETWEEN ? AND ?')
+        params += [aspect * (1 - aspect_tolerance), aspect * (1 + aspect_tolerance)]
+    for condition, value in (('width >= ?', min_width), ('height >= ?', min_height),
+                             ('luminance >= ?', min_luminance), ('luminance <= ?', max_luminance)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    if color is not None and color not in COLOR_BINS:
+        raise ValueError(f'Unknown color: {color}')
+
+    columns = ('id', 'title', 'apod_date', 'file_path', 'width', 'height', 'aspect', 'luminance')
+    with metrics.span('select'):
+        if color is None:
+            query_result = cache_db.query_all(f"""
+              SELECT {', '.join(columns)} FROM image_apod
+              WHERE {' AND '.join(conditions)}
+              ORDER BY apod_date DESC
+              LIMIT ?
+            """, params + [limit])
+            return [dict(zip(columns, row)) for row in query_result]
+
+        # The color rule needs the histograms, which are only a few bytes each
+        query_result = cache_db.query_all(f"""
+          SELECT {', '.join(columns)}, histogram FROM image_apod
+          WHERE {' AND '.join(conditions)}
+          ORDER BY apod_date DESC
+        """, params)
+        if not query_result:
+            return []
+        shares = get_color_shares([row[-1] for row in query_result], color)
+        matches = [(share, row[:-1]) for share, row in zip(shares, query_result) if share >= min_color_share]
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return [dict(zip(columns, row)) for _, row in matches[:limit]]
+
+if __name__ == '__main__':
+    main()
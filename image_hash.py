@@ -0,0 +1,392 @@
+'''
+Library for perceptual hashing of APOD images and finding near-duplicates.
+
+A SHA-256 hash only matches byte-identical files, so a re-encoded or resized
+copy of a cached image would otherwise be stored again. Each image also gets
+two 64-bit perceptual hashes, which stay (nearly) the same when an image is
+re-encoded or scaled:
+  pHash  signs of the low-frequency DCT coefficients of a 32x32 grayscale sample
+  dHash  whether brightness increases from left to right across a 9x8 sample
+Two images are near-duplicates when both hashes differ in at most
+NEAR_DUPLICATE_DISTANCE bits.
+
+Hashing is done with NumPy on whole batches of samples (see image_analysis)
+at once. Lookups go through a BK-tree of the pHashes in the image cache DB,
+so only a small part of the cache is compared against. A scan of the whole cache compares all
+hashes block by block as packed 64-bit integers.
+
+Usage:
+  python image_hash.py [--distance BITS] [--workers N]
+'''
+import argparse
+import threading
+import cache_db
+
+
+SAMPLE_SIZE = 32              # Width and height in pixels of the grayscale sample hashed
+HASH_SIZE = 8                 # Width and height of the bit grid of each hash (64 bits)
+NEAR_DUPLICATE_DISTANCE = 6   # Max differing bits of both hashes of near-duplicates
+MIN_CONTRAST = 2.0            # Min standard deviation of a sample's brightness; flatter images are not hashed
+SCAN_BLOCK_SIZE = 256         # Number of hashes compared against all others at a time by find_near_duplicate_pairs
+HASH_MASK = (1 << 64) - 1
+
+# Global variables
+hash_index = None               # BK-tree of the pHashes in the image cache DB, built on first use
+hash_index_db_path = None       # Path of the DB hash_index was built from
+hash_index_lock = threading.Lock()
+
+def main():
+    import apod_desktop  # Not at the top, since apod_desktop imports this module
+    import image_analysis  # Not at the top, since image_analysis imports this module
+
+    args = get_args()
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+
+    analyzed = image_analysis.backfill_analysis(max_workers=args.workers)
+    print(f'Analyzed {analyzed} images')
+    groups = group_pairs(find_near_duplicate_pairs(args.distance))
+    for group in groups:
+        print('Near-duplicates:')
+        for apod_id in group:
+            apod_info = apod_desktop.get_apod_info(apod_id)
+            print(f"  {apod_id}: {apod_info['title']} ({apod_info['file_path']})")
+    print(f'{len(groups)} groups of near-duplicate images')
+
+def get_args():
+    """Gets the scan settings from the command line.
+
+    Returns:
+        argparse.Namespace: Scan settings
+    """
+    parser = argparse.ArgumentParser(description='Finds near-duplicate images in the image cache.')
+    parser.add_argument('--distance', type=int, default=NEAR_DUPLICATE_DISTANCE,
+                        help='max differing bits of near-duplicate hashes')
+    parser.add_argument('--workers', type=int, default=None, help='number of image decoding processes (default: one per core)')
+    return parser.parse_args()
+
+def compute_hashes(samples):
+    """Calculates the pHash and dHash of a batch of samples in one vectorized pass.
+
+    Args:
+        samples (list[bytes]): SAMPLE_SIZE x SAMPLE_SIZE grayscale samples from image_analysis.load_sample
+
+    Returns:
+        list[tuple]: (phash, dhash) of each sample as unsigned 64-bit integers, or
+        (None, None) for a sample too flat for its hashes to mean anything
+    """
+    import numpy as np
+
+    if not samples:
+        return []
+    pixels = np.frombuffer(b''.join(samples), dtype=np.uint8)
+    pixels = pixels.reshape(len(samples), SAMPLE_SIZE, SAMPLE_SIZE).astype(np.float32)
+
+    # pHash: 2D DCT of every sample as two matrix products, keeping the lowest frequencies
+    dct = get_dct_matrix(SAMPLE_SIZE)
+    coefficients = (dct @ pixels @ dct.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(samples), -1)
+    # The DC coefficient is only the mean brightness, so it is left out of the median
+    medians = np.median(coefficients[:, 1:], axis=1)
+    phashes = pack_bits(coefficients > medians[:, None])
+
+    # dHash: area-average down to HASH_SIZE rows of HASH_SIZE + 1 columns, then compare neighbours
+    small = get_area_weights(SAMPLE_SIZE, HASH_SIZE) @ pixels @ get_area_weights(SAMPLE_SIZE, HASH_SIZE + 1).T
+    dhashes = pack_bits((small[:, :, 1:] > small[:, :, :-1]).reshape(len(samples), -1))
+
+    flat = pixels.std(axis=(1, 2)) < MIN_CONTRAST
+    return [(None, None) if is_flat else (int(phash), int(dhash))
+            for phash, dhash, is_flat in zip(phashes, dhashes, flat)]
+
+def get_dct_matrix(size):
+    """Makes the orthonormal DCT-II matrix of a given size.
+
+    Args:
+        size (int): Number of samples
+
+    Returns:
+        numpy.ndarray: (size, size) matrix whose product with a vector is its DCT
+    """
+    import numpy as np
+
+    frequencies = np.arange(size)[:, None]
+    positions = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * positions + 1) * frequencies / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+def get_area_weights(source_size, target_size):
+    """Makes the matrix that downsamples a line of pixels by averaging the
+    source pixels under each target pixel.
+
+    Args:
+        source_size (int): Number of source pixels
+        target_size (int): Number of target pixels
+
+    Returns:
+        numpy.ndarray: (target_size, source_size) matrix of weights, each row summing to 1
+    """
+    import numpy as np
+
+    edges = np.arange(target_size + 1) * source_size / target_size
+    starts = np.maximum(edges[:-1, None], np.arange(source_size)[None, :])
+    ends = np.minimum(edges[1:, None], np.arange(1, source_size + 1)[None, :])
+    weights = np.clip(ends - starts, 0, None)
+    return (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def pack_bits(bits):
+    """Packs rows of 64 bits into unsigned 64-bit integers, first bit highest.
+
+    Args:
+        bits (numpy.ndarray): (n, 64) array of booleans
+
+    Returns:
+        numpy.ndarray: n unsigned 64-bit integers
+    """
+    import numpy as np
+
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def to_db_hash(image_hash):
+    """Converts an unsigned 64-bit hash to the signed integer sqlite stores.
+
+    Args:
+        image_hash (int): Unsigned hash, or None
+
+    Returns:
+        int: Signed hash, or None
+    """
+    if image_hash is None:
+        return None
+    return image_hash - (1 << 64) if image_hash >= 1 << 63 else image_hash
+
+def from_db_hash(image_hash):
+    """Converts a hash read from the image cache DB back to an unsigned 64-bit integer.
+
+    Args:
+        image_hash (int): Signed hash, or None
+
+    Returns:
+        int: Unsigned hash, or None
+    """
+    return image_hash & HASH_MASK if image_hash is not None else None
+
+def hamming_distance(hash1, hash2):
+    """Counts the bits in which two hashes differ.
+
+    Args:
+        hash1 (int): Unsigned hash
+        hash2 (int): Unsigned hash
+
+    Returns:
+        int: Number of differing bits
+    """
+    return bin(hash1 ^ hash2).count('1')
+
+def is_near_duplicate(hashes1, hashes2, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Checks whether two images are near-duplicates by their hashes.
+
+    Args:
+        hashes1 (tuple): (phash, dhash) of one image, unsigned
+        hashes2 (tuple): (phash, dhash) of the other image, unsigned
+        max_distance (int, optional): Max differing bits of each hash. Defaults to NEAR_DUPLICATE_DISTANCE.
+
+    Returns:
+        bool: True, if both hashes are within max_distance bits
+    """
+    return all(hamming_distance(hash1, hash2) <= max_distance for hash1, hash2 in zip(hashes1, hashes2))
+
+class BKTree:
+    """Burkhard-Keller tree of hashes, for finding every hash within a Hamming
+    distance of another without comparing against all of them.
+
+    Each node's children are keyed by their distance from the node. By the
+    triangle inequality, a search only descends into children whose key is
+    within the search distance of the query's own distance from the node.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child node}]
+        self.size = 0
+
+    def add(self, image_hash, item):
+        """Adds a hash to the tree.
+
+        Args:
+            image_hash (int): Unsigned hash
+            item (object): Returned by search when the hash matches
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [image_hash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, [item], {}]
+                return
+            node = child
+
+    def search(self, image_hash, max_distance):
+        """Finds the items of every hash within a distance of a hash.
+
+        Args:
+            image_hash (int): Unsigned hash
+            max_distance (int): Max differing bits
+
+        Returns:
+            list[tuple]: (distance, item) of each match
+        """
+        matches = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_hash, items, children = nodes.pop()
+            distance = hamming_distance(image_hash, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return matches
+
+def get_hash_index():
+    """Gets the BK-tree of the pHashes in the open image cache DB, building it
+    the first time (or after another DB has been opened).
+
+    The caller must hold hash_index_lock.
+
+    Returns:
+        BKTree: Index whose items are (dhash, apod_id)
+    """
+    global hash_index
+    global hash_index_db_path
+
+    if hash_index is None or hash_index_db_path != cache_db.db_path:
+        hash_index = BKTree()
+        hash_index_db_path = cache_db.db_path
+        for apod_id, phash, dhash in cache_db.query_all(
+                "SELECT id, phash, dhash FROM image_apod WHERE phash IS NOT NULL"):
+            hash_index.add(from_db_hash(phash), (from_db_hash(dhash), apod_id))
+    return hash_index
+
+def add_to_index(apod_id, phash, dhash):
+    """Adds the hashes of a new APOD record to the index, if it has been built.
+
+    Args:
+        apod_id (int): Record ID of the APOD in the image cache DB
+        phash (int): Unsigned pHash of its image, or None
+        dhash (int): Unsigned dHash of its image, or None
+    """
+    if phash is None:
+        return
+    with hash_index_lock:
+        if hash_index is not None and hash_index_db_path == cache_db.db_path:
+            hash_index.add(phash, (dhash, apod_id))
+
+def find_near_duplicates(phash, dhash, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Finds the APODs in the image cache DB whose image is a near-duplicate of an image.
+
+    The index may still hold the hashes of an image that has since been
+    replaced, so callers should check the record's current hashes.
+
+    Args:
+        phash (int): Unsigned pHash of the image
+        dhash (int): Unsigned dHash of the image
+        max_distance (int, optional): Max differing bits of each hash. Defaults to NEAR_DUPLICATE_DISTANCE.
+
+    Returns:
+        list[tuple]: (apod_id, distance) of each near-duplicate, closest first, where
+        the distance is the larger of the pHash and dHash distances
+    """
+    if phash is None or dhash is None:
+        return []
+    with hash_index_lock:
+        candidates = get_hash_index().search(phash, max_distance)
+
+    matches = []
+    for phash_distance, (candidate_dhash, apod_id) in candidates:
+        dhash_distance = hamming_distance(dhash, candidate_dhash)
+        if dhash_distance <= max_distance:
+            matches.append((apod_id, max(phash_distance, dhash_distance)))
+    return sorted(matches, key=lambda match: match[1])
+
+def find_near_duplicate_pairs(max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Finds every pair of cached images that are near-duplicates of each other.
+
+    All hashes are held in two arrays of packed 64-bit integers. Each block of
+    SCAN_BLOCK_SIZE hashes is XORed against all later hashes at once, and the
+    differing bits are counted with a vectorized popcount.
+
+    Args:
+        max_distance (int, optional): Max differing bits of each hash. Defaults to NEAR_DUPLICATE_DISTANCE.
+
+    Returns:
+        list[tuple]: (apod_id, apod_id) of each pair of near-duplicates
+    """
+    import numpy as np
+
+    rows = cache_db.query_all("SELECT id, phash, dhash FROM image_apod WHERE cached AND phash IS NOT NULL")
+    if not rows:
+        return []
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    phashes = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)
+    dhashes = np.array([row[2] for row in rows], dtype=np.int64).view(np.uint64)
+
+    pairs = []
+    for start in range(0, len(rows), SCAN_BLOCK_SIZE):
+        end = min(start + SCAN_BLOCK_SIZE, len(rows))
+        # Each block is compared with itself and every later hash, so each pair is found once
+        phash_distances = count_bits(phashes[start:end, None] ^ phashes[None, start:])
+        dhash_distances = count_bits(dhashes[start:end, None] ^ dhashes[None, start:])
+        matches = (phash_distances <= max_distance) & (dhash_distances <= max_distance)
+        rows_in_block, columns = np.nonzero(np.triu(matches, k=1))
+        pairs.extend(zip(ids[start + rows_in_block].tolist(), ids[start + columns].tolist()))
+    return pairs
+
+def count_bits(values):
+    """Counts the set bits of each of an array of unsigned 64-bit integers.
+
+    Args:
+        values (numpy.ndarray): Unsigned 64-bit integers
+
+    Returns:
+        numpy.ndarray: Number of set bits of each value
+    """
+    import numpy as np
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy before 2.0 has no popcount, so the bytes are looked up in a table
+    byte_counts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+    return byte_counts[values.view(np.uint8).reshape(values.shape + (8,))].sum(axis=-1)
+
+def group_pairs(pairs):
+    """Groups pairs of near-duplicates into sets of images that are all connected by pairs.
+
+    Args:
+        pairs (list[tuple]): (apod_id, apod_id) of each pair
+
+    Returns:
+        list[list[int]]: Record IDs of each group, sorted
+    """
+    parents = {}
+
+    def find(apod_id):
+        while parents.setdefault(apod_id, apod_id) != apod_id:
+            parents[apod_id] = parents[parents[apod_id]]
+            apod_id = parents[apod_id]
+        return apod_id
+
+    for apod_id1, apod_id2 in pairs:
+        parents[find(apod_id1)] = find(apod_id2)
+
+    groups = {}
+    for apod_id in parents:
+        groups.setdefault(find(apod_id), []).append(apod_id)
+    return sorted(sorted(group) for group in groups.values())
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,27 @@
 '''
 Library of useful functions for working with images.
 '''
-import requests
+import http_lib
+import metrics
+import time
 import ctypes
 import subprocess
 import os
+import json
+import re
+import sys
+import threading
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read from the network at a time when streaming
+DOWNLOAD_ATTEMPTS = 3            # Tries (resuming where the last one stopped) before a download fails
+VARIANT_QUALITY = 90             # JPEG quality of screen-size variants of images
+
+# Global variables
+file_locks = {}                  # Partial file path -> lock held while downloading into it
+file_locks_lock = threading.Lock()
+screen_size = None               # (width, height) of the screen in pixels, None until detected
+wallpaper_variants = {}          # Full path of an image -> path of its screen-size variant
+Image = None                     # PIL.Image, once imported by load_pillow
  
 def main():
     image_url = 'https://apod.nasa.gov/apod/image/2304/PolarisIfn_Zayaz_4000.jpg'
@@ -27,18 +44,245 @@ def download_image(image_url):
     Returns:
         bytes: Binary image data, if succcessful. None, if unsuccessful.
     """
+    import requests  # Not needed until something is downloaded (see http_lib)
+
     # Send GET request to download the image
     print(f'Downloading image from {image_url}...', end='')
-    resp_msg = requests.get(image_url)
+    with metrics.span('download', url=image_url):
+        resp_msg = http_lib.get(image_url)
  
     # Check if the image was retrieved successfully
     if resp_msg.status_code == requests.codes.ok:
         print('success')
+        metrics.increment('bytes_downloaded', len(resp_msg.content))
         return resp_msg.content
     else:
         print('failure')
         print(f'Response code: {resp_msg.status_code} ({resp_msg.reason})')     
  
+def download_image_to_file(image_url, image_path, etag=None, last_modified=None):
+    """Downloads an image from a specified URL straight into a file on disk.
+
+    The image is streamed in chunks into a partial file, image_path + '.part',
+    and each chunk is fed into a SHA-256 hash as it arrives. When the download
+    completes, the partial file is atomically renamed to image_path, so memory
+    use stays flat regardless of image size and no partial file is ever left
+    at image_path.
+
+    If the transfer drops, the partial file is kept together with the image's
+    validator (ETag or Last-Modified) in image_path + '.part.json'. The next
+    attempt, in this call or a later one, resumes from where it stopped with an
+    HTTP Range request, falling back to a full download if the server does not
+    support ranges or the image changed in the meantime.
+
+    If etag or last_modified is given, a conditional GET is sent and nothing is
+    downloaded when the server reports the image has not been modified.
+
+    Args:
+        image_url (str): URL of image
+        image_path (str): Path to save image file
+        etag (str, optional): ETag of the copy already on disk. Defaults to None.
+        last_modified (str, optional): Last-Modified of the copy already on disk. Defaults to None.
+
+    Returns:
+        dict: Download info, if successful. None, if unsuccessful. Contains
+        'not_modified' (True if the server answered 304 and image_path was left
+        untouched), plus the image's 'sha256', 'etag', 'last_modified' and
+        'content_length' when it was downloaded.
+    """
+    import hashlib
+    import requests
+
+    part_path = f'{image_path}.part'
+    image_hash = hashlib.sha256()
+    hashed_bytes = 0      # Bytes of the partial file already fed into image_hash
+    hash_seconds = 0.0
+    received_bytes = 0    # Bytes actually transferred over the network
+
+    print(f'Downloading image from {image_url}...', end='')
+    download_start_time = time.perf_counter()
+    with get_file_lock(part_path):
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            part_info = read_part_info(part_path, image_url)
+            offset = os.path.getsize(part_path) if part_info is not None else 0
+
+            headers = {}
+            if offset > 0:
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = part_info['etag'] or part_info['last_modified']
+            else:
+                if etag is not None:
+                    headers['If-None-Match'] = etag
+                if last_modified is not None:
+                    headers['If-Modified-Since'] = last_modified
+
+            try:
+                with http_lib.get(image_url, headers=headers, stream=True) as resp_msg:
+                    if resp_msg.status_code == requests.codes.not_modified:
+                        print('not modified')
+                        metrics.record('download', time.perf_counter() - download_start_time, url=image_url)
+                        metrics.increment('not_modified_responses')
+                        return {'not_modified': True}
+
+                    # The partial file is no longer valid, so start over
+                    if resp_msg.status_code == requests.codes.requested_range_not_satisfiable:
+                        remove_part_file(part_path)
+                        continue
+
+                    if resp_msg.status_code == requests.codes.partial_content and get_range_start(resp_msg) == offset:
+                        metrics.increment('resumed_downloads')
+                        if hashed_bytes != offset:
+                            image_hash, hashed_bytes, seconds = hash_file(part_path)
+                            hash_seconds += seconds
+                        file_mode = 'ab'
+                    elif resp_msg.status_code == requests.codes.ok:
+                        # Full image (the server ignored the range or the image changed)
+                        image_hash = hashlib.sha256()
+                        hashed_bytes = 0
+                        file_mode = 'wb'
+                    else:
+                        print('failure')
+                        print(f'Response code: {resp_msg.status_code} ({resp_msg.reason})')
+                        return None
+
+                    image_etag = resp_msg.headers.get('ETag')
+                    image_last_modified = resp_msg.headers.get('Last-Modified')
+                    if file_mode == 'ab':
+                        image_etag = image_etag or part_info['etag']
+                        image_last_modified = image_last_modified or part_info['last_modified']
+                    write_part_info(part_path, image_url, image_etag, image_last_modified)
+
+                    with open(part_path, file_mode) as part_file:
+                        for chunk in resp_msg.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            part_file.write(chunk)
+                            received_bytes += len(chunk)
+                            hash_start_time = time.perf_counter()
+                            image_hash.update(chunk)
+                            hashed_bytes += len(chunk)
+                            hash_seconds += time.perf_counter() - hash_start_time
+            except (requests.RequestException, OSError) as e:
+                if attempt < DOWNLOAD_ATTEMPTS - 1:
+                    print(f'interrupted ({e}), resuming...', end='')
+                    continue
+                print('failure')
+                print(f'Error: {e}')
+                metrics.increment('bytes_downloaded', received_bytes)
+                return None
+
+            # Download complete
+            os.replace(part_path, image_path)
+            remove_part_file(part_path)
+            break
+        else:
+            print('failure')
+            return None
+
+    print('success')
+    # Hashing overlaps the download, so its time is part of the download span too
+    metrics.record('download', time.perf_counter() - download_start_time, url=image_url, bytes=received_bytes)
+    metrics.record('hash', hash_seconds, bytes=hashed_bytes)
+    metrics.increment('bytes_downloaded', received_bytes)
+    return {
+        'not_modified': False,
+        'sha256': image_hash.hexdigest(),
+        'etag': image_etag,
+        'last_modified': image_last_modified,
+        'content_length': hashed_bytes
+    }
+
+def get_file_lock(file_path):
+    """Gets the lock that keeps threads of this process from writing the same file at once.
+
+    Args:
+        file_path (str): Path of the file
+
+    Returns:
+        threading.Lock: Lock for the file
+    """
+    with file_locks_lock:
+        return file_locks.setdefault(file_path, threading.Lock())
+
+def read_part_info(part_path, image_url):
+    """Reads the info saved with a partially downloaded image.
+
+    Args:
+        part_path (str): Path of the partial image file
+        image_url (str): URL the image is being downloaded from
+
+    Returns:
+        dict: The partial image's 'etag' and 'last_modified', if the download can be
+        resumed. None, if there is no partial file for image_url or it has no validator.
+    """
+    if not os.path.exists(part_path):
+        return None
+    try:
+        with open(f'{part_path}.json') as info_file:
+            part_info = json.load(info_file)
+    except (OSError, ValueError):
+        return None
+    if part_info.get('url') != image_url or not (part_info.get('etag') or part_info.get('last_modified')):
+        return None
+    return part_info
+
+def write_part_info(part_path, image_url, etag, last_modified):
+    """Saves the info needed to resume a partially downloaded image.
+
+    Args:
+        part_path (str): Path of the partial image file
+        image_url (str): URL the image is being downloaded from
+        etag (str): ETag of the image, or None
+        last_modified (str): Last-Modified of the image, or None
+    """
+    with open(f'{part_path}.json', 'w') as info_file:
+        json.dump({'url': image_url, 'etag': etag, 'last_modified': last_modified}, info_file)
+
+def remove_part_file(part_path):
+    """Deletes a partial image file and its saved info, if they exist.
+
+    Args:
+        part_path (str): Path of the partial image file
+    """
+    for path in (part_path, f'{part_path}.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def get_range_start(resp_msg):
+    """Gets the first byte position of a 206 Partial Content response.
+
+    Args:
+        resp_msg (requests.Response): Response message
+
+    Returns:
+        int: Position of the first byte in the response, or None if it has no valid Content-Range
+    """
+    content_range = resp_msg.headers.get('Content-Range', '')
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        return int(byte_range.split('-', 1)[0]) if unit == 'bytes' else None
+    except ValueError:
+        return None
+
+def hash_file(file_path):
+    """Calculates the SHA-256 hash of a file, e.g. the part of an image downloaded before a resume.
+
+    Args:
+        file_path (str): Path of the file
+
+    Returns:
+        tuple: (hash, size, seconds) - hashlib object holding the file's hash,
+        number of bytes hashed and time taken
+    """
+    import hashlib
+
+    start_time = time.perf_counter()
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+            size += len(chunk)
+    return file_hash, size, time.perf_counter() - start_time
+
 def save_image_file(image_data, image_path):
     """Saves image data as a file on disk.
     
@@ -53,7 +297,7 @@ def save_image_file(image_data, image_path):
     """
     try:
         print(f"Saving image file as {image_path}...", end='')
-        with open(image_path, 'wb') as file:
+        with metrics.span('save_file'), open(image_path, 'wb') as file:
             file.write(image_data)
         print("success")
         return True
@@ -61,8 +305,49 @@ def save_image_file(image_data, image_path):
         print("failure")
         return False
  
+def link_image_file(image_path, link_path):
+    """Makes an image file reachable under a second path without copying it.
+
+    A hard link is used where possible, and a relative symbolic link otherwise.
+    An existing file at link_path is replaced atomically. Nothing is written if
+    link_path already refers to the image file.
+
+    Args:
+        image_path (str): Path of the image file
+        link_path (str): Path the image file should also be reachable at
+
+    Returns:
+        bool: True, if successful. False, if unsuccessful
+    """
+    try:
+        if os.path.exists(link_path) and os.path.samefile(image_path, link_path):
+            return True
+    except OSError:
+        pass
+
+    print(f"Linking image file as {link_path}...", end='')
+    temp_link_path = f'{link_path}.{os.getpid()}.link'
+    try:
+        try:
+            os.link(image_path, temp_link_path)
+        except OSError:
+            os.symlink(os.path.relpath(image_path, os.path.dirname(link_path)), temp_link_path)
+        os.replace(temp_link_path, link_path)
+    except OSError as e:
+        print("failure")
+        print(f"Error: {e}")
+        if os.path.lexists(temp_link_path):
+            os.remove(temp_link_path)
+        return False
+    print("success")
+    return True
+
 def set_desktop_background_image(image_path):
     """Sets the desktop background image to a specific image.
+
+    If a screen-size variant of the image has been registered (see
+    add_wallpaper_variant), the variant is used instead, so the desktop does
+    not have to decode and scale the full-resolution image.
  
     Args:
         image_path (str): Path of image file
@@ -70,6 +355,9 @@ def set_desktop_background_image(image_path):
     Returns:
         bool: True, if successful. False, if unsuccessful        
     """
+    variant_path = wallpaper_variants.get(os.path.abspath(image_path))
+    if variant_path is not None and os.path.exists(variant_path):
+        image_path = variant_path
     print(f"Setting desktop to {image_path}...", end='')
     
     # Check if the image file exists
@@ -86,8 +374,9 @@ def set_desktop_background_image(image_path):
     set desktop picture to POSIX file "{abs_path}"
 end tell'''
         
-        result = subprocess.run(['osascript', '-e', script], 
-                              capture_output=True, text=True)
+        with metrics.span('set_wallpaper'):
+            result = subprocess.run(['osascript', '-e', script], 
+                                  capture_output=True, text=True)
         
         if result.returncode == 0:
             print("success")
@@ -115,6 +404,140 @@ def scale_image(image_size, max_size=(800, 600)):
     resize_ratio = min(max_size[0] / image_size[0], max_size[1] / image_size[1])
     new_size = (int(image_size[0] * resize_ratio), int(image_size[1] * resize_ratio))
     return new_size
+
+def configure_screen_size(size):
+    """Sets the screen size that wallpaper variants are rendered for, instead of detecting it.
+
+    Args:
+        size (tuple[int, int]): Screen size in pixels (width, height), None to detect it again
+    """
+    global screen_size
+    screen_size = size
+
+def get_screen_size():
+    """Gets the size of the screen in pixels, detecting it the first time.
+
+    Returns:
+        tuple[int, int]: Screen size in pixels (width, height), or None if it cannot be detected
+    """
+    global screen_size
+    if screen_size is None:
+        screen_size = detect_screen_size()
+    return screen_size
+
+def detect_screen_size():
+    """Detects the size of the main screen in pixels.
+
+    On macOS the native resolution is read from system_profiler (so Retina
+    screens report their real pixel count); elsewhere Tk is asked.
+
+    Returns:
+        tuple[int, int]: Screen size in pixels (width, height), or None if it cannot be detected
+    """
+    try:
+        if sys.platform == 'darwin':
+            result = subprocess.run(['system_profiler', 'SPDisplaysDataType'], capture_output=True, text=True)
+            match = re.search(r'Resolution: (\d+) x (\d+)', result.stdout)
+            return (int(match[1]), int(match[2])) if match else None
+
+        import tkinter
+        root = tkinter.Tk()
+        try:
+            return root.winfo_screenwidth(), root.winfo_screenheight()
+        finally:
+            root.destroy()
+    except Exception:
+        return None
+
+def render_image_variant(image_path, variant_path, max_size):
+    """Saves a copy of an image scaled down to fit a maximum size, as a JPEG.
+
+    JPEGs are decoded at a reduced scale where possible (Pillow's draft mode),
+    so large images are never fully decoded. Safe to run in a worker process.
+
+    Args:
+        image_path (str): Path of the image file
+        variant_path (str): Path the scaled copy is saved at
+        max_size (tuple[int, int]): Maximum size in pixels (width, height)
+
+    Returns:
+        bool: True, if the copy was saved. False, if Pillow is not installed, the
+        image could not be read, or it already fits within max_size
+    """
+    if load_pillow() is None:
+        return False
+
+    temp_path = f'{variant_path}.{os.getpid()}.tmp'
+    try:
+        with Image.open(image_path) as image:
+            new_size = scale_image(image.size, max_size)
+            if new_size[0] >= image.size[0] or new_size[1] >= image.size[1]:
+                return False
+            image.draft('RGB', new_size)
+            variant = image.convert('RGB').resize(new_size, Image.LANCZOS)
+        variant.save(temp_path, 'JPEG', quality=VARIANT_QUALITY)
+        os.replace(temp_path, variant_path)
+        return True
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+def render_thumbnail_pyramid(image_path, thumbnail_paths):
+    """Saves thumbnails of an image at several sizes, as JPEGs.
+
+    The image is decoded once, at the reduced scale closest to the largest
+    thumbnail, and each smaller thumbnail is scaled down from the one before
+    it. Safe to run in a worker thread.
+
+    Args:
+        image_path (str): Path of the image file
+        thumbnail_paths (dict): Max width and height of each thumbnail in pixels -> path it is saved at
+
+    Returns:
+        bool: True, if the thumbnails were saved. False, if Pillow is not installed
+        or the image could not be read
+    """
+    if load_pillow() is None:
+        return False
+
+    sizes = sorted(thumbnail_paths, reverse=True)
+    try:
+        with Image.open(image_path) as image:
+            image.draft('RGB', (sizes[0], sizes[0]))
+            thumbnail = image.convert('RGB')
+        for size in sizes:
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            temp_path = f'{thumbnail_paths[size]}.{os.getpid()}.{threading.get_ident()}.tmp'
+            thumbnail.save(temp_path, 'JPEG', quality=VARIANT_QUALITY)
+            os.replace(temp_path, thumbnail_paths[size])
+        return True
+    except OSError:
+        return False
+
+def load_pillow():
+    """Imports Pillow the first time an image has to be decoded, so setting an
+    already rendered wallpaper does not pay for loading it.
+
+    Returns:
+        module: PIL.Image, or None if Pillow is not installed
+    """
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+    return Image
+
+def add_wallpaper_variant(image_path, variant_path):
+    """Registers a screen-size variant of an image, for set_desktop_background_image to use.
+
+    Args:
+        image_path (str): Path of the original image file
+        variant_path (str): Path of the variant
+    """
+    wallpaper_variants[os.path.abspath(image_path)] = variant_path
  
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,165 @@
+'''
+Library for caching APOD information returned by NASA's APOD API.
+
+Lookups go through an in-process LRU first and then an on-disk table in the
+image cache DB, so repeat lookups need no API call at all. Entries for past
+dates (images and videos alike) never expire, since their APOD information
+never changes. Today's entry and failed lookups expire after their own time-to-live.
+'''
+from collections import OrderedDict
+from datetime import date
+import json
+import threading
+import time
+import cache_db
+
+
+LRU_SIZE = 512               # Max number of entries kept in memory
+TODAY_TTL = 60 * 60          # Seconds before today's APOD info is fetched again
+NEGATIVE_TTL = 10 * 60       # Seconds before a failed lookup is tried again
+
+# Global variables
+use_disk = False             # Whether entries are also kept in the image cache DB
+lru = OrderedDict()          # APOD date -> (APOD info, expiry time or None)
+lru_lock = threading.Lock()  # Guards lru and stats, which are shared by worker threads
+stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+def main():
+    store_apod_info('2004-08-08', {'date': '2004-08-08', 'media_type': 'image'})
+    print(lookup_apod_info('2004-08-08'))
+    print(get_cache_stats())
+    return
+
+def init_metadata_cache():
+    """Sets up the on-disk APOD information cache in the open image cache DB,
+    creating its table if it does not already exist.
+    """
+    global use_disk
+
+    cache_db.execute("""
+        CREATE TABLE IF NOT EXISTS apod_metadata
+        (
+           apod_date  TEXT PRIMARY KEY,
+           info_json  TEXT,
+           expires_at REAL
+        );
+    """)
+    use_disk = True
+
+def lookup_apod_info(apod_date):
+    """Looks up cached APOD information for a specified date.
+
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+
+    Returns:
+        tuple[bool, dict]: (True, APOD info) on a cache hit, where the APOD info is None
+        for a cached failure. (False, None) on a cache miss.
+    """
+    key = str(apod_date)
+    now = time.time()
+
+    with lru_lock:
+        entry = lru.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > now):
+            lru.move_to_end(key)
+            stats['memory_hits'] += 1
+            return True, entry[0]
+
+    if use_disk:
+        query_result = cache_db.query_one("SELECT info_json, expires_at FROM apod_metadata WHERE apod_date = ?", (key,))
+
+        if query_result is not None and (query_result[1] is None or query_result[1] > now):
+            apod_info = json.loads(query_result[0]) if query_result[0] is not None else None
+            with lru_lock:
+                remember(key, apod_info, query_result[1])
+                stats['disk_hits'] += 1
+            return True, apod_info
+
+    with lru_lock:
+        stats['misses'] += 1
+    return False, None
+
+def store_apod_info(apod_date, apod_info):
+    """Stores APOD information for a specified date in the cache.
+
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+        apod_info (dict): Dictionary of APOD info, or None if the lookup failed
+    """
+    key = str(apod_date)
+    expires_at = get_expiry_time(key, apod_info)
+
+    with lru_lock:
+        remember(key, apod_info, expires_at)
+
+    if use_disk:
+        info_json = json.dumps(apod_info) if apod_info is not None else None
+        cache_db.execute("INSERT OR REPLACE INTO apod_metadata (apod_date, info_json, expires_at) VALUES (?, ?, ?)",
+                         (key, info_json, expires_at))
+
+def forget_apod_info(apod_date):
+    """Removes the cached APOD information for a specified date, e.g. a failed
+    lookup that should be retried before it expires.
+
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+    """
+    key = str(apod_date)
+    with lru_lock:
+        lru.pop(key, None)
+
+    if use_disk:
+        cache_db.execute("DELETE FROM apod_metadata WHERE apod_date = ?", (key,))
+
+def get_expiry_time(apod_date, apod_info):
+    """Determines when cached APOD information for a specified date expires.
+
+    Args:
+        apod_date (str): APOD date formatted as YYYY-MM-DD
+        apod_info (dict): Dictionary of APOD info, or None if the lookup failed
+
+    Returns:
+        float: Expiry time in seconds since the epoch, or None if the entry never expires
+    """
+    if apod_info is None:
+        return time.time() + NEGATIVE_TTL
+    if apod_date >= date.today().isoformat():
+        return time.time() + TODAY_TTL
+    return None
+
+def remember(key, apod_info, expires_at):
+    """Adds an entry to the in-process LRU, evicting the least recently used
+    entry when it is full. The caller must hold lru_lock.
+
+    Args:
+        key (str): APOD date formatted as YYYY-MM-DD
+        apod_info (dict): Dictionary of APOD info, or None if the lookup failed
+        expires_at (float): Expiry time in seconds since the epoch, or None
+    """
+    lru[key] = (apod_info, expires_at)
+    lru.move_to_end(key)
+    while len(lru) > LRU_SIZE:
+        lru.popitem(last=False)
+
+def get_cache_stats():
+    """Gets the hit and miss counts of the APOD information cache.
+
+    Returns:
+        dict: Number of 'memory_hits', 'disk_hits' and 'misses', plus the
+        number of entries currently held in memory as 'memory_entries'
+    """
+    with lru_lock:
+        cache_stats = dict(stats)
+        cache_stats['memory_entries'] = len(lru)
+    return cache_stats
+
+def clear_memory_cache():
+    """Empties the in-process LRU and resets the hit and miss counts."""
+    with lru_lock:
+        lru.clear()
+        for stat in stats:
+            stats[stat] = 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+Library for timing and counting the stages of the APOD fetch pipeline.
+
+Each stage (API call, image download, hashing, SQLite, setting the wallpaper)
+is wrapped in a timing span, and bytes transferred and cache hits/misses are
+counted. The totals can be dumped in the Prometheus text format, and every
+span can also be written to a JSON-lines log as it ends.
+'''
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+# Global variables
+stage_stats = {}             # Stage name -> {'count', 'seconds', 'max_seconds'}
+counters = {}                # Counter name -> value
+metrics_lock = threading.Lock()
+log_file = None              # Open JSON-lines log of spans, None if not logging
+
+def main():
+    with span('example'):
+        time.sleep(0.01)
+    increment('example_bytes', 1024)
+    print(format_prometheus())
+    return
+
+def configure_metrics(log_path=None):
+    """Sets where spans are logged as they end.
+
+    Args:
+        log_path (str, optional): Path of a JSON-lines log file to append to, None to stop logging. Defaults to None.
+    """
+    global log_file
+
+    with metrics_lock:
+        if log_file is not None:
+            log_file.close()
+        log_file = open(log_path, 'a') if log_path is not None else None
+
+@contextmanager
+def span(stage, **labels):
+    """Times a block of code as one run of a pipeline stage.
+
+    Args:
+        stage (str): Name of the stage
+        **labels: Extra fields written to the log with the span (e.g. url='...')
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start_time, **labels)
+
+def record(stage, seconds, **labels):
+    """Records one run of a pipeline stage that was timed by the caller.
+
+    Args:
+        stage (str): Name of the stage
+        seconds (float): Time taken by the stage
+        **labels: Extra fields written to the log with the span
+    """
+    with metrics_lock:
+        stats = stage_stats.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+        if log_file is not None:
+            event = {'time': time.time(), 'stage': stage, 'seconds': round(seconds, 6)}
+            event.update(labels)
+            log_file.write(json.dumps(event) + '\n')
+            log_file.flush()
+
+def increment(counter, amount=1):
+    """Adds to a counter, e.g. of bytes downloaded or cache hits.
+
+    Args:
+        counter (str): Name of the counter
+        amount (int, optional): Amount added. Defaults to 1.
+    """
+    with metrics_lock:
+        counters[counter] = counters.get(counter, 0) + amount
+
+def get_metrics():
+    """Gets a snapshot of all stage timings and counters.
+
+    Returns:
+        dict: 'stages' (stage name -> count, seconds and max_seconds) and 'counters'
+    """
+    with metrics_lock:
+        return {
+            'stages': {stage: dict(stats) for stage, stats in stage_stats.items()},
+            'counters': dict(counters)
+        }
+
+def reset_metrics():
+    """Clears all stage timings and counters."""
+    with metrics_lock:
+        stage_stats.clear()
+        counters.clear()
+
+def format_prometheus():
+    """Formats all stage timings and counters in the Prometheus text format.
+
+    Returns:
+        str: Metrics text
+    """
+    snapshot = get_metrics()
+    lines = [
+        '# HELP apod_stage_seconds Time spent in each stage of the APOD pipeline.',
+        '# TYPE apod_stage_seconds summary'
+    ]
+    for stage, stats in sorted(snapshot['stages'].items()):
+        lines.append(f'apod_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines.append(f'apod_stage_seconds_sum{{stage="{stage}"}} {stats["seconds"]:.6f}')
+    lines.append('# HELP apod_stage_seconds_max Longest single run of each stage.')
+    lines.append('# TYPE apod_stage_seconds_max gauge')
+    for stage, stats in sorted(snapshot['stages'].items()):
+        lines.append(f'apod_stage_seconds_max{{stage="{stage}"}} {stats["max_seconds"]:.6f}')
+    for counter, value in sorted(snapshot['counters'].items()):
+        lines.append(f'# TYPE apod_{counter}_total counter')
+        lines.append(f'apod_{counter}_total {value}')
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path):
+    """Writes all stage timings and counters to a file in the Prometheus text format.
+
+    Args:
+        path (str): Path of the file
+    """
+    with open(path, 'w') as file:
+        file.write(format_prometheus())
+
+def run_profiled(function, report_prefix):
+    """Runs a function under cProfile and tracemalloc and writes their reports.
+
+    Writes report_prefix.prof (cProfile data for pstats/snakeviz),
+    report_prefix_cpu.txt (top functions by cumulative time) and
+    report_prefix_memory.txt (top allocation sites and peak traced memory).
+
+    Args:
+        function (function): Function to run, taking no arguments
+        report_prefix (str): Path prefix of the report files
+
+    Returns:
+        The return value of function
+    """
+    # The profilers are only loaded for --profile runs
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(f'{report_prefix}.prof')
+        with open(f'{report_prefix}_cpu.txt', 'w') as file:
+            pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(40)
+        with open(f'{report_prefix}_memory.txt', 'w') as file:
+            file.write(f'Peak traced memory: {peak_memory / 1024:.1f} KiB\n')
+            file.write(f'Traced memory at exit: {current_memory / 1024:.1f} KiB\n\n')
+            for stat in snapshot.statistics('lineno')[:40]:
+                file.write(f'{stat}\n')
+        print(f'Profile reports written to {report_prefix}.prof, {report_prefix}_cpu.txt and {report_prefix}_memory.txt')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''
+Library for coalescing concurrent calls that would fetch the same thing.
+
+When several threads (or asyncio tasks) ask for the same key at once, e.g.
+the APOD information for one date or the image at one URL, only the first
+caller runs the fetch. The others wait for it and share its result (or its
+exception), so the network request, the download and the image cache DB
+write happen once. Calls made after the fetch has finished start a new one;
+results are not cached here.
+'''
+import threading
+import metrics
+
+
+# Global variables
+in_flight = {}                    # Key -> Flight of the call running for it
+in_flight_lock = threading.Lock() # Guards in_flight
+in_flight_tasks = {}              # (event loop, key) -> asyncio task of the call running for it
+
+def main():
+    def slow_square(number):
+        threading.Event().wait(0.1)
+        print(f'Squaring {number}')
+        return number * number
+
+    threads = [threading.Thread(target=lambda: print(call(('square', 4), slow_square, 4))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(metrics.get_metrics()['counters'])
+    return
+
+class Flight:
+    """A call in progress, shared by every caller of the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def call(key, function, *args, **kwargs):
+    """Calls a function, unless a call for the same key is already running,
+    in which case waits for that call and returns its result instead.
+
+    The function must not call() with its own key, or it would wait for itself.
+
+    Args:
+        key (hashable): Identifies what the function fetches, e.g. ('apod_info', '2024-01-01')
+        function (function): Function to call
+        *args: Arguments of the function
+        **kwargs: Keyword arguments of the function
+
+    Raises:
+        Exception: Whatever the function raised, in every caller sharing the call
+
+    Returns:
+        object: Result of the function
+    """
+    with in_flight_lock:
+        flight = in_flight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = in_flight[key] = Flight()
+
+    if not is_leader:
+        metrics.increment('single_flight_shared')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = function(*args, **kwargs)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+        flight.done.set()
+
+async def call_async(key, function, *args, **kwargs):
+    """Calls a blocking function on a worker thread without blocking the event
+    loop, unless a call for the same key is already running, in which case
+    awaits that call instead.
+
+    Calls are shared both between tasks of the same event loop and with
+    threads using call().
+
+    Args:
+        key (hashable): Identifies what the function fetches
+        function (function): Blocking function to call
+        *args: Arguments of the function
+        **kwargs: Keyword arguments of the function
+
+    Raises:
+        Exception: Whatever the function raised, in every caller sharing the call
+
+    Returns:
+        object: Result of the function
+    """
+    import asyncio  # Only asyncio callers pay for importing it
+
+    loop = asyncio.get_running_loop()
+    task_key = (loop, key)
+    task = in_flight_tasks.get(task_key)
+    if task is None:
+        task = loop.create_task(asyncio.to_thread(call, key, function, *args, **kwargs))
+        in_flight_tasks[task_key] = task
+        task.add_done_callback(lambda task: in_flight_tasks.pop(task_key, None))
+    else:
+        metrics.increment('single_flight_shared')
+
+    # A cancelled caller must not cancel the call the other callers are waiting for
+    return await asyncio.shield(task)
+
+def get_in_flight_count():
+    """Gets the number of calls currently running.
+
+    Returns:
+        int: Number of keys with a call in progress
+    """
+    with in_flight_lock:
+        return len(in_flight)
+
+if __name__ == '__main__':
+    main()